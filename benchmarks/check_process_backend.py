@@ -0,0 +1,135 @@
+"""
+process バックエンドの動作確認
+
+子プロセスで実行したyt-dlpの結果・例外・進捗が親プロセスへ正しく届くかを確認する。
+エクストラクターの差し替えは子プロセスに及ばないため、MediaServer のファイルを
+URLで直接ダウンロードする（yt-dlpの汎用エクストラクター）。
+
+- 正常終了: 'selected'（選ばれたフォーマットID）と 'finished' が run() の終了までに中継される
+- HTTP 429: yt-dlpのメッセージのまま DownloadError として届き、'rate_limit' に分類される。
+  ワーカー経由で実行すると同時実行数が下がり、新規開始が一時停止される
+- 接続拒否: pickleできない例外に置き換わらず、'network' に分類される
+
+使い方:
+    python benchmarks/check_process_backend.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from media_server import MediaServer  # noqa: E402
+
+# ワーカー経由のジョブの終了を待つ最大時間（秒）
+JOB_TIMEOUT = 60
+# 接続を拒否されるURL（ポート9はdiscardで通常は待ち受けていない）
+REFUSED_URL = 'http://127.0.0.1:9/refused0001.mp4'
+
+
+def check(results: list, name: str, ok: bool, detail: str = ''):
+    results.append(ok)
+    print(f"[{'OK' if ok else 'NG'}] {name}{f': {detail}' if detail else ''}")
+
+
+async def run_backend(api, url: str, workdir: Path) -> tuple:
+    """バックエンドで直接実行し (結果または例外, 受け取った進捗のステータス) を返す"""
+    statuses = []
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'outtmpl': str(workdir / '%(id)s.%(ext)s'),
+        'retries': 0,
+    }
+    try:
+        result = await api.download_backend.run(
+            str(uuid.uuid4()), url, ydl_opts,
+            lambda d: statuses.append(d['status']), lambda d: None,
+        )
+    except Exception as e:
+        result = e
+    return result, statuses
+
+
+async def run_worker_job(api, url: str) -> dict:
+    """待ち行列に入れてダウンロードワーカーに実行させ、終了したタスクを返す"""
+    task_id = str(uuid.uuid4())
+    api.task_store.create(task_id, api.new_task_record(format='mp4'))
+    api.download_queue.put_nowait(task_id, {'url': url, 'format': 'mp4', 'cookie_id': None})
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        task = api.task_store.get(task_id)
+        if task['status'] in api.FINAL_STATUSES:
+            return task
+        await asyncio.sleep(0.2)
+    return api.task_store.get(task_id)
+
+
+async def run_checks(api, server: MediaServer, workdir: Path) -> list:
+    from yt_dlp.utils import DownloadError
+
+    results: list = []
+    async with api.app.router.lifespan_context(api.app):
+        # 正常終了: 最後の進捗まで中継されてから run() が戻る
+        info, statuses = await run_backend(api, f'{server.url}/media/check/check000001.mp4', workdir)
+        check(results, "download returns info", isinstance(info, dict), type(info).__name__)
+        check(results, "'selected' relayed", 'selected' in statuses, str(statuses[:3]))
+        check(results, "'finished' relayed before run() returns",
+              bool(statuses) and statuses[-1] == 'finished', str(statuses[-3:]))
+
+        # HTTP 429: メッセージからレート制限に分類できる
+        error, _ = await run_backend(api, f'{server.url}/status/429/ratelimit01.mp4', workdir)
+        check(results, "429 raises DownloadError", isinstance(error, DownloadError), repr(error)[:120])
+        check(results, "429 classified as rate_limit", api.classify_error(str(error)) == 'rate_limit')
+
+        # 接続拒否: pickleできない例外（_YDLLogger・トレースバック）に置き換わらない
+        error, _ = await run_backend(api, REFUSED_URL, workdir)
+        check(results, "refused URL raises DownloadError", isinstance(error, DownloadError), repr(error)[:120])
+        check(results, "refused URL classified as network", api.classify_error(str(error)) == 'network')
+
+        # ワーカー経由: レート制限で同時実行数が下がり、新規開始が一時停止される
+        limit = api.concurrency.limit
+        task = await run_worker_job(api, f'{server.url}/status/429/ratelimit02.mp4')
+        check(results, "worker job fails with the rate limit message",
+              task.get('error') == api.ERROR_MESSAGES['rate_limit'], str(task.get('error'))[:120])
+        check(results, "concurrency backs off",
+              api.concurrency.limit < limit and api.concurrency.backoff_remaining() > 0,
+              f"limit {limit} -> {api.concurrency.limit}, backoff {api.concurrency.backoff_remaining():.0f}s")
+    return results
+
+
+def main():
+    workdir = Path(tempfile.mkdtemp(prefix='rushia-check-'))
+
+    # 確認用の環境（アプリのimport前に設定）
+    os.environ['RUSHIA_DL_BACKEND'] = 'process'
+    os.environ['RUSHIA_DL_TASK_STORE'] = 'memory'
+    os.environ['RUSHIA_DL_JOURNAL'] = str(workdir / 'journal.sqlite3')
+    os.environ['RUSHIA_DL_YTDLP_CACHE'] = str(workdir / 'yt-dlp-cache')
+
+    server = MediaServer(fragment_size=64 * 1024, fragment_count=4)
+    server.start()
+
+    from rushia_dl import api
+
+    download_dir = workdir / 'download'
+    download_dir.mkdir()
+    api.DOWNLOAD_DIR = download_dir
+    api.artifact_cache.directory = download_dir
+
+    try:
+        results = asyncio.run(run_checks(api, server, workdir))
+    finally:
+        server.stop()
+
+    print(f"\n{sum(results)}/{len(results)} checks passed")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
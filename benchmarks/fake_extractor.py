@@ -0,0 +1,79 @@
+"""
+ベンチマーク用のyt-dlpエクストラクター
+
+YouTubeのURLを受け付け、ネットワークにはアクセスせずにローカルの
+MediaServer を指すフォーマットを返す。install() を呼ぶと、以後作成される
+YoutubeDLで本物のYouTubeエクストラクターより先に使われる。
+"""
+from yt_dlp import YoutubeDL
+from yt_dlp.extractor.common import InfoExtractor
+
+# 配信方式ごとのyt-dlpのprotocol
+PROTOCOLS = {
+    'http': 'http',
+    'dash': 'http_dash_segments',
+    'hls': 'm3u8_native',
+}
+
+
+class FakeYoutubeIE(InfoExtractor):
+    IE_NAME = 'rushia:bench'
+    _VALID_URL = r'https?://(?:(?:www|m|music)\.)?(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|live/|embed/)|youtu\.be/)(?P<id>[0-9A-Za-z_-]{11})'
+
+    # install() で設定
+    server = None
+    protocol = 'dash'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        return {
+            'id': video_id,
+            'title': f'Bench {video_id}',
+            'live_status': 'not_live',
+            'duration': 2 * self.server.fragment_count,
+            'formats': [
+                self._format(video_id, 'mp4', vcodec='avc1.4d401f', acodec='mp4a.40.2'),
+                self._format(video_id, 'm4a', vcodec='none', acodec='mp4a.40.2'),
+            ],
+        }
+
+    def _format(self, video_id: str, ext: str, vcodec: str, acodec: str) -> dict:
+        base = self.server.url
+        fmt = {
+            'format_id': f'{self.protocol}-{ext}',
+            'ext': ext,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'protocol': PROTOCOLS[self.protocol],
+            'filesize': self.server.total_size,
+        }
+        if self.protocol == 'dash':
+            fmt['url'] = f'{base}/dash/{video_id}/{ext}/manifest.mpd'
+            fmt['fragment_base_url'] = f'{base}/dash/{video_id}/{ext}/'
+            fmt['fragments'] = [
+                {'path': f'seg{i}.m4s', 'duration': 2.0} for i in range(self.server.fragment_count)
+            ]
+        elif self.protocol == 'hls':
+            fmt['url'] = f'{base}/hls/{video_id}/{ext}/index.m3u8'
+        else:
+            fmt['url'] = f'{base}/media/{video_id}/{ext}'
+        return fmt
+
+
+def install(server, protocol: str = 'dash'):
+    """以後作成されるYoutubeDLでFakeYoutubeIEを最優先で使う
+
+    同じプロセス内でのみ有効（process バックエンドの子プロセスには反映されない）。
+    """
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown protocol: {protocol} (choose from {', '.join(PROTOCOLS)})")
+    FakeYoutubeIE.server = server
+    FakeYoutubeIE.protocol = protocol
+
+    original = getattr(YoutubeDL.add_default_info_extractors, '__wrapped__', YoutubeDL.add_default_info_extractors)
+
+    def add_default_info_extractors(self):
+        self.add_info_extractor(FakeYoutubeIE())
+        original(self)
+    add_default_info_extractors.__wrapped__ = original
+    YoutubeDL.add_default_info_extractors = add_default_info_extractors
@@ -0,0 +1,151 @@
+"""
+ベンチマーク用のローカルメディアサーバー
+
+YouTubeの代わりに、合成したデータを次の3つの形式で配信する。
+    /media/<動画ID>/<フォーマット>              ファイル全体（プログレッシブ）
+    /dash/<動画ID>/<フォーマット>/seg<番号>.m4s  DASHのフラグメント
+    /hls/<動画ID>/<フォーマット>/index.m3u8      HLSのプレイリスト（フラグメントは seg<番号>.ts）
+    /status/<ステータスコード>/...               エラー応答（レート制限などの再現）
+中身は意味のないバイト列のため、ffmpegによる後処理は行えない。
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# 送信時の書き込み単位
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class _Server(ThreadingHTTPServer):
+    # 同時接続が多くても接続を拒否しないよう待ち受けキューを大きくする
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MediaServer:
+    """合成メディアを配信するHTTPサーバー（別スレッドで動作）
+
+    fragment_size × fragment_count が1本あたりのサイズ。latency は各リクエストの
+    応答前の待ち時間、bandwidth は1接続あたりの送信速度の上限（バイト/秒）。
+    """
+
+    def __init__(self, fragment_size: int = 256 * 1024, fragment_count: int = 20,
+                 latency: float = 0.0, bandwidth: Optional[float] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.fragment_size = fragment_size
+        self.fragment_count = fragment_count
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._payload = bytes(range(256)) * (fragment_size // 256 + 1)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self._server = _Server((host, port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def total_size(self) -> int:
+        """1本あたりのサイズ（バイト）"""
+        return self.fragment_size * self.fragment_count
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='media-server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _handle(self, handler: BaseHTTPRequestHandler):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = handler.path.split('?')[0].strip('/').split('/')
+        if parts[0] == 'media' and len(parts) == 3:
+            self._send_body(handler, self.total_size, 'video/mp4')
+        elif parts[0] == 'dash' and len(parts) == 4 and parts[3].startswith('seg'):
+            self._send_body(handler, self.fragment_size, 'video/iso.segment')
+        elif parts[0] == 'hls' and len(parts) == 4 and parts[3] == 'index.m3u8':
+            self._send_playlist(handler)
+        elif parts[0] == 'hls' and len(parts) == 4 and parts[3].startswith('seg'):
+            self._send_body(handler, self.fragment_size, 'video/mp2t')
+        elif parts[0] == 'status' and len(parts) >= 2 and parts[1].isdigit():
+            # 指定したステータスのエラー応答（/status/429/... でレート制限を再現）
+            handler.send_error(int(parts[1]))
+        else:
+            handler.send_error(404)
+
+    def _send_playlist(self, handler: BaseHTTPRequestHandler):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for i in range(self.fragment_count):
+            lines += ['#EXTINF:2.0,', f'seg{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        body = ('\n'.join(lines) + '\n').encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _send_body(self, handler: BaseHTTPRequestHandler, size: int, content_type: str):
+        start, end = 0, size - 1
+        range_header = handler.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            handler.send_response(206)
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            handler.send_response(200)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.end_headers()
+
+        remaining = end - start + 1
+        started_at = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                n = min(remaining, WRITE_CHUNK_SIZE)
+                handler.wfile.write(self._chunk(n))
+                remaining -= n
+                sent += n
+                if self.bandwidth:
+                    # 送信速度の上限に合わせて待機
+                    ahead = sent / self.bandwidth - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self._lock:
+                self.bytes_sent += sent
+
+    def _chunk(self, n: int) -> bytes:
+        if n <= len(self._payload):
+            return self._payload[:n]
+        return (self._payload * (n // len(self._payload) + 1))[:n]
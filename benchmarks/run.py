@@ -0,0 +1,227 @@
+"""
+rushia-dl Web APIの負荷・ベンチマーク
+
+ローカルの MediaServer と FakeYoutubeIE を使い、ネットワークにアクセスせずに
+/api/download と /api/status を多数のクライアントから呼び出して計測する。
+アプリはこのプロセス内で起動し、HTTPサーバーを介さずASGIで直接呼び出す。
+
+使い方:
+    python benchmarks/run.py --clients 50 --requests 200 --videos 40
+    python benchmarks/run.py --protocol hls --fragment-size 131072 --json result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from fake_extractor import PROTOCOLS, install  # noqa: E402
+from media_server import MediaServer  # noqa: E402
+
+# 利用率・メモリの記録間隔（秒）
+SAMPLE_INTERVAL = 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="rushia-dl Web APIのベンチマーク")
+    parser.add_argument("--clients", type=int, default=20, help="同時に動かすクライアント数")
+    parser.add_argument("--requests", type=int, default=100, help="ダウンロード要求の総数")
+    parser.add_argument("--videos", type=int, default=50,
+                        help="動画IDの種類数（要求数より少ないと同じ動画への重複要求になる）")
+    parser.add_argument("--format", choices=["mp4", "m4a"], default="mp4",
+                        help="要求するフォーマット（合成データは単一フォーマットのAACのため、どちらも後処理はファイル名の変更だけで済む）")
+    parser.add_argument("--protocol", choices=list(PROTOCOLS), default="dash", help="メディアの配信方式")
+    parser.add_argument("--fragment-size", type=int, default=256 * 1024, help="フラグメントのサイズ（バイト）")
+    parser.add_argument("--fragments", type=int, default=20, help="1本あたりのフラグメント数")
+    parser.add_argument("--latency", type=float, default=0.0, help="メディアサーバーの応答遅延（秒）")
+    parser.add_argument("--bandwidth", type=float, default=None, help="1接続あたりの送信速度の上限（バイト/秒）")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="/api/status の呼び出し間隔（秒）")
+    parser.add_argument("--task-store", choices=["memory", "sqlite"], default="memory", help="タスク状態の保存先")
+    parser.add_argument("--seed", type=int, default=0, help="動画の選び方の乱数シード")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで保存するパス")
+    return parser.parse_args()
+
+
+def percentile(values: list, p: float) -> float:
+    """最近傍法のパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+
+def current_rss() -> int:
+    """現在の常駐メモリ（バイト、Linux以外ではピーク値）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Recorder:
+    """リクエストごとの所要時間と結果を記録"""
+
+    def __init__(self):
+        self.latencies = {'download': [], 'status': []}
+        self.completion = []
+        self.outcomes: dict = {}
+
+    def outcome(self, name: str):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+
+async def run_client(client: httpx.AsyncClient, jobs: asyncio.Queue, recorder: Recorder, args):
+    """要求を1件ずつ取り出し、完了するまで状態を確認する"""
+    while True:
+        try:
+            video_id = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        started = time.perf_counter()
+        response = await client.post('/api/download', json={
+            'url': f'https://www.youtube.com/watch?v={video_id}',
+            'format': args.format,
+        })
+        recorder.latencies['download'].append(time.perf_counter() - started)
+        if response.status_code != 200:
+            recorder.outcome(f'rejected_{response.status_code}')
+            continue
+
+        task_id = response.json()['task_id']
+        status = response.json()['status']
+        while status not in ('completed', 'error'):
+            await asyncio.sleep(args.poll_interval)
+            polled = time.perf_counter()
+            response = await client.get(f'/api/status/{task_id}')
+            recorder.latencies['status'].append(time.perf_counter() - polled)
+            if response.status_code != 200:
+                status = f'missing_{response.status_code}'
+                break
+            status = response.json()['status']
+        recorder.completion.append(time.perf_counter() - started)
+        recorder.outcome(status)
+
+
+async def sample(api, samples: list, stop: asyncio.Event):
+    """実行中のダウンロード数とメモリ使用量を定期的に記録"""
+    while not stop.is_set():
+        samples.append((api.active_downloads, len(api.download_queue), current_rss()))
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_benchmark(api, args) -> dict:
+    rng = random.Random(args.seed)
+    video_ids = [f'bench{i:06d}' for i in range(args.videos)]
+    jobs: asyncio.Queue = asyncio.Queue()
+    for _ in range(args.requests):
+        jobs.put_nowait(rng.choice(video_ids))
+
+    recorder = Recorder()
+    samples: list = []
+    stop = asyncio.Event()
+    transport = httpx.ASGITransport(app=api.app)
+    async with api.app.router.lifespan_context(api.app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            sampler = asyncio.create_task(sample(api, samples, stop))
+            started = time.perf_counter()
+            await asyncio.gather(*(run_client(client, jobs, recorder, args) for _ in range(args.clients)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await sampler
+
+    total_requests = sum(len(v) for v in recorder.latencies.values())
+    active = [s[0] for s in samples]
+    return {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'requests_per_s': total_requests / elapsed if elapsed else 0.0,
+        'downloads_per_s': recorder.outcomes.get('completed', 0) / elapsed if elapsed else 0.0,
+        'outcomes': recorder.outcomes,
+        'latency': {name: summarize(values) for name, values in recorder.latencies.items()},
+        'completion': summarize(recorder.completion),
+        'worker_utilization': (sum(active) / len(active) / api.MAX_CONCURRENT_DOWNLOADS) if active else 0.0,
+        'max_queued': max((s[1] for s in samples), default=0),
+        'peak_rss_mb': max((s[2] for s in samples), default=0) / 1024 / 1024,
+        'ydl_sessions': {'created': api.session_pool.created, 'reused': api.session_pool.reused},
+    }
+
+
+def print_report(result: dict, server: MediaServer):
+    print(f"\n経過時間: {result['elapsed_s']:.2f}s")
+    print(f"API: {result['requests_per_s']:.1f} req/s, 完了したダウンロード: {result['downloads_per_s']:.2f} 件/s")
+    print(f"結果: {result['outcomes']}")
+    for name, stats in [*result['latency'].items(), ('completion', result['completion'])]:
+        print(f"  {name:<10} n={stats['count']:<6} p50={stats['p50_ms']:8.1f}ms "
+              f"p99={stats['p99_ms']:8.1f}ms max={stats['max_ms']:8.1f}ms")
+    print(f"ワーカー利用率: {result['worker_utilization'] * 100:.0f}% (最大待機 {result['max_queued']} 件)")
+    print(f"メモリ（ピークRSS）: {result['peak_rss_mb']:.1f} MiB")
+    print(f"YoutubeDLセッション: 作成 {result['ydl_sessions']['created']} / 再利用 {result['ydl_sessions']['reused']}")
+    print(f"メディアサーバー: {server.requests} リクエスト, {server.bytes_sent / 1024 / 1024:.1f} MiB 送信")
+
+
+def main():
+    args = parse_args()
+    workdir = Path(tempfile.mkdtemp(prefix='rushia-bench-'))
+
+    # 計測用の環境（アプリのimport前に設定）
+    os.environ['RUSHIA_DL_BACKEND'] = 'thread'
+    os.environ['RUSHIA_DL_TASK_STORE'] = args.task_store
+    os.environ['RUSHIA_DL_TASK_DB'] = str(workdir / 'tasks.sqlite3')
+    # 再開用の記録とyt-dlpのキャッシュも一時ディレクトリへ（中断したベンチマークのジョブを本番で再開しない）
+    os.environ['RUSHIA_DL_JOURNAL'] = str(workdir / 'journal.sqlite3')
+    os.environ['RUSHIA_DL_YTDLP_CACHE'] = str(workdir / 'yt-dlp-cache')
+
+    server = MediaServer(
+        fragment_size=args.fragment_size,
+        fragment_count=args.fragments,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+    )
+    server.start()
+    install(server, args.protocol)
+
+    from rushia_dl import api
+
+    # ダウンロード先を一時ディレクトリに切り替え（既存のキャッシュを使わない）
+    download_dir = workdir / 'download'
+    download_dir.mkdir()
+    api.DOWNLOAD_DIR = download_dir
+    api.artifact_cache.directory = download_dir
+
+    try:
+        result = asyncio.run(run_benchmark(api, args))
+    finally:
+        server.stop()
+
+    print_report(result, server)
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(result, ensure_ascii=False, indent=2))
+        print(f"結果を保存しました: {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
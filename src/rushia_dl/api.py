@@ -4,32 +4,103 @@ FastAPI backend for rushia_dl web interface
 from __future__ import unicode_literals
 
 import asyncio
+import glob
+import json
+import os
 import time
 import uuid
+from urllib.parse import quote
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
 from threading import Lock
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from yt_dlp import YoutubeDL
+from starlette.background import BackgroundTask
+from yt_dlp.utils import DownloadCancelled
+
+from .archive import iter_zip
+from .cache import ArtifactCache, TTLCache
+from .journal import DownloadJournal
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry
+from .player_cache import CACHE_DIR as YTDLP_CACHE_DIR, prune_player_cache
+from .postprocess import PostProcessPool, final_name
+from .progress import ProgressTracker
+from .scheduler import AdaptiveConcurrency, ClientQueueLimitError, DownloadQueue, FragmentBudget, QueueFullError
+from .task_store import create_task_store
+from .urls import VIDEO_ID_PATTERN, extract_video_id
+from .workers import create_backend, session_pool
 
 # アプリケーションのライフサイクル管理
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """アプリケーションの起動・終了時の処理"""
-    global cleanup_task
+    global cleanup_task, download_workers, cancel_watcher, journal_watcher, shutting_down
+    # 起動時: 既存ファイルからキャッシュ索引を構築
+    cached_count = artifact_cache.scan()
+    print(f"[Startup] Artifact cache indexed {cached_count} file(s)")
+    evicted = artifact_cache.enforce_budget()
+    # 起動時: 前回終了しなかったダウンロードを待ち行列に戻す（書き込み途中のファイルは掃除しない）
+    resumed = resume_journaled_jobs(journal.claim())
+    if resumed:
+        print(f"[Startup] Resuming {resumed} interrupted download(s)")
+    strays = artifact_cache.sweep_strays(active_video_ids(), STRAY_FILE_GRACE_SECONDS)
+    if evicted or strays:
+        print(f"[Startup] Removed {len(evicted)} file(s) over budget, {len(strays)} stray file(s)")
+    stale_players = prune_player_cache(YTDLP_CACHE_DIR)
+    if stale_players:
+        print(f"[Startup] Removed {len(stale_players)} stale player cache file(s)")
     # 起動時: クリーンアップタスクを開始
     cleanup_task = asyncio.create_task(cleanup_old_files())
     print(f"[Startup] File cleanup task started (retention: {FILE_RETENTION_HOURS} hours)")
+    # 起動時: 待ち行列からジョブを取り出すワーカーを開始
+    download_workers = [
+        asyncio.create_task(download_worker()) for _ in range(MAX_CONCURRENT_DOWNLOADS)
+    ]
+    print(f"[Startup] {len(download_workers)} download worker(s) started "
+          f"(backend: {download_backend.name}, queue size: {MAX_QUEUE_SIZE}, "
+          f"post-processing slots: {postprocess_pool.max_workers})")
+    warmup_task = asyncio.create_task(warm_ydl_sessions())
+    # 起動時: 放置されたタスクの自動キャンセルを開始
+    cancel_watcher = asyncio.create_task(watch_cancellations())
+    if IDLE_CANCEL_SECONDS:
+        print(f"[Startup] Tasks left unchecked for {IDLE_CANCEL_SECONDS}s will be cancelled")
+    # 起動時: 異常終了した他のワーカープロセスのダウンロードの引き取りを開始
+    journal_watcher = asyncio.create_task(watch_journal())
     
     yield
     
+    # 以降に中断されるジョブは次回の起動時に再開するため記録を残す
+    shutting_down = True
+    warmup_task.cancel()
+    cancel_watcher.cancel()
+    journal_watcher.cancel()
+    # 終了時: 一括ダウンロードの投入とワーカーを停止
+    feeders = list(batch_feeders)
+    for feeder in feeders:
+        feeder.cancel()
+    await asyncio.gather(*feeders, return_exceptions=True)
+    for worker in download_workers:
+        worker.cancel()
+    await asyncio.gather(*download_workers, return_exceptions=True)
+    download_workers = []
+    # 後処理中のffmpegを停止
+    postprocessing = list(postprocess_tasks.values())
+    for task in postprocessing:
+        task.cancel()
+    await asyncio.gather(*postprocessing, return_exceptions=True)
+    # 実行中のyt-dlpを止めてから、中断したジョブを次回の起動・他のワーカープロセスに引き渡す
+    download_backend.shutdown()
+    task_store.close()
+    journal.release()
+    journal.close()
+    
     # 終了時: クリーンアップタスクを停止
     if cleanup_task:
         cleanup_task.cancel()
@@ -76,13 +147,60 @@ if STATIC_DIR.exists():
 
 # 並行ダウンロード設定
 MAX_CONCURRENT_DOWNLOADS = 5  # 同時ダウンロード上限
-download_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+# yt-dlpの実行方式: "thread"（プロセス内スレッド）または "process"（別プロセス、CPUコア数に応じて並列化）
+DOWNLOAD_BACKEND = os.environ.get('RUSHIA_DL_BACKEND', 'thread')
+download_backend = create_backend(DOWNLOAD_BACKEND, MAX_CONCURRENT_DOWNLOADS)
+# レート制限を検知したら同時実行数を減らし、全体で新規開始とリトライを一時停止する
+MIN_CONCURRENT_DOWNLOADS = 1
+RATE_LIMIT_BACKOFF_SECONDS = 60  # 最初の一時停止時間（連続すると倍々、最大15分）
+concurrency = AdaptiveConcurrency(
+    MAX_CONCURRENT_DOWNLOADS,
+    min_limit=MIN_CONCURRENT_DOWNLOADS,
+    backoff_base=RATE_LIMIT_BACKOFF_SECONDS,
+    on_backoff=download_backend.set_backoff,
+)
+# HLS/DASHのフラグメントの同時接続数（全ジョブの合計と1ジョブあたりの上限）
+FRAGMENT_CONNECTION_BUDGET = 16
+MAX_FRAGMENT_CONNECTIONS_PER_JOB = 8
+fragment_budget = FragmentBudget(FRAGMENT_CONNECTION_BUDGET, MAX_FRAGMENT_CONNECTIONS_PER_JOB)
 active_downloads = 0
 downloads_lock = Lock()
+# 結合・変換（ffmpeg）はダウンロードの枠とは別に、CPUのコア数まで並列で実行
+postprocess_pool = PostProcessPool()
+postprocess_tasks: dict = {}  # タスクID -> 後処理のasyncioタスク
+
+# 待ち行列設定
+MAX_QUEUE_SIZE = 100  # 待ち行列に入れられるジョブ数の上限
+MAX_QUEUED_PER_CLIENT = 20  # 1クライアントあたりの待ちジョブ数の上限
+# フォーマットごとの優先度（小さいほど先に実行、短い音声を大きな動画の結合より優先）
+FORMAT_PRIORITY = {
+    'm4a': 0,
+    'mp4': 10,
+}
+# 一括ダウンロード設定
+MAX_BATCH_ITEMS = 200  # 1回の一括ダウンロードで受け付ける件数の上限
+BATCH_QUEUE_WINDOW = 5  # 1つの一括ダウンロードから同時に待ち行列へ入れる件数
+BATCH_FEED_INTERVAL = 1.0  # 待ち行列の空きを確認する間隔（秒）
+BATCH_TTL = 6 * 60 * 60  # 一括ダウンロードの情報の保持時間（秒）
+batches = TTLCache(BATCH_TTL)
+batch_feeders: set = set()
+# 動画情報取得（ライブ配信チェック）設定
+PROBE_WORKERS = 2  # 情報取得専用スレッド数（ダウンロード枠とは別）
+PROBE_CACHE_TTL = 10 * 60  # 取得した動画情報の有効期間（秒、フォーマットURLの失効より十分短く）
+probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+probe_cache = TTLCache(PROBE_CACHE_TTL)
+
+download_queue = DownloadQueue(MAX_QUEUE_SIZE, max_per_client=MAX_QUEUED_PER_CLIENT)
+download_workers: list = []
 
 # ファイル保持設定
-FILE_RETENTION_HOURS = 3  # ファイル保持時間（時間）
-CLEANUP_INTERVAL_SECONDS = 300  # クリーンアップ間隔（5分）
+FILE_RETENTION_HOURS = 3  # ファイル保持時間（時間、最後に利用されてから）
+MAX_CACHE_BYTES = 20 * 1024 ** 3  # ダウンロードディレクトリの容量上限（超えたら利用の少ないファイルから削除）
+STRAY_FILE_GRACE_SECONDS = 60 * 60  # 一時ファイルをこの時間更新がなければ削除
+STRAY_SWEEP_INTERVAL_SECONDS = 60 * 60  # 一時ファイルの掃除間隔
+# nginxに配信を任せる場合の内部ロケーション（例: "/_downloads/"、空なら本体から配信）
+ACCEL_REDIRECT_PREFIX = os.environ.get('RUSHIA_DL_ACCEL_REDIRECT', '')
+CLEANUP_INTERVAL_SECONDS = 300  # 削除予定がない場合の最大待機時間（5分）
 
 # タスクステータスごとのタイムアウト設定（秒）
 TASK_TIMEOUT = {
@@ -94,59 +212,187 @@ TASK_TIMEOUT = {
 }
 
 # ダウンロードタスクの状態管理
-download_tasks: dict = {}
+# "memory"（プロセス内の辞書、既定）または "sqlite"（複数ワーカーで共有、再起動後も保持）
+TASK_STORE = os.environ.get('RUSHIA_DL_TASK_STORE', 'memory')
+DATA_DIR = Path(__file__).parent.parent.parent / ".data"
+TASK_DB_PATH = Path(os.environ.get('RUSHIA_DL_TASK_DB', DATA_DIR / "tasks.sqlite3"))
+task_store = create_task_store(TASK_STORE, TASK_TIMEOUT, TASK_DB_PATH)
+
+# ダウンロード中のジョブの記録（再起動後に書き込み途中のファイルから再開する）
+JOURNAL_PATH = Path(os.environ.get('RUSHIA_DL_JOURNAL', DATA_DIR / "journal.sqlite3"))
+JOURNAL_UPDATE_INTERVAL = 5  # 進み具合を記録する最短間隔（秒）
+JOURNAL_HEARTBEAT_INTERVAL = 10  # 生存の記録と、終了したワーカープロセスのジョブを引き取る間隔（秒）
+JOURNAL_OWNER_TIMEOUT = 60  # 生存の記録がこの秒数途絶えたワーカープロセスは異常終了したとみなす
+MAX_RESUME_ATTEMPTS = 3  # 再開しても終わらないジョブはこの回数で諦める（起動のたびに異常終了する原因の可能性）
+RESUME_MAX_AGE = TASK_TIMEOUT['downloading']  # これより前に受け付けたジョブは再開しない（秒）
+journal = DownloadJournal(JOURNAL_PATH, JOURNAL_OWNER_TIMEOUT)
+journal_watcher: Optional[asyncio.Task] = None
+shutting_down = False  # 終了処理中（中断したジョブの記録を残す）
+
+# 実行中ダウンロードの集約（(動画ID, フォーマット) → 代表タスクID）
+inflight_downloads: dict = {}
+inflight_keys: dict = {}  # 代表タスクID → (動画ID, フォーマット)
+inflight_lock = Lock()
+
+# 代表タスクの完了時に相乗りタスクへコピーする項目
+SHARED_RESULT_FIELDS = ('status', 'progress', 'filename', 'error', 'title')
+
+# 完成済みファイルの索引（(動画ID, フォーマット) → ファイル）
+artifact_cache = ArtifactCache(DOWNLOAD_DIR, FILE_RETENTION_HOURS * 60 * 60, MAX_CACHE_BYTES)
+
+# 進捗の反映間隔（秒）。yt-dlpのコールバックはこれより細かくても間引く
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+# 進捗ストリーム設定
+PROGRESS_STREAM_INTERVAL = 0.5  # 進捗イベントの最短送信間隔（秒）
+PROGRESS_STREAM_KEEPALIVE = 15  # 更新がない場合のキープアライブ間隔（秒）
+PROGRESS_STREAM_MAX_TASKS = 50  # 1つのストリームで購読できるタスク数の上限
+
+# 終了状態（これ以降は更新されない）
+FINAL_STATUSES = ('completed', 'error')
+
+# キャンセル設定
+# クライアントが状態を確認しなくなって（/api/status・/api/events・/api/batch）この秒数が過ぎたら自動でキャンセル（0で無効）
+IDLE_CANCEL_SECONDS = int(os.environ.get('RUSHIA_DL_IDLE_CANCEL_SECONDS') or 0)
+SEEN_UPDATE_INTERVAL = 5  # 確認された時刻を記録する最短間隔（秒）
+CANCEL_CHECK_INTERVAL = 5  # 自動キャンセルと、他のプロセスで受け付けたキャンセルを確認する間隔（秒）
+CANCELLED_MESSAGE = "ダウンロードはキャンセルされました。"
+cancel_reasons: dict = {}  # 中断を要求した実行中のタスク -> 理由（'user' / 'idle'）
+job_files: dict = {}  # 実行中のタスク -> yt-dlpが書き込んだファイル名（キャンセル時に削除）
+cancel_watcher: Optional[asyncio.Task] = None
+
+# ダウンロード中のファイルの配信（/api/stream）
+STREAM_CHUNK_SIZE = 64 * 1024  # 1回に読み込んで送る大きさ
+STREAM_POLL_INTERVAL = 0.25  # 追記を待つ間隔（秒）
+
+# メトリクス（/metrics でPrometheus形式で出力）
+metrics = MetricsRegistry(prefix='rushia_dl_')
+probe_seconds = metrics.histogram('probe_seconds', 'Time spent probing video info (live check, playlist expansion)', ('kind',))
+queue_wait_seconds = metrics.histogram('queue_wait_seconds', 'Time jobs spent waiting in the download queue', ('format',))
+download_seconds = metrics.histogram('download_seconds', 'Wall time of yt-dlp download jobs (excluding the post-processing stage)', ('format', 'outcome'))
+postprocess_seconds = metrics.histogram('postprocess_seconds', 'Time spent in each post-processing step (rename, remux, merge, convert, yt-dlp post-processors)', ('postprocessor',))
+serve_seconds = metrics.histogram('serve_seconds', 'Time to send downloaded files to clients', ('mode',))
+downloaded_bytes_total = metrics.counter('downloaded_bytes_total', 'Bytes downloaded by yt-dlp')
+cache_lookups_total = metrics.counter('cache_lookups_total', 'Artifact lookups by result (hit, inflight, miss)', ('result',))
+download_errors_total = metrics.counter('download_errors_total', 'Failed downloads by error category', ('category',))
+cancellations_total = metrics.counter('cancellations_total', 'Cancelled tasks by reason (user, idle)', ('reason',))
+metrics.gauge('active_downloads', 'Downloads currently running', lambda: active_downloads)
+metrics.gauge('concurrency_limit', 'Current adaptive limit on concurrent downloads', lambda: int(concurrency.limit))
+metrics.gauge('backoff_seconds', 'Remaining global backoff after an upstream rate limit', concurrency.backoff_remaining)
+metrics.gauge('postprocess_active', 'ffmpeg processes running in the post-processing stage', lambda: postprocess_pool.active)
+metrics.gauge('postprocess_waiting', 'Jobs waiting for a post-processing slot', lambda: postprocess_pool.waiting)
+metrics.gauge('fragment_connections', 'Fragment connections allotted to running downloads', lambda: fragment_budget.in_use)
+metrics.gauge('queued_downloads', 'Downloads waiting in the queue', lambda: len(download_queue))
+metrics.gauge('ydl_sessions_idle', 'Warm YoutubeDL sessions waiting in this process', session_pool.idle_count)
+metrics.gauge('cache_files', 'Files in the download directory', lambda: artifact_cache.file_count)
+metrics.gauge('cache_bytes', 'Disk usage of the download directory in bytes', lambda: artifact_cache.total_bytes)
+metrics.gauge('cache_max_bytes', 'Configured size limit of the download directory in bytes', lambda: MAX_CACHE_BYTES)
 
 # クリーンアップタスクの制御
 cleanup_task: Optional[asyncio.Task] = None
 
 
+class TaskEventHub:
+    """タスク更新をワーカースレッドから進捗ストリームへ通知"""
+
+    def __init__(self):
+        self._subscribers: dict = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, task_ids: list) -> asyncio.Event:
+        """タスクIDを購読し、更新時にセットされるイベントを返す"""
+        self._loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        for task_id in task_ids:
+            self._subscribers.setdefault(task_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, task_ids: list, event: asyncio.Event):
+        """購読を解除"""
+        for task_id in task_ids:
+            events = self._subscribers.get(task_id)
+            if events is None:
+                continue
+            events.discard(event)
+            if not events:
+                del self._subscribers[task_id]
+
+    def notify(self, task_id: str):
+        """タスクの更新を通知（どのスレッドからでも呼び出し可能）"""
+        if task_id not in self._subscribers or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wake, task_id)
+        except RuntimeError:
+            # イベントループが終了済み
+            pass
+
+    def _wake(self, task_id: str):
+        for event in self._subscribers.get(task_id, ()):
+            event.set()
+
+
+# タスク更新の通知先
+task_events = TaskEventHub()
+
+
 async def cleanup_old_files():
-    """古いダウンロードファイルとタスク情報を定期的に削除"""
+    """古いダウンロードファイルとタスク情報を削除予定時刻に合わせて削除"""
+    next_sweep = time.time() + STRAY_SWEEP_INTERVAL_SECONDS
     while True:
         try:
-            await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+            # 次の削除予定時刻まで待機（予定がなくても最大CLEANUP_INTERVAL_SECONDSごとに確認）
+            deadlines = [next_sweep]
+            deadlines += [d for d in (artifact_cache.next_expiry(), task_store.next_expiry()) if d is not None]
+            wait = CLEANUP_INTERVAL_SECONDS
+            if deadlines:
+                wait = min(max(min(deadlines) - time.time(), 0), CLEANUP_INTERVAL_SECONDS)
+            await asyncio.sleep(wait)
             current_time = time.time()
-            file_retention_seconds = FILE_RETENTION_HOURS * 60 * 60
-            deleted_files = 0
-            deleted_tasks = 0
             
-            # 古いファイルを削除（3時間経過）
-            for file_path in DOWNLOAD_DIR.iterdir():
-                if file_path.is_file() and file_path.suffix in ['.m4a', '.mp4']:
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > file_retention_seconds:
-                        try:
-                            file_path.unlink()
-                            deleted_files += 1
-                            print(f"[Cleanup] Deleted old file: {file_path.name}")
-                        except Exception as e:
-                            print(f"[Cleanup] Failed to delete {file_path.name}: {e}")
+            # 古いファイルを削除（最後の更新から3時間経過）
+            deleted = artifact_cache.delete_expired(current_time)
+            for filename in deleted:
+                print(f"[Cleanup] Deleted old file: {filename}")
             
             # 古いタスク情報を削除（ステータスごとのタイムアウト）
-            tasks_to_delete = []
-            for task_id, task_data in download_tasks.items():
-                created_at = task_data.get('created_at', 0)
-                status = task_data.get('status', 'pending')
-                timeout = TASK_TIMEOUT.get(status, 3 * 60 * 60)  # デフォルト3時間
-                task_age = current_time - created_at
-                
-                if task_age > timeout:
-                    tasks_to_delete.append(task_id)
+            deleted_tasks = task_store.delete_expired(current_time)
             
-            for task_id in tasks_to_delete:
-                del download_tasks[task_id]
-                deleted_tasks += 1
+            # 中断されたダウンロードの一時ファイルを削除（実行中のものは残す）
+            if current_time >= next_sweep:
+                next_sweep = current_time + STRAY_SWEEP_INTERVAL_SECONDS
+                loop = asyncio.get_running_loop()
+                strays = await loop.run_in_executor(
+                    None, artifact_cache.sweep_strays, active_video_ids(), STRAY_FILE_GRACE_SECONDS
+                )
+                for filename in strays:
+                    print(f"[Cleanup] Deleted stray file: {filename}")
+                # 古いバージョンのプレイヤーJSのキャッシュを削除
+                stale_players = await loop.run_in_executor(None, prune_player_cache, YTDLP_CACHE_DIR)
+                if stale_players:
+                    print(f"[Cleanup] Deleted {len(stale_players)} stale player cache file(s)")
             
-            if deleted_files > 0 or deleted_tasks > 0:
-                print(f"[Cleanup] Deleted {deleted_files} file(s), {deleted_tasks} task(s)")
+            if deleted or deleted_tasks > 0:
+                print(f"[Cleanup] Deleted {len(deleted)} file(s), {deleted_tasks} task(s)")
                 
         except asyncio.CancelledError:
             print("[Cleanup] Task cancelled")
             break
         except Exception as e:
             print(f"[Cleanup] Error: {e}")
+            await asyncio.sleep(1)
 
 
+def active_video_ids() -> set:
+    """実行中・待機中のダウンロードの動画ID（一時ファイルを残す対象）"""
+    with inflight_lock:
+        ids = {video_id for video_id, _ in inflight_downloads}
+    for task_id in download_queue.task_ids():
+        job = download_queue.get_job(task_id)
+        video_id = extract_video_id(job['url']) if job else None
+        if video_id:
+            ids.add(video_id)
+    return ids
 
 
 class DownloadRequest(BaseModel):
@@ -155,6 +401,13 @@ class DownloadRequest(BaseModel):
     cookie_id: Optional[str] = None  # アップロードされたCookieのID
 
 
+class BatchRequest(BaseModel):
+    urls: list[str] = []  # 動画URLの一覧
+    playlist_url: Optional[str] = None  # プレイリストのURL（urlsと併用可）
+    format: str  # "m4a" or "mp4"
+    cookie_id: Optional[str] = None  # アップロードされたCookieのID（全件で共有）
+
+
 class CookieUploadResponse(BaseModel):
     cookie_id: str
     message: str
@@ -173,113 +426,152 @@ class DownloadStatus(BaseModel):
     downloaded_bytes: Optional[int] = None
     total_bytes: Optional[int] = None
     elapsed: Optional[float] = None  # 経過秒数
+    queue_position: Optional[int] = None  # 待ち順（待機中のみ、1始まり）
+
+
+class BatchStatus(BaseModel):
+    batch_id: str
+    title: Optional[str] = None  # プレイリスト名
+    total: int
+    completed: int
+    failed: int
+    running: int  # ダウンロード中・処理中
+    pending: int  # 待機中
+    progress: float  # 全体の進捗（各タスクの平均）
+    tasks: list[DownloadStatus]
 
 
 def progress_hook(task_id: str):
-    """ダウンロード進捗のコールバック"""
+    """ダウンロード進捗のコールバック（PROGRESS_UPDATE_INTERVALごとにまとめて反映）"""
+    def apply(snapshot: dict):
+        # ステータスが変わらない進捗だけの更新は保存先がまとめて書き込む
+        task_store.update(task_id, batch='status' not in snapshot, **snapshot)
+        task_events.notify(task_id)
+    
+    tracker = ProgressTracker(apply, PROGRESS_UPDATE_INTERVAL)
+    partial_files = []
+    # キャンセル時に削除するファイル
+    written = job_files.setdefault(task_id, set())
+    last_recorded = 0.0
+    
     def hook(d):
-        if d['status'] == 'downloading':
-            # バイトベースの進捗
-            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-            downloaded = d.get('downloaded_bytes', 0)
-            
-            # フラグメントベースの進捗（HLS/DASHなど）
-            fragment_index = d.get('fragment_index')
-            fragment_count = d.get('fragment_count')
-            
-            # 進捗を計算
-            if total > 0 and downloaded > 0:
-                progress = (downloaded / total) * 100
-            elif fragment_index and fragment_count:
-                progress = (fragment_index / fragment_count) * 100
-            else:
-                progress = download_tasks[task_id].get('progress', 0)
-            
-            download_tasks[task_id]['progress'] = min(progress, 99)
-            download_tasks[task_id]['status'] = 'downloading'
-            
-            # 追加情報を保存
-            download_tasks[task_id]['speed'] = d.get('speed')
-            download_tasks[task_id]['eta'] = d.get('eta')
-            download_tasks[task_id]['downloaded_bytes'] = downloaded
-            download_tasks[task_id]['total_bytes'] = total
-            download_tasks[task_id]['elapsed'] = d.get('elapsed')
-            
-            # フラグメント情報も保存（デバッグ用）
-            if fragment_index and fragment_count:
-                download_tasks[task_id]['fragment_index'] = fragment_index
-                download_tasks[task_id]['fragment_count'] = fragment_count
-            
-        elif d['status'] == 'finished':
-            download_tasks[task_id]['status'] = 'processing'
-            download_tasks[task_id]['progress'] = 99
-            # ダウンロード完了時の情報をクリア
-            download_tasks[task_id]['speed'] = None
-            download_tasks[task_id]['eta'] = None
+        nonlocal last_recorded
+        if d['status'] == 'selected':
+            # 再開時に同じフォーマット（同じファイル名）を選ぶよう記録
+            journal.update(task_id, format_ids=d['format_ids'])
+            return
+        for key in ('filename', 'tmpfilename'):
+            if d.get(key):
+                written.add(Path(d[key]).name)
+        if d['status'] == 'finished':
+            downloaded_bytes_total.inc(d.get('total_bytes') or d.get('downloaded_bytes') or 0)
+        elif d['status'] == 'downloading' and d.get('tmpfilename') not in partial_files:
+            # 変換なしでm4aになるファイルの書き込み先を記録（/api/streamで書き込み中から配信する）
+            partial_files.append(d.get('tmpfilename'))
+            if d.get('tmpfilename') and str(d.get('filename', '')).endswith('.m4a'):
+                task_store.update(task_id, partial_file=Path(d['tmpfilename']).name)
+        if d['status'] == 'downloading' and time.monotonic() - last_recorded >= JOURNAL_UPDATE_INTERVAL:
+            # 再開の位置はyt-dlpが .part・.ytdl に持つため、ここでは確認用に記録する
+            last_recorded = time.monotonic()
+            journal.update(task_id, position={
+                'filename': Path(d.get('filename') or '').name,
+                'fragment_index': d.get('fragment_index'),
+                'fragment_count': d.get('fragment_count'),
+                'downloaded_bytes': d.get('downloaded_bytes'),
+            })
+        tracker.on_progress(d)
     return hook
 
 
 def postprocessor_hook(task_id: str):
-    """後処理の進捗コールバック"""
+    """後処理の進捗コールバック（後処理ごとの所要時間も記録）"""
+    started: dict = {}
+    
     def hook(d):
+        name = d.get('postprocessor') or ''
         if d['status'] == 'finished':
-            download_tasks[task_id]['progress'] = 100
+            task_store.update(task_id, progress=100)
+            if name in started:
+                postprocess_seconds.observe(time.monotonic() - started.pop(name), postprocessor=name)
         elif d['status'] == 'started':
             # エンコード開始
-            download_tasks[task_id]['status'] = 'processing'
+            task_store.update(task_id, status='processing')
+            started[name] = time.monotonic()
+        task_events.notify(task_id)
     return hook
 
 
-def format_error_message(error: str) -> str:
-    """エラーメッセージをユーザーフレンドリーな形式に変換"""
+# エラーの分類ごとのユーザー向けメッセージ
+ERROR_MESSAGES = {
+    'rate_limit': "YouTubeのレート制限に達しました。1時間ほど待ってから再度お試しください。",
+    'content_unavailable': "この動画は現在利用できません。YouTubeのレート制限の可能性があります。しばらく待ってから再度お試しください。",
+    'video_unavailable': "この動画は利用できません。削除されたか、非公開になっている可能性があります。",
+    'private': "この動画は非公開です。",
+    'age_restricted': "この動画は年齢制限があります。cookie.txtを使用してログイン状態でお試しください。",
+    'members_only': "この動画はメンバーシップ限定です。cookie.txtを使用してメンバーシップオプションを有効にしてください。",
+    'geo_restricted': "この動画はお住まいの地域では利用できません。",
+    'network': "ネットワークエラーが発生しました。インターネット接続を確認して再度お試しください。",
+    'ffmpeg': "動画の変換中にエラーが発生しました。FFmpegが正しくインストールされているか確認してください。",
+}
+
+
+def classify_error(error: str) -> str:
+    """エラーメッセージを分類（メトリクスのラベルにも使用）"""
     error_lower = error.lower()
     
     # レート制限エラー
-    if 'rate-limit' in error_lower or 'rate limit' in error_lower:
-        return "YouTubeのレート制限に達しました。1時間ほど待ってから再度お試しください。"
+    if ('rate-limit' in error_lower or 'rate limit' in error_lower
+            or 'http error 429' in error_lower or 'too many requests' in error_lower):
+        return 'rate_limit'
     
     # コンテンツ利用不可
     if "this content isn't available" in error_lower:
-        return "この動画は現在利用できません。YouTubeのレート制限の可能性があります。しばらく待ってから再度お試しください。"
+        return 'content_unavailable'
     
     # 動画が見つからない
     if 'video unavailable' in error_lower or 'not available' in error_lower:
-        return "この動画は利用できません。削除されたか、非公開になっている可能性があります。"
+        return 'video_unavailable'
     
     # プライベート動画
     if 'private video' in error_lower:
-        return "この動画は非公開です。"
+        return 'private'
     
     # 年齢制限
     if 'age' in error_lower and 'restrict' in error_lower:
-        return "この動画は年齢制限があります。cookie.txtを使用してログイン状態でお試しください。"
+        return 'age_restricted'
     
     # メンバーシップ限定
     if 'members-only' in error_lower or 'member' in error_lower:
-        return "この動画はメンバーシップ限定です。cookie.txtを使用してメンバーシップオプションを有効にしてください。"
+        return 'members_only'
     
     # 地域制限
     if 'geo' in error_lower or 'country' in error_lower:
-        return "この動画はお住まいの地域では利用できません。"
+        return 'geo_restricted'
     
     # ネットワークエラー
     if 'network' in error_lower or 'connection' in error_lower:
-        return "ネットワークエラーが発生しました。インターネット接続を確認して再度お試しください。"
+        return 'network'
     
     # FFmpegエラー
     if 'ffmpeg' in error_lower:
-        return "動画の変換中にエラーが発生しました。FFmpegが正しくインストールされているか確認してください。"
+        return 'ffmpeg'
     
     # その他のエラー
+    return 'other'
+
+
+def format_error_message(error: str) -> str:
+    """エラーメッセージをユーザーフレンドリーな形式に変換"""
+    category = classify_error(error)
+    if category in ERROR_MESSAGES:
+        return ERROR_MESSAGES[category]
     return f"ダウンロード中にエラーが発生しました: {error}"
 
 
-def get_common_ydl_opts(task_id: str) -> dict:
-    """共通のyt-dlpオプションを取得"""
+def get_common_ydl_opts() -> dict:
+    """共通のyt-dlpオプションを取得（進捗フックは実行バックエンドが設定）"""
     return {
         'outtmpl': str(DOWNLOAD_DIR / '%(title)s-%(id)s.%(ext)s'),
-        'progress_hooks': [progress_hook(task_id)],
-        'postprocessor_hooks': [postprocessor_hook(task_id)],
         'noplaylist': True,
         # リトライ設定（レート制限エラー時の自動リトライ）
         'retries': 10,  # リトライ回数
@@ -290,15 +582,46 @@ def get_common_ydl_opts(task_id: str) -> dict:
         'no_warnings': False,  # 警告を表示
         # YouTubeのJSチャレンジ解決に必要（Deno + remote components）
         'remote_components': ['ejs:github'],
+        # プレイヤーJSの解析結果を全ワーカー・CLIで共有
+        'cachedir': str(YTDLP_CACHE_DIR),
         # 注意: sleep_intervalはダウンロード速度を大幅に低下させるため
         # ダウンロード時には使用しない（情報取得時のみ使用）
     }
 
 
-async def download_video(task_id: str, url: str, format: str, cookie_id: Optional[str] = None):
-    """バックグラウンドでダウンロードを実行"""
-    global active_downloads
+def get_download_ydl_opts(format: str, cookie_path: Optional[Path] = None) -> dict:
+    """フォーマットに応じたダウンロード用のyt-dlpオプションを取得"""
+    # 共通オプションを取得
+    ydl_opts = get_common_ydl_opts()
     
+    # 結合・変換・コンテナの修正は後処理の段階（postprocess_pool）で行う
+    ydl_opts['fixup'] = 'never'
+    
+    if format == 'm4a':
+        # M4A: YouTubeのネイティブ形式を完成品の名前に直接ダウンロード（M4A以外の形式の場合のみ後処理で変換）
+        ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
+    else:  # mp4
+        # フォーマットごとに .f137.mp4 などとして保存（同じ動画のm4aのジョブとは別のファイルにする）
+        ydl_opts.update({
+            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best',
+            'outtmpl': str(DOWNLOAD_DIR / '%(title)s-%(id)s.f%(format_id)s.%(ext)s'),
+        })
+    
+    # クッキーファイルが存在する場合は使用
+    if cookie_path and cookie_path.exists():
+        ydl_opts['cookiefile'] = str(cookie_path)
+    return ydl_opts
+
+
+async def download_video(task_id: str, url: str, format: str, cookie_id: Optional[str] = None,
+                         keep_cookie: bool = False, format_ids: Optional[list] = None) -> str:
+    """バックグラウンドでダウンロードを実行（keep_cookieなら終了後もCookieを残す）
+
+    format_ids は再開したジョブで前回選ばれたフォーマット（同じファイル名になり続きから保存される）。
+
+    結果として 'success'（ダウンロードを終えて後処理へ引き継いだ）または
+    エラーの分類（classify_error）を返す。後処理の結果はタスクの状態に反映される。
+    """
     # URLをクリーンアップ（プレイリストパラメータを削除）
     url = clean_youtube_url(url)
     
@@ -314,108 +637,199 @@ async def download_video(task_id: str, url: str, format: str, cookie_id: Optiona
     else:
         print("[Debug] download_video: No cookie_id provided")
     
+    outcome = 'other'
     try:
-        download_tasks[task_id]['status'] = 'downloading'
+        if is_task_finished(task_id):
+            # 待ち行列に入った後、開始前にキャンセルされた
+            outcome = 'cancelled'
+            return outcome
         
-        # 共通オプションを取得
-        ydl_opts = get_common_ydl_opts(task_id)
+        task_store.update(task_id, status='downloading')
+        task_events.notify(task_id)
         
-        if format == 'm4a':
-            # M4A: YouTubeのネイティブ形式を直接ダウンロード（変換なし）
-            ydl_opts.update({
-                'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                # M4A以外の形式がダウンロードされた場合のみ変換
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'm4a',
-                    'preferredquality': '0',  # 元の品質を維持
-                    'nopostoverwrites': True,
-                }],
-            })
-        else:  # mp4
-            ydl_opts.update({
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best',
-                'merge_output_format': 'mp4',
-            })
+        ydl_opts = get_download_ydl_opts(format, cookie_path)
+        if format_ids:
+            # 前回のフォーマットがなくなっていれば通常の選択に戻る
+            ydl_opts['format'] = f"{'+'.join(format_ids)}/{ydl_opts['format']}"
+        
+        # ライブ配信チェックで取得済みの動画情報があれば再抽出しない
+        probed_info = probe_cache.pop(probe_cache_key(url, cookie_id))
         
-        # クッキーファイルが存在する場合は使用
-        if cookie_path and cookie_path.exists():
-            ydl_opts['cookiefile'] = str(cookie_path)
+        # フラグメントの同時接続数を割り当て（レート制限で同時実行数を減らしている間は全体も縮める）
+        fragment_connections = fragment_budget.allocate(scale=concurrency.limit / MAX_CONCURRENT_DOWNLOADS)
+        ydl_opts['concurrent_fragment_downloads'] = fragment_connections
         
-        # ダウンロード実行（専用スレッドプールで実行）
-        def run_download():
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                # yt-dlpがサニタイズしたファイル名を取得
-                if info:
-                    # prepare_filenameで実際のファイル名を取得
-                    prepared_filename = ydl.prepare_filename(info)
-                    info['_prepared_filename'] = prepared_filename
-                return info
+        # ダウンロード実行（スレッドプールまたはプロセスプールで実行）
+        started_at = time.monotonic()
+        try:
+            info = await download_backend.run(
+                task_id, url, ydl_opts,
+                progress_hook(task_id), postprocessor_hook(task_id),
+                probed_info=probed_info,
+            )
+        except DownloadCancelled:
+            download_seconds.observe(time.monotonic() - started_at, format=format, outcome='cancelled')
+            raise
+        except Exception:
+            download_seconds.observe(time.monotonic() - started_at, format=format, outcome='error')
+            raise
+        finally:
+            fragment_budget.release(fragment_connections)
+        download_seconds.observe(time.monotonic() - started_at, format=format, outcome='success')
         
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(download_executor, run_download)
+        if task_id in cancel_reasons:
+            # 中断の要求がダウンロードの完了に間に合わなかった
+            raise DownloadCancelled('Download cancelled')
         
-        # ダウンロードしたファイル名を取得
         if info:
-            title = info.get('title', 'Unknown')
-            video_id = info.get('id', '')
-            ext = 'm4a' if format == 'm4a' else 'mp4'
-            
-            # 実際のファイルを検索（yt-dlpがサニタイズした名前で）
-            actual_filename = None
-            
-            # 方法1: video_idでファイルを検索
-            for file_path in DOWNLOAD_DIR.iterdir():
-                if file_path.is_file() and video_id in file_path.name:
-                    if file_path.suffix == f'.{ext}':
-                        actual_filename = file_path.name
-                        break
-            
-            # 方法2: prepare_filenameから取得
-            if not actual_filename and info.get('_prepared_filename'):
-                prepared = Path(info['_prepared_filename'])
-                # 拡張子を変換後のものに変更
-                expected_path = prepared.with_suffix(f'.{ext}')
-                if expected_path.exists():
-                    actual_filename = expected_path.name
-                # 元のパスも確認
-                elif prepared.with_suffix(f'.{ext}').name:
-                    for file_path in DOWNLOAD_DIR.iterdir():
-                        if video_id in file_path.name and file_path.suffix == f'.{ext}':
-                            actual_filename = file_path.name
-                            break
-            
-            if actual_filename:
-                download_tasks[task_id]['status'] = 'completed'
-                download_tasks[task_id]['progress'] = 100
-                download_tasks[task_id]['filename'] = actual_filename
-                download_tasks[task_id]['title'] = title
-            else:
-                download_tasks[task_id]['status'] = 'error'
-                download_tasks[task_id]['error'] = f"ダウンロードは完了しましたが、ファイルが見つかりません。(video_id: {video_id})"
+            # 結合・変換は後処理の段階で行い、ダウンロードの枠はここで空ける
+            outcome = 'success'
+            postprocess = asyncio.create_task(postprocess_download(task_id, format, info))
+            postprocess_tasks[task_id] = postprocess
+            postprocess.add_done_callback(lambda _: postprocess_tasks.pop(task_id, None))
         else:
             # infoがNoneの場合もエラーとして扱う
-            download_tasks[task_id]['status'] = 'error'
-            download_tasks[task_id]['error'] = "ダウンロードに失敗しました。動画情報を取得できませんでした。"
+            outcome = 'no_info'
+            download_errors_total.inc(category=outcome)
+            task_store.update(task_id, status='error', error="ダウンロードに失敗しました。動画情報を取得できませんでした。")
         
+    except DownloadCancelled:
+        # 書き込み途中のファイルとダウンロード済みのフォーマットを削除
+        outcome = 'cancelled'
+        mark_cancelled(task_id, cancel_reasons.pop(task_id, 'user'))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, remove_job_files, job_files.get(task_id, ()))
+    
     except Exception as e:
-        download_tasks[task_id]['status'] = 'error'
         # エラーメッセージをユーザーフレンドリーに変換
-        download_tasks[task_id]['error'] = format_error_message(str(e))
+        outcome = classify_error(str(e))
+        download_errors_total.inc(category=outcome)
+        task_store.update(task_id, status='error', error=format_error_message(str(e)))
     
     finally:
-        # ダウンロード完了後、カウンターをデクリメント
+        job_files.pop(task_id, None)
+        # 後処理へ引き継いだ場合は後処理の終了時に反映する
+        if outcome != 'success':
+            # 相乗りしていたタスクへ結果を反映
+            release_inflight(task_id)
+            task_events.notify(task_id)
+        
+        # Cookieファイルを削除（セキュリティのため、一括ダウンロードでは全件終了後に削除）
+        # 終了処理で中断された場合は再開時に使うため残す
+        if not keep_cookie and not shutting_down:
+            delete_cookie_file(cookie_path)
+    
+    return outcome
+
+
+async def postprocess_download(task_id: str, format: str, info: dict):
+    """ダウンロードしたファイルを結合・変換して完成品にし、タスクを完了させる
+
+    ffmpegの実行はダウンロードの枠とは別の postprocess_pool（コア数まで）で行う。
+    """
+    title = info.get('title', 'Unknown')
+    video_id = info.get('id', '')
+    ext = 'm4a' if format == 'm4a' else 'mp4'
+    files = []
+    try:
+        # yt-dlpが報告したパスから実際のファイルを取得（ディレクトリ走査はしない）
+        for downloaded in info.get('_downloaded_files') or []:
+            path = DOWNLOAD_DIR / Path(downloaded.get('path') or '').name
+            if path.is_file():
+                files.append({**downloaded, 'path': str(path)})
+        if not files:
+            download_errors_total.inc(category='file_not_found')
+            task_store.update(
+                task_id,
+                status='error',
+                error=f"ダウンロードは完了しましたが、ファイルが見つかりません。(video_id: {video_id})",
+            )
+            return
+        
+        task_store.update(task_id, status='processing')
+        task_events.notify(task_id)
+        output_path = DOWNLOAD_DIR / final_name(Path(files[0]['path']).name, ext)
+        started_at = time.monotonic()
+        kind = await postprocess_pool.run(format, files, output_path)
+        postprocess_seconds.observe(time.monotonic() - started_at, postprocessor=kind)
+        
+        task_store.update(
+            task_id,
+            status='completed',
+            progress=100,
+            filename=output_path.name,
+            title=title,
+        )
+        # 次回以降の同一リクエストのためにキャッシュへ登録（容量超過分は古いものから削除）
+        if video_id:
+            for evicted in artifact_cache.add(video_id, format, output_path.name, title):
+                print(f"[Cache] Evicted: {evicted}")
+    
+    except asyncio.CancelledError:
+        reason = cancel_reasons.pop(task_id, None)
+        if reason is None:
+            # 終了時の停止
+            raise
+        # ffmpegは停止済み（出力途中のファイルはpostprocess_poolが削除）
+        mark_cancelled(task_id, reason)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, remove_job_files, [Path(f['path']).name for f in files])
+    
+    except Exception as e:
+        category = classify_error(str(e))
+        download_errors_total.inc(category=category)
+        task_store.update(task_id, status='error', error=format_error_message(str(e)))
+    
+    finally:
+        # 相乗りしていたタスクへ結果を反映
+        release_inflight(task_id)
+        task_events.notify(task_id)
+
+
+async def download_worker():
+    """待ち行列からジョブを取り出してダウンロードを実行（同時実行数はconcurrencyが調整）"""
+    global active_downloads
+    
+    while True:
+        # ジョブができてから実行枠を待つ（枠を待つ間もジョブは待ち行列に残り、キャンセルと待ち順の表示ができる）
+        await download_queue.wait()
+        epoch = await concurrency.acquire()
+        job = download_queue.get_nowait()
+        if job is None:
+            # 実行枠を待つ間に他のワーカーが取り出した・キャンセルされた
+            concurrency.release(epoch, None)
+            continue
+        queue_wait_seconds.observe(time.time() - job['enqueued_at'], format=job['format'])
         with downloads_lock:
-            active_downloads -= 1
+            active_downloads += 1
         
-        # Cookieファイルを削除（セキュリティのため）
-        if cookie_path and cookie_path.exists():
-            try:
-                cookie_path.unlink()
-                print(f"[Security] Deleted cookie file: {cookie_path.name}")
-            except Exception as e:
-                print(f"[Security] Failed to delete cookie file: {e}")
+        # 残りの待機タスクの待ち順が変わったことを通知
+        for queued_id in download_queue.task_ids():
+            task_events.notify(queued_id)
+        
+        outcome = None
+        try:
+            outcome = await download_video(
+                job['task_id'], job['url'], job['format'], job['cookie_id'],
+                keep_cookie=job.get('keep_cookie', False), format_ids=job.get('format_ids'),
+            )
+        except Exception as e:
+            print(f"[Worker] Unexpected error in {job['task_id']}: {e}")
+        finally:
+            with downloads_lock:
+                active_downloads -= 1
+            concurrency.release(epoch, outcome)
+
+
+def get_client_key(request: Request) -> str:
+    """公平性の単位となるクライアント識別子（nginx経由ならX-Real-IP）"""
+    real_ip = request.headers.get('x-real-ip')
+    if real_ip:
+        return real_ip
+    forwarded = request.headers.get('x-forwarded-for')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.client.host if request.client else ''
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -502,6 +916,37 @@ def clean_youtube_url(url: str) -> str:
     return cleaned_url
 
 
+def get_probe_ydl_opts(cookie_path: Optional[Path] = None) -> dict:
+    """動画情報の取得（ライブ配信チェック）用のyt-dlpオプションを取得"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'noplaylist': True,  # プレイリストを無視
+        # レート制限対策
+        'sleep_interval': 1,
+        'extractor_retries': 3,
+        # YouTubeのJSチャレンジ解決に必要（Deno + remote components）
+        'remote_components': ['ejs:github'],
+        'cachedir': str(YTDLP_CACHE_DIR),
+    }
+    if cookie_path and cookie_path.exists():
+        ydl_opts['cookiefile'] = str(cookie_path)
+    return ydl_opts
+
+
+async def warm_ydl_sessions():
+    """よく使うオプションのYoutubeDLを事前に作成（最初の要求の待ち時間を減らす）"""
+    loop = asyncio.get_running_loop()
+    try:
+        probe = loop.run_in_executor(probe_executor, session_pool.warm, get_probe_ydl_opts())
+        warmed = await download_backend.warm([get_download_ydl_opts(format) for format in ('m4a', 'mp4')])
+        await probe
+        print(f"[Startup] Warmed {warmed + 1} YoutubeDL session(s)")
+    except Exception as e:
+        print(f"[Startup] Failed to warm YoutubeDL sessions: {e}")
+
+
 def check_if_live(url: str, cookie_id: Optional[str] = None) -> dict:
     """動画がライブ配信中かどうかをチェック"""
     # URLをクリーンアップ（プレイリストパラメータを削除）
@@ -519,24 +964,14 @@ def check_if_live(url: str, cookie_id: Optional[str] = None) -> dict:
     else:
         print("[Debug] check_if_live: No cookie_id provided")
     
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': False,
-        'noplaylist': True,  # プレイリストを無視
-        # レート制限対策
-        'sleep_interval': 1,
-        'extractor_retries': 3,
-        # YouTubeのJSチャレンジ解決に必要（Deno + remote components）
-        'remote_components': ['ejs:github'],
-    }
-    
-    if cookie_path and cookie_path.exists():
-        ydl_opts['cookiefile'] = str(cookie_path)
+    ydl_opts = get_probe_ydl_opts(cookie_path)
+    if 'cookiefile' in ydl_opts:
         print(f"[Debug] check_if_live: cookiefile option set to: {cookie_path}")
     
-    with YoutubeDL(ydl_opts) as ydl:
+    with session_pool.session(ydl_opts) as ydl, probe_seconds.time(kind='live_check'):
         info = ydl.extract_info(url, download=False)
+        # ダウンロード時に再抽出しなくて済むよう動画情報を保存
+        probe_cache.set(probe_cache_key(url, cookie_id), ydl.sanitize_info(info, remove_private_keys=True))
         return {
             'is_live': info.get('is_live', False),
             'live_status': info.get('live_status'),
@@ -544,66 +979,39 @@ def check_if_live(url: str, cookie_id: Optional[str] = None) -> dict:
         }
 
 
-@app.post("/api/download", response_model=DownloadStatus)
-async def start_download(request: DownloadRequest, background_tasks: BackgroundTasks):
-    """ダウンロードを開始"""
-    global active_downloads
-    
-    # URLの検証
-    if not request.url or 'youtube.com' not in request.url and 'youtu.be' not in request.url:
-        raise HTTPException(status_code=400, detail="有効なYouTube URLを入力してください")
-    
-    # フォーマットの検証
-    if request.format not in ['m4a', 'mp4']:
-        raise HTTPException(status_code=400, detail="フォーマットはm4aまたはmp4を指定してください")
-    
-    # 同時ダウンロード数のチェック
-    with downloads_lock:
-        if active_downloads >= MAX_CONCURRENT_DOWNLOADS:
-            raise HTTPException(
-                status_code=503,
-                detail=f"現在混み合っています（{active_downloads}/{MAX_CONCURRENT_DOWNLOADS}件処理中）。しばらくしてからお試しください。"
-            )
-        # ダウンロード数をインクリメント
-        active_downloads += 1
-    
-    # ライブ配信チェック（専用スレッドプールで実行）
+def live_error(video_info: dict) -> Optional[str]:
+    """ライブ配信中・配信予定ならダウンロードできない理由を返す（録画が配信終了まで枠を占有するため）"""
+    if video_info.get('is_live') or video_info.get('live_status') == 'is_live':
+        return f"「{video_info.get('title', '動画')}」は現在ライブ配信中です。配信終了後に再度お試しください。"
+    if video_info.get('live_status') == 'is_upcoming':
+        return f"「{video_info.get('title', '動画')}」は配信予定です。配信終了後に再度お試しください。"
+    return None
+
+
+async def probe_live_error(url: str, cookie_id: Optional[str] = None) -> Optional[str]:
+    """情報取得専用のスレッドプールでライブ配信チェックを行い、ダウンロードできない理由を返す
+
+    レート制限で一時停止中は確認せず、確認に失敗した場合はダウンロードを試みる（/api/download と同じ）。
+    """
+    if concurrency.backoff_remaining() > 0:
+        return None
+    loop = asyncio.get_running_loop()
     try:
-        loop = asyncio.get_event_loop()
-        video_info = await loop.run_in_executor(
-            download_executor,
-            lambda: check_if_live(request.url, request.cookie_id)
-        )
-        
-        # ライブ配信中の場合はエラー
-        if video_info.get('is_live') or video_info.get('live_status') == 'is_live':
-            with downloads_lock:
-                active_downloads -= 1
-            raise HTTPException(
-                status_code=400,
-                detail=f"「{video_info.get('title', '動画')}」は現在ライブ配信中です。配信終了後に再度お試しください。"
-            )
-        
-        # 配信予定の場合もエラー
-        if video_info.get('live_status') == 'is_upcoming':
-            with downloads_lock:
-                active_downloads -= 1
-            raise HTTPException(
-                status_code=400,
-                detail=f"「{video_info.get('title', '動画')}」は配信予定です。配信終了後に再度お試しください。"
-            )
-            
-    except HTTPException:
-        raise
+        video_info = await loop.run_in_executor(probe_executor, check_if_live, url, cookie_id)
     except Exception:
-        # チェック失敗時はダウンロードを試みる（エラーはダウンロード時に処理）
-        pass
-    
-    # タスクIDを生成
-    task_id = str(uuid.uuid4())
-    
-    # タスク状態を初期化
-    download_tasks[task_id] = {
+        return None
+    return live_error(video_info)
+
+
+def probe_cache_key(url: str, cookie_id: Optional[str] = None) -> tuple:
+    """動画情報キャッシュのキー（Cookieごとに取得結果が異なるため区別する）"""
+    url = clean_youtube_url(url)
+    return (extract_video_id(url) or url, cookie_id)
+
+
+def new_task_record(**fields) -> dict:
+    """タスク状態の初期値を作成"""
+    task = {
         'status': 'pending',
         'progress': 0,
         'filename': None,
@@ -616,24 +1024,103 @@ async def start_download(request: DownloadRequest, background_tasks: BackgroundT
         'elapsed': None,
         'created_at': time.time(),  # タスク作成時刻（クリーンアップ用）
     }
+    task.update(fields)
+    return task
+
+
+def delete_cookie_file(cookie_path: Optional[Path]):
+    """Cookieファイルを削除（セキュリティのため）"""
+    if cookie_path and cookie_path.exists():
+        try:
+            cookie_path.unlink()
+            print(f"[Security] Deleted cookie file: {cookie_path.name}")
+        except Exception as e:
+            print(f"[Security] Failed to delete cookie file: {e}")
+
+
+def create_cached_task(cached: dict, cookie_id: Optional[str] = None) -> DownloadStatus:
+    """キャッシュヒット時に完了済みタスクを作成"""
+    # 保持期限を延長
+    artifact_cache.touch(cached['filename'])
     
-    # バックグラウンドでダウンロードを実行
-    background_tasks.add_task(download_video, task_id, request.url, request.format, request.cookie_id)
+    task_id = str(uuid.uuid4())
+    task_store.create(task_id, new_task_record(
+        status='completed',
+        progress=100,
+        filename=cached['filename'],
+        title=cached.get('title'),
+        cached=True,
+    ))
+    print(f"[Cache] Hit: {cached['filename']}")
+    
+    # 使われなかったCookieファイルを削除
+    if cookie_id:
+        delete_cookie_file(COOKIE_DIR / f"{cookie_id}.txt")
     
     return DownloadStatus(
         task_id=task_id,
-        status='pending',
-        progress=0
+        status='completed',
+        progress=100,
+        filename=cached['filename'],
+        title=cached.get('title'),
     )
 
 
-@app.get("/api/status/{task_id}", response_model=DownloadStatus)
-async def get_status(task_id: str):
-    """ダウンロード状態を取得"""
-    if task_id not in download_tasks:
-        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+def attach_to_inflight(flight_key: tuple, cookie_id: Optional[str] = None) -> Optional[DownloadStatus]:
+    """実行中の同一ダウンロードがあれば、その進捗を共有するタスクを作成"""
+    with inflight_lock:
+        leader_id = inflight_downloads.get(flight_key)
+        leader = task_store.get(leader_id) if leader_id else None
+        if leader is None:
+            return None
+        
+        task_id = str(uuid.uuid4())
+        task_store.create(task_id, new_task_record(format=flight_key[1], leader_task_id=leader_id))
+        task_store.update(leader_id, followers=leader.get('followers', []) + [task_id])
+    
+    print(f"[Dedup] Attached {task_id} to in-flight download {leader_id}")
+    
+    # 代表タスク側のCookieで取得するため、このリクエストのCookieは不要
+    if cookie_id:
+        delete_cookie_file(COOKIE_DIR / f"{cookie_id}.txt")
     
-    task = download_tasks[task_id]
+    return build_status(task_id)
+
+
+def release_inflight(task_id: str):
+    """実行中ダウンロードの登録を解除し、結果を相乗りタスクへ反映（再開用の記録も削除）"""
+    if not shutting_down:
+        journal.remove(task_id)
+    with inflight_lock:
+        flight_key = inflight_keys.pop(task_id, None)
+        if flight_key and inflight_downloads.get(flight_key) == task_id:
+            del inflight_downloads[flight_key]
+        task = task_store.get(task_id)
+    
+    if task is None:
+        return
+    
+    result = {field: task.get(field) for field in SHARED_RESULT_FIELDS}
+    for follower_id in task.get('followers', []):
+        task_store.update(follower_id, leader_task_id=None, **result)
+        task_events.notify(follower_id)
+
+
+def resolve_task(task_id: str) -> dict:
+    """タスク状態を取得（相乗り中のタスクは代表タスクの状態を返す）"""
+    task = task_store.get(task_id)
+    leader_id = task.get('leader_task_id')
+    if leader_id:
+        leader = task_store.get(leader_id)
+        if leader is not None:
+            return leader
+    return task
+
+
+def build_status(task_id: str) -> DownloadStatus:
+    """タスク状態からレスポンスモデルを作成（クライアントが確認した時刻も記録）"""
+    mark_seen(task_id)
+    task = resolve_task(task_id)
     return DownloadStatus(
         task_id=task_id,
         status=task['status'],
@@ -646,39 +1133,856 @@ async def get_status(task_id: str):
         downloaded_bytes=task.get('downloaded_bytes'),
         total_bytes=task.get('total_bytes'),
         elapsed=task.get('elapsed'),
+        queue_position=download_queue.position(task.get('leader_task_id') or task_id),
     )
 
 
+@app.post("/api/download", response_model=DownloadStatus)
+async def start_download(request: DownloadRequest, client_request: Request):
+    """ダウンロードを開始（空きがなければ待ち行列に入れる）"""
+    # URLの検証
+    if not request.url or 'youtube.com' not in request.url and 'youtu.be' not in request.url:
+        raise HTTPException(status_code=400, detail="有効なYouTube URLを入力してください")
+    
+    # フォーマットの検証
+    if request.format not in ['m4a', 'mp4']:
+        raise HTTPException(status_code=400, detail="フォーマットはm4aまたはmp4を指定してください")
+    
+    # キャッシュ済みファイルがあればyt-dlpを実行せずに完了タスクを返す
+    video_id = extract_video_id(request.url)
+    cached = artifact_cache.lookup(video_id, request.format) if video_id else None
+    if cached:
+        cache_lookups_total.inc(result='hit')
+        return create_cached_task(cached, request.cookie_id)
+    
+    # 同じ動画・フォーマットのダウンロードが実行中ならその結果を共有する
+    flight_key = (video_id, request.format) if video_id else None
+    if flight_key:
+        follower_status = attach_to_inflight(flight_key, request.cookie_id)
+        if follower_status:
+            cache_lookups_total.inc(result='inflight')
+            return follower_status
+    cache_lookups_total.inc(result='miss')
+    
+    # タスクIDを生成
+    task_id = str(uuid.uuid4())
+    
+    # タスク状態を初期化し、ライブ配信チェック中の同一リクエストも相乗りできるよう登録
+    task_store.create(task_id, new_task_record(format=request.format))
+    if flight_key:
+        with inflight_lock:
+            inflight_downloads.setdefault(flight_key, task_id)
+            inflight_keys[task_id] = flight_key
+    
+    # ライブ配信チェック（ダウンロード枠を使わないよう情報取得専用のスレッドプールで実行）
+    # レート制限で一時停止中は上流へのアクセスを増やさないよう省略し、ダウンロード時の抽出に任せる
+    try:
+        video_info = {}
+        if concurrency.backoff_remaining() == 0:
+            loop = asyncio.get_event_loop()
+            video_info = await loop.run_in_executor(
+                probe_executor,
+                lambda: check_if_live(request.url, request.cookie_id)
+            )
+        
+        # ライブ配信中・配信予定の場合はエラー
+        detail = live_error(video_info)
+        if detail:
+            raise HTTPException(status_code=400, detail=detail)
+            
+    except HTTPException as e:
+        abort_new_task(task_id, e.detail)
+        raise
+    except Exception:
+        # チェック失敗時はダウンロードを試みる（エラーはダウンロード時に処理）
+        pass
+    
+    # 待ち行列に追加（ワーカーに空きがあればすぐに開始される）
+    client = get_client_key(client_request)
+    try:
+        download_queue.put_nowait(
+            task_id,
+            {'url': request.url, 'format': request.format, 'cookie_id': request.cookie_id},
+            priority=FORMAT_PRIORITY.get(request.format, 0),
+            client=client,
+        )
+    except QueueFullError:
+        detail = f"現在混み合っています（{len(download_queue)}件待機中）。しばらくしてからお試しください。"
+        abort_new_task(task_id, detail)
+        raise HTTPException(status_code=503, detail=detail)
+    except ClientQueueLimitError:
+        detail = f"待機中のダウンロードが多すぎます（上限{MAX_QUEUED_PER_CLIENT}件）。完了してから追加してください。"
+        abort_new_task(task_id, detail)
+        raise HTTPException(status_code=429, detail=detail)
+    journal.record(task_id, url=request.url, format=request.format, cookie_id=request.cookie_id, client=client)
+    
+    return build_status(task_id)
+
+
+def abort_new_task(task_id: str, detail: str):
+    """開始前に拒否したタスクを破棄（相乗りしていたタスクには同じエラーを反映）"""
+    task_store.update(task_id, status='error', error=detail)
+    release_inflight(task_id)
+    task_store.delete(task_id)
+
+
+@app.get("/api/status/{task_id}", response_model=DownloadStatus)
+async def get_status(task_id: str):
+    """ダウンロード状態を取得"""
+    if task_id not in task_store:
+        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+    
+    return build_status(task_id)
+
+
+@app.delete("/api/task/{task_id}", response_model=DownloadStatus)
+async def delete_task(task_id: str):
+    """ダウンロードをキャンセル（実行中のyt-dlp・ffmpegを中断し、書き込み途中のファイルを削除）
+
+    実行中の場合は中断を要求して現在の状態を返す（中断されると 'error' になる）。
+    同じ動画を他のリクエストも待っている代表タスクは中断しない。
+    """
+    task = task_store.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+    if is_task_finished(task_id):
+        return build_status(task_id)
+    
+    if task.get('leader_task_id'):
+        # 相乗り中のタスクは切り離すだけ（代表タスクのダウンロードは続ける）
+        detach_follower(task_id, 'user')
+    elif any(follower_id in task_store for follower_id in task.get('followers', [])):
+        raise HTTPException(status_code=409, detail="同じ動画を他のリクエストもダウンロード中のため、キャンセルできません")
+    else:
+        cancel_task(task_id, 'user')
+    return build_status(task_id)
+
+
+def mark_seen(task_id: str):
+    """クライアントがタスクを確認した時刻を記録（自動キャンセルの判定に使う）"""
+    if not IDLE_CANCEL_SECONDS:
+        return
+    task = task_store.get(task_id)
+    now = time.time()
+    if task and task.get('status') not in FINAL_STATUSES and now - task.get('last_seen', 0) >= SEEN_UPDATE_INTERVAL:
+        task_store.update(task_id, batch=True, last_seen=now)
+
+
+def mark_cancelled(task_id: str, reason: str):
+    """タスクをキャンセル済みにする"""
+    task_store.update(task_id, status='error', error=CANCELLED_MESSAGE, cancelled=reason)
+    cancellations_total.inc(reason=reason)
+    print(f"[Cancel] Cancelled {task_id} ({reason})")
+
+
+def remove_job_files(filenames) -> list:
+    """キャンセルしたジョブの書き込み途中のファイル・後処理前のファイルを削除"""
+    removed = []
+    for filename in filenames:
+        paths = [DOWNLOAD_DIR / filename, DOWNLOAD_DIR / f"{filename}.ytdl"]
+        # フラグメントごとの一時ファイル（.part-Frag1 など）
+        paths += DOWNLOAD_DIR.glob(f"{glob.escape(filename)}-Frag*")
+        for path in paths:
+            try:
+                path.unlink()
+                removed.append(path.name)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[Cancel] Failed to remove {path.name}: {e}")
+    return removed
+
+
+def abort_local(task_id: str, reason: str) -> bool:
+    """このプロセスで待機中・実行中のタスクを中断（該当しなければFalse）
+
+    待機中なら待ち行列から取り除いてすぐに終了させる。実行中ならyt-dlpの進捗フック、
+    またはffmpegの停止で中断させ、終了の反映はdownload_video・postprocess_downloadが行う。
+    """
+    job = download_queue.remove(task_id)
+    if job is not None:
+        mark_cancelled(task_id, reason)
+        release_inflight(task_id)
+        if job.get('cookie_id') and not job.get('keep_cookie'):
+            delete_cookie_file(COOKIE_DIR / f"{job['cookie_id']}.txt")
+        # キャンセルしたタスクと、待ち順が変わった待機中のタスクへ通知
+        for notify_id in [task_id, *download_queue.task_ids()]:
+            task_events.notify(notify_id)
+        return True
+    
+    postprocess = postprocess_tasks.get(task_id)
+    if postprocess is not None:
+        cancel_reasons[task_id] = reason
+        postprocess.cancel()
+        return True
+    if download_backend.cancel(task_id):
+        cancel_reasons[task_id] = reason
+        return True
+    return False
+
+
+def cancel_task(task_id: str, reason: str):
+    """代表タスク（相乗りしていないタスク）をキャンセル"""
+    if abort_local(task_id, reason):
+        return
+    task = task_store.get(task_id)
+    if task is None or task['status'] in FINAL_STATUSES:
+        return
+    if task['status'] == 'pending':
+        # 待ち行列に入る前（ライブ配信チェック中・一括ダウンロードの投入待ち）か、他のプロセスの待ち行列
+        # 待ち行列から取り出されても開始されない
+        mark_cancelled(task_id, reason)
+        release_inflight(task_id)
+        task_events.notify(task_id)
+    else:
+        # 他のワーカープロセスで実行中（共有ストア）: そのプロセスのwatch_cancellationsが中断する
+        task_store.update(task_id, cancel_requested=reason)
+
+
+def detach_follower(task_id: str, reason: str):
+    """相乗り中のタスクを代表タスクから切り離してキャンセル済みにする"""
+    with inflight_lock:
+        task = task_store.get(task_id)
+        leader_id = task.get('leader_task_id') if task else None
+        leader = task_store.get(leader_id) if leader_id else None
+        if leader is not None:
+            task_store.update(leader_id, followers=[f for f in leader.get('followers', []) if f != task_id])
+        task_store.update(task_id, leader_task_id=None)
+    mark_cancelled(task_id, reason)
+    task_events.notify(task_id)
+
+
+def last_seen_at(task: dict) -> float:
+    """代表タスクと相乗りしているタスクのうち、最後にクライアントが確認した時刻"""
+    seen = task.get('last_seen') or task.get('created_at', 0)
+    for follower_id in task.get('followers', []):
+        follower = task_store.get(follower_id)
+        if follower:
+            seen = max(seen, follower.get('last_seen') or follower.get('created_at', 0))
+    return seen
+
+
+async def watch_cancellations():
+    """放置されたタスクの自動キャンセルと、他のプロセスで受け付けたキャンセルの反映"""
+    while True:
+        try:
+            await asyncio.sleep(CANCEL_CHECK_INTERVAL)
+            now = time.time()
+            for task_id, task in task_store.active():
+                if task.get('leader_task_id'):
+                    continue
+                if task.get('cancel_requested'):
+                    abort_local(task_id, task['cancel_requested'])
+                elif (IDLE_CANCEL_SECONDS and task_id not in cancel_reasons
+                        and now - last_seen_at(task) > IDLE_CANCEL_SECONDS):
+                    print(f"[Cancel] {task_id} has not been checked for {IDLE_CANCEL_SECONDS}s")
+                    cancel_task(task_id, 'idle')
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"[Cancel] Error: {e}")
+
+
+def expand_playlist(url: str, cookie_id: Optional[str] = None) -> dict:
+    """プレイリストを1回のフラット抽出で動画URLの一覧に展開"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        # 各動画のページは取得せず、プレイリストの一覧だけを取得
+        'extract_flat': 'in_playlist',
+        'playlistend': MAX_BATCH_ITEMS,
+        'extractor_retries': 3,
+        'remote_components': ['ejs:github'],
+        'cachedir': str(YTDLP_CACHE_DIR),
+    }
+    if cookie_id and (COOKIE_DIR / f"{cookie_id}.txt").exists():
+        ydl_opts['cookiefile'] = str(COOKIE_DIR / f"{cookie_id}.txt")
+    
+    with session_pool.session(ydl_opts) as ydl, probe_seconds.time(kind='playlist'):
+        info = ydl.extract_info(url, download=False)
+    
+    urls = []
+    for entry in info.get('entries') or []:
+        if not entry:
+            # 取得できなかった項目はNoneになる
+            continue
+        video_id = entry.get('id')
+        # 配信中・配信予定の動画はダウンロードできないため除外
+        if entry.get('live_status') in ('is_live', 'is_upcoming'):
+            continue
+        if video_id and VIDEO_ID_PATTERN.match(video_id):
+            urls.append(f"https://www.youtube.com/watch?v={video_id}")
+    return {'title': info.get('title'), 'urls': urls}
+
+
+def prepare_batch_item(url: str, format: str) -> tuple:
+    """一括ダウンロードの1件分のタスクを作成し (タスクID, 投入するジョブ) を返す
+
+    キャッシュ済み・実行中のものは既存の結果を使うため、ジョブはNone。
+    """
+    video_id = extract_video_id(url)
+    cached = artifact_cache.lookup(video_id, format) if video_id else None
+    if cached:
+        cache_lookups_total.inc(result='hit')
+        return create_cached_task(cached).task_id, None
+    
+    flight_key = (video_id, format) if video_id else None
+    if flight_key:
+        follower_status = attach_to_inflight(flight_key)
+        if follower_status:
+            cache_lookups_total.inc(result='inflight')
+            return follower_status.task_id, None
+    cache_lookups_total.inc(result='miss')
+    
+    task_id = str(uuid.uuid4())
+    task_store.create(task_id, new_task_record(format=format))
+    if flight_key:
+        with inflight_lock:
+            inflight_downloads.setdefault(flight_key, task_id)
+            inflight_keys[task_id] = flight_key
+    return task_id, {'url': url, 'format': format}
+
+
+async def feed_batch(task_ids: list, jobs: list, format: str, client: str, cookie_id: Optional[str]):
+    """一括ダウンロードのジョブを待ち行列の空きに合わせて少しずつ投入
+
+    一度に全件を入れると待ち行列が埋まり他のリクエストが503になるため、
+    この一括ダウンロードの待機中ジョブを BATCH_QUEUE_WINDOW 件までに抑える。
+    """
+    pending = list(jobs)
+    queued: list = []
+    try:
+        while pending:
+            queued = [task_id for task_id in queued if download_queue.position(task_id) is not None]
+            if len(queued) >= BATCH_QUEUE_WINDOW:
+                await asyncio.sleep(BATCH_FEED_INTERVAL)
+                continue
+            
+            task_id, job = pending[0]
+            if task_id not in task_store or is_task_finished(task_id):
+                # 待機中に期限切れで削除された・キャンセルされた
+                pending.pop(0)
+                release_inflight(task_id)
+                continue
+            if job.get('check_live'):
+                # 直接指定されたURL（プレイリストの動画は展開時に除外済み）は投入の直前に確認する
+                job = {k: v for k, v in job.items() if k != 'check_live'}
+                pending[0] = (task_id, job)
+                detail = await probe_live_error(job['url'], cookie_id)
+                if detail:
+                    pending.pop(0)
+                    print(f"[Batch] Skipped live/upcoming video: {job['url']}")
+                    task_store.update(task_id, status='error', error=detail)
+                    release_inflight(task_id)
+                    task_events.notify(task_id)
+                    continue
+            try:
+                download_queue.put_nowait(
+                    task_id,
+                    {**job, 'cookie_id': cookie_id, 'keep_cookie': True},
+                    priority=FORMAT_PRIORITY.get(format, 0),
+                    client=client,
+                )
+            except (QueueFullError, ClientQueueLimitError):
+                await asyncio.sleep(BATCH_FEED_INTERVAL)
+                continue
+            journal.record(task_id, **job, cookie_id=cookie_id, client=client)
+            pending.pop(0)
+            queued.append(task_id)
+            task_events.notify(task_id)
+        
+        # 全件終わるまでCookieを残す
+        if cookie_id:
+            while not all(is_task_finished(task_id) for task_id in task_ids):
+                await asyncio.sleep(BATCH_FEED_INTERVAL)
+    finally:
+        for task_id, _ in pending:
+            abort_new_task(task_id, "一括ダウンロードが中断されました。")
+        # 終了処理で中断された場合は再開時に使うため残す
+        if cookie_id and not shutting_down:
+            delete_cookie_file(COOKIE_DIR / f"{cookie_id}.txt")
+
+
+def resume_journaled_jobs(entries: list) -> int:
+    """引き取ったジョブ（journal.claim()）を同じタスクIDで待ち行列へ戻し、件数を返す
+
+    前回の終了時（異常終了を含む）に終わっていなかったジョブを、yt-dlpが書き込み途中のファイルから
+    続けて保存する。一括ダウンロードと同じく (クライアント, フォーマット, Cookie) ごとに
+    feed_batch で少しずつ投入する。
+    """
+    groups: dict = {}
+    now = time.time()
+    for task_id, entry in entries:
+        if now - entry.get('created_at', 0) > RESUME_MAX_AGE or entry.get('attempts', 0) >= MAX_RESUME_ATTEMPTS:
+            print(f"[Resume] Giving up {task_id} after {entry.get('attempts', 0)} attempt(s): {entry.get('url')}")
+            journal.remove(task_id)
+            task_store.update(task_id, status='error', error="サーバーの再起動後にダウンロードを再開できませんでした。")
+            continue
+
+        format = entry['format']
+        video_id = extract_video_id(entry['url'])
+        cached = artifact_cache.lookup(video_id, format) if video_id else None
+        if cached:
+            # 後処理まで終わってから記録を削除する前に停止した
+            journal.remove(task_id)
+            task_store.create(task_id, new_task_record(
+                status='completed',
+                progress=100,
+                filename=cached['filename'],
+                title=cached.get('title'),
+                format=format,
+            ))
+            continue
+
+        # 共有ストアなら前回の状態（相乗りしていたタスク）が残っている
+        previous = task_store.get(task_id) or {}
+        task_store.create(task_id, new_task_record(
+            format=format, resumed=True, followers=previous.get('followers', []),
+        ))
+        flight_key = (video_id, format) if video_id else None
+        if flight_key:
+            with inflight_lock:
+                inflight_downloads.setdefault(flight_key, task_id)
+                inflight_keys[task_id] = flight_key
+        journal.update(task_id, attempts=entry.get('attempts', 0) + 1)
+
+        position = entry.get('position') or {}
+        if position.get('fragment_index'):
+            print(f"[Resume] {task_id}: {position.get('filename')} "
+                  f"from fragment {position['fragment_index']}/{position.get('fragment_count')}")
+        elif position.get('downloaded_bytes'):
+            print(f"[Resume] {task_id}: {position.get('filename')} from {position['downloaded_bytes']} bytes")
+        job = {'url': entry['url'], 'format': format, 'format_ids': entry.get('format_ids')}
+        key = (entry.get('client', ''), format, entry.get('cookie_id'))
+        groups.setdefault(key, []).append((task_id, job))
+
+    for (client, format, cookie_id), jobs in groups.items():
+        feeder = asyncio.create_task(feed_batch([task_id for task_id, _ in jobs], jobs, format, client, cookie_id))
+        batch_feeders.add(feeder)
+        feeder.add_done_callback(batch_feeders.discard)
+    return sum(len(jobs) for jobs in groups.values())
+
+
+async def watch_journal():
+    """生存を記録し、異常終了した他のワーカープロセスのダウンロードを引き取って再開"""
+    while True:
+        try:
+            await asyncio.sleep(JOURNAL_HEARTBEAT_INTERVAL)
+            loop = asyncio.get_running_loop()
+            entries = await loop.run_in_executor(None, journal.claim)
+            resumed = resume_journaled_jobs(entries)
+            if resumed:
+                print(f"[Resume] Took over {resumed} download(s) from a stopped worker")
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"[Resume] Error: {e}")
+
+
+def is_task_finished(task_id: str) -> bool:
+    """タスクが終了状態か（削除済みも終了とみなす）"""
+    task = task_store.get(task_id)
+    return task is None or resolve_task(task_id).get('status') in FINAL_STATUSES
+
+
+def build_batch_status(batch_id: str, batch: dict) -> BatchStatus:
+    """一括ダウンロードの各タスクの状態を集計"""
+    statuses = [build_status(task_id) for task_id in batch['task_ids'] if task_id in task_store]
+    counts = {status: 0 for status in ('completed', 'error', 'downloading', 'processing', 'pending')}
+    for status in statuses:
+        counts[status.status] = counts.get(status.status, 0) + 1
+    total = len(batch['task_ids'])
+    return BatchStatus(
+        batch_id=batch_id,
+        title=batch.get('title'),
+        total=total,
+        completed=counts['completed'],
+        failed=counts['error'] + total - len(statuses),
+        running=counts['downloading'] + counts['processing'],
+        pending=counts['pending'],
+        progress=sum(100 if s.status in FINAL_STATUSES else s.progress for s in statuses) / total if total else 100,
+        tasks=statuses,
+    )
+
+
+@app.post("/api/batch", response_model=BatchStatus)
+async def start_batch(request: BatchRequest, client_request: Request):
+    """複数の動画・プレイリストをまとめてダウンロード"""
+    if request.format not in ['m4a', 'mp4']:
+        raise HTTPException(status_code=400, detail="フォーマットはm4aまたはmp4を指定してください")
+    
+    urls = [url.strip() for url in request.urls if url.strip()]
+    direct_urls = set(urls)
+    invalid = [url for url in urls if not extract_video_id(url)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"有効なYouTube URLではありません: {', '.join(invalid[:5])}")
+    
+    title = None
+    if request.playlist_url:
+        if 'list=' not in request.playlist_url:
+            raise HTTPException(status_code=400, detail="有効なYouTubeプレイリストのURLを入力してください")
+        try:
+            loop = asyncio.get_running_loop()
+            playlist = await loop.run_in_executor(
+                probe_executor, expand_playlist, request.playlist_url, request.cookie_id
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=format_error_message(str(e)))
+        title = playlist['title']
+        urls += playlist['urls']
+    
+    # 同じ動画の重複を除く
+    unique = {}
+    for url in urls:
+        unique.setdefault(extract_video_id(url), url)
+    urls = list(unique.values())
+    if not urls:
+        raise HTTPException(status_code=400, detail="ダウンロードする動画がありません")
+    if len(urls) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"一度にダウンロードできるのは{MAX_BATCH_ITEMS}件までです")
+    
+    task_ids = []
+    jobs = []
+    for url in urls:
+        task_id, job = prepare_batch_item(url, request.format)
+        task_ids.append(task_id)
+        if job is not None:
+            if url in direct_urls:
+                # 配信中・配信予定ならダウンロードせずエラーにする（feed_batchで確認）
+                job['check_live'] = True
+            jobs.append((task_id, job))
+    
+    batch_id = str(uuid.uuid4())
+    batch = {'task_ids': task_ids, 'title': title, 'format': request.format, 'created_at': time.time()}
+    batches.set(batch_id, batch)
+    print(f"[Batch] {batch_id}: {len(task_ids)} item(s), {len(jobs)} to download")
+    
+    if jobs or request.cookie_id:
+        feeder = asyncio.create_task(feed_batch(
+            task_ids, jobs, request.format, get_client_key(client_request), request.cookie_id
+        ))
+        batch_feeders.add(feeder)
+        feeder.add_done_callback(batch_feeders.discard)
+    
+    return build_batch_status(batch_id, batch)
+
+
+@app.get("/api/batch/{batch_id}", response_model=BatchStatus)
+async def get_batch_status(batch_id: str):
+    """一括ダウンロードの全体の進捗を取得"""
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="一括ダウンロードが見つかりません")
+    return build_batch_status(batch_id, batch)
+
+
+@app.get("/api/batch/{batch_id}/zip")
+async def download_batch_zip(batch_id: str):
+    """一括ダウンロードの完了したファイルをzipにまとめて配信（生成しながら送信）"""
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="一括ダウンロードが見つかりません")
+    if not all(is_task_finished(task_id) for task_id in batch['task_ids']):
+        raise HTTPException(status_code=409, detail="まだ終わっていないダウンロードがあります")
+    
+    filenames = []
+    for task_id in batch['task_ids']:
+        task = task_store.get(task_id)
+        filename = task and resolve_task(task_id).get('filename')
+        if filename and (DOWNLOAD_DIR / filename).is_file() and filename not in filenames:
+            filenames.append(filename)
+    if not filenames:
+        raise HTTPException(status_code=404, detail="ダウンロードできたファイルがありません")
+    
+    for filename in filenames:
+        artifact_cache.record_access(filename)
+        artifact_cache.pin(filename)
+    
+    def stream():
+        started_at = time.monotonic()
+        try:
+            yield from iter_zip([(DOWNLOAD_DIR / filename, filename) for filename in filenames])
+        finally:
+            for filename in filenames:
+                artifact_cache.unpin(filename)
+            serve_seconds.observe(time.monotonic() - started_at, mode='zip')
+    
+    archive_name = f"{batch.get('title') or 'rushia-dl'}-{batch['format']}.zip"
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(archive_name)}"},
+    )
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Server-Sent Events形式のメッセージを作成"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def task_event_stream(request: Request, task_ids: list):
+    """タスクの進捗をSSEで配信（終了状態になるまで）"""
+    # 相乗り中のタスクは代表タスクの更新でも起こす
+    watch_ids = set(task_ids)
+    for task_id in task_ids:
+        leader_id = (task_store.get(task_id) or {}).get('leader_task_id')
+        if leader_id:
+            watch_ids.add(leader_id)
+    watch_ids = list(watch_ids)
+    
+    event = task_events.subscribe(watch_ids)
+    pending = list(task_ids)
+    last_sent: dict = {}
+    # 共有ストアでは他のワーカーが更新するため通知を待たずに定期的に確認する
+    wait_timeout = PROGRESS_STREAM_INTERVAL if task_store.shared else PROGRESS_STREAM_KEEPALIVE
+    last_yield = time.monotonic()
+    try:
+        while pending:
+            # スナップショット作成前にクリアして、作成中の更新を取りこぼさない
+            event.clear()
+            
+            for task_id in list(pending):
+                if task_id not in task_store:
+                    yield format_sse('missing', {'task_id': task_id})
+                    pending.remove(task_id)
+                    continue
+                
+                payload = jsonable_encoder(build_status(task_id))
+                if last_sent.get(task_id) != payload:
+                    yield format_sse('status', payload)
+                    last_sent[task_id] = payload
+                    last_yield = time.monotonic()
+                if payload['status'] in FINAL_STATUSES:
+                    pending.remove(task_id)
+            
+            if not pending:
+                break
+            
+            # 次の更新を待つ（更新がなければキープアライブを送信）
+            try:
+                await asyncio.wait_for(event.wait(), timeout=wait_timeout)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_yield >= PROGRESS_STREAM_KEEPALIVE:
+                    yield ": keepalive\n\n"
+                    last_yield = time.monotonic()
+            
+            if await request.is_disconnected():
+                return
+            
+            # 短時間の連続した更新を1回にまとめる
+            await asyncio.sleep(PROGRESS_STREAM_INTERVAL)
+        
+        yield format_sse('end', {'task_ids': task_ids})
+    finally:
+        task_events.unsubscribe(watch_ids, event)
+
+
+def event_stream_response(request: Request, task_ids: list) -> StreamingResponse:
+    """SSEレスポンスを作成"""
+    return StreamingResponse(
+        task_event_stream(request, task_ids),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginxのバッファリングを無効化
+        },
+    )
+
+
+@app.get("/api/events/{task_id}")
+async def stream_status(task_id: str, request: Request):
+    """1つのタスクの進捗をSSEで配信"""
+    if task_id not in task_store:
+        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+    
+    return event_stream_response(request, [task_id])
+
+
+@app.get("/api/events")
+async def stream_statuses(request: Request, task_ids: str):
+    """複数タスクの進捗をまとめてSSEで配信（task_idsはカンマ区切り）"""
+    ids = list(dict.fromkeys(t.strip() for t in task_ids.split(',') if t.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="task_idsを指定してください")
+    if len(ids) > PROGRESS_STREAM_MAX_TASKS:
+        raise HTTPException(status_code=400, detail=f"一度に購読できるタスクは{PROGRESS_STREAM_MAX_TASKS}件までです")
+    
+    return event_stream_response(request, ids)
+
+
 @app.get("/api/download/{filename}")
-async def download_file(filename: str):
-    """ダウンロードしたファイルを取得（60分後に自動削除）"""
+async def download_file(filename: str, request: Request):
+    """ダウンロードしたファイルを取得（Range/If-Range対応、最後の利用から保持時間後に自動削除）"""
     file_path = DOWNLOAD_DIR / filename
     
-    if not file_path.exists():
+    if not file_path.is_file():
         raise HTTPException(status_code=404, detail="ファイルが見つかりません")
     
     # ファイルタイプに応じたMIMEタイプを設定
     media_type = "audio/mp4" if filename.endswith('.m4a') else "video/mp4"
     
+    # 利用を記録して保持期限を延長（シークや再開による途中からの要求は回数に含めない）
+    if is_initial_range(request.headers.get('range')):
+        artifact_cache.record_access(filename)
+    else:
+        artifact_cache.touch(filename)
+    
+    if ACCEL_REDIRECT_PREFIX:
+        # nginxがsendfileで直接配信（Range/If-Rangeもnginxが処理）
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(filename),
+                "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+            },
+        )
+    
+    # 送信が終わるまで削除対象から外す
+    artifact_cache.pin(filename)
     return FileResponse(
         path=str(file_path),
         filename=filename,
-        media_type=media_type
+        media_type=media_type,
+        background=BackgroundTask(finish_serving, filename, time.monotonic()),
+    )
+
+
+def finish_serving(filename: str, started_at: float):
+    """ファイルの送信完了時の処理"""
+    artifact_cache.unpin(filename)
+    serve_seconds.observe(time.monotonic() - started_at, mode='direct')
+
+
+def is_initial_range(range_header: Optional[str]) -> bool:
+    """ファイル全体、または先頭からの要求か"""
+    if not range_header:
+        return True
+    return range_header.replace(' ', '').startswith('bytes=0-')
+
+
+@app.get("/api/stream/{task_id}")
+async def stream_download(task_id: str, request: Request):
+    """ダウンロード中のm4aを書き込まれた分から順に配信（完了済みなら通常のファイル配信）
+
+    変換を行わないm4aは書き込み中のファイルがそのまま完成品になるため、
+    ダウンロードの完了を待たずに先頭から送り始める。
+    """
+    if task_id not in task_store:
+        raise HTTPException(status_code=404, detail="タスクが見つかりません")
+    
+    started_at = time.monotonic()
+    task, handle = await wait_for_stream_source(task_id, request)
+    if handle is None:
+        if task is None:
+            raise HTTPException(status_code=404, detail="タスクが見つかりません")
+        if task['status'] == 'completed' and task.get('filename'):
+            return await download_file(task['filename'], request)
+        if task['status'] == 'error':
+            raise HTTPException(status_code=409, detail=task.get('error') or "ダウンロードに失敗しました")
+        raise HTTPException(status_code=400, detail="ダウンロード中の配信はm4aのみ対応しています")
+    
+    filename = task['partial_file'].removesuffix('.part')
+    return StreamingResponse(
+        follow_partial_file(task_id, handle, request, started_at),
+        media_type="audio/mp4",
+        headers={
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginxのバッファリングを無効化
+        },
     )
 
 
+async def wait_for_stream_source(task_id: str, request: Request) -> tuple:
+    """書き込み中のファイルを開けるか、タスクが終了するまで待つ
+
+    (タスク, 開いたファイル) を返す。完了・失敗・m4a以外・切断時はファイルがNone。
+    """
+    watch_ids = [task_id]
+    leader_id = (task_store.get(task_id) or {}).get('leader_task_id')
+    if leader_id:
+        watch_ids.append(leader_id)
+    event = task_events.subscribe(watch_ids)
+    # 共有ストアでは他のワーカーが更新するため通知を待たずに定期的に確認する
+    wait_timeout = PROGRESS_STREAM_INTERVAL if task_store.shared else PROGRESS_STREAM_KEEPALIVE
+    try:
+        while True:
+            event.clear()
+            if task_id not in task_store:
+                return None, None
+            mark_seen(task_id)
+            task = resolve_task(task_id)
+            if task['status'] in FINAL_STATUSES:
+                return task, None
+            if task.get('format') != 'm4a':
+                return task, None
+            partial = task.get('partial_file')
+            if task['status'] == 'downloading' and partial:
+                try:
+                    return task, open(DOWNLOAD_DIR / partial, 'rb')
+                except OSError:
+                    # 書き込みが終わって名前が変わった後は完了を待って通常の配信にする
+                    pass
+            try:
+                await asyncio.wait_for(event.wait(), timeout=wait_timeout)
+            except asyncio.TimeoutError:
+                pass
+            if await request.is_disconnected():
+                return task, None
+    finally:
+        task_events.unsubscribe(watch_ids, event)
+
+
+async def follow_partial_file(task_id: str, handle, request: Request, started_at: float):
+    """ファイルを末尾まで送り、ダウンロードが終わるまで追記を待って送り続ける
+
+    書き込みが終わると名前が変わるが、開いたファイルはそのまま最後まで読める。
+    """
+    loop = asyncio.get_running_loop()
+    sent = 0
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, handle.read, STREAM_CHUNK_SIZE)
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+                continue
+            
+            task = resolve_task(task_id) if task_id in task_store else None
+            if task is None or task['status'] != 'downloading':
+                # ダウンロードは書き終わっている（終了の通知は名前の変更後）ので残りを送って終了
+                while chunk := await loop.run_in_executor(None, handle.read, STREAM_CHUNK_SIZE):
+                    sent += len(chunk)
+                    yield chunk
+                break
+            if os.fstat(handle.fileno()).st_size < sent:
+                # 最初からダウンロードし直している（送信済みの部分と一致しないため中断）
+                print(f"[Stream] Partial file was truncated, aborting stream for {task_id}")
+                break
+            if await request.is_disconnected():
+                break
+            mark_seen(task_id)
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+    finally:
+        handle.close()
+        serve_seconds.observe(time.monotonic() - started_at, mode='stream')
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/api/server-status")
 async def server_status():
     """サーバーの状態を取得"""
-    # ダウンロードディレクトリのファイル数をカウント
-    file_count = sum(
-        1 for f in DOWNLOAD_DIR.iterdir()
-        if f.is_file() and f.suffix in ['.m4a', '.mp4']
-    )
-    
     # アクティブなタスク（実行中のバックグラウンドタスク）を取得
     active_tasks = []
-    for task_id, task_data in download_tasks.items():
+    for task_id, task_data in task_store.active():
+        # 他のタスクに相乗りしているものは代表タスク側で数える
+        if task_data.get('leader_task_id'):
+            continue
         status = task_data.get('status', 'unknown')
         # 実行中のタスクのみ（pending, downloading, processing）
         if status in ['pending', 'downloading', 'processing']:
@@ -693,12 +1997,24 @@ async def server_status():
     return {
         "active_downloads": active_downloads,
         "max_concurrent_downloads": MAX_CONCURRENT_DOWNLOADS,
-        "available_slots": MAX_CONCURRENT_DOWNLOADS - active_downloads,
+        "available_slots": max(0, int(concurrency.limit) - active_downloads),
+        # レート制限による調整後の同時実行数と、新規開始を止めている残り時間
+        "concurrency_limit": int(concurrency.limit),
+        "backoff_seconds": round(concurrency.backoff_remaining()),
+        "queued_downloads": len(download_queue),
+        "postprocess_active": postprocess_pool.active,
+        "postprocess_waiting": postprocess_pool.waiting,
+        "max_postprocess_workers": postprocess_pool.max_workers,
+        "max_queue_size": MAX_QUEUE_SIZE,
         "file_retention_hours": FILE_RETENTION_HOURS,
         "task_timeouts": TASK_TIMEOUT,
-        "cached_files": file_count,
+        "idle_cancel_seconds": IDLE_CANCEL_SECONDS,
+        "cached_files": artifact_cache.file_count,
+        "cached_bytes": artifact_cache.total_bytes,
+        "max_cache_bytes": MAX_CACHE_BYTES,
         "active_tasks": active_tasks,
-        "total_tasks_in_memory": len(download_tasks),
+        "total_tasks_in_memory": len(task_store),
+        "task_store": TASK_STORE,
     }
 
 
@@ -0,0 +1,55 @@
+"""
+複数ファイルのzipアーカイブを逐次生成して配信
+"""
+import zipfile
+from pathlib import Path
+from typing import Iterator
+
+# ファイルの読み込み単位
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+class _ZipStreamBuffer:
+    """zipfileの出力を受け取り、生成した分だけ取り出せるバッファ
+
+    seek() を持たないため、zipfileはデータディスクリプタ形式で書き込む
+    （全体をメモリやディスクに溜めずに先頭から送信できる）。
+    """
+
+    def __init__(self):
+        self._chunks: list = []
+        self._offset = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(files: list) -> Iterator[bytes]:
+    """[(ファイルパス, アーカイブ内の名前), ...] を無圧縮のzipとして逐次生成
+
+    音声・動画はすでに圧縮済みのためZIP_STOREDで格納する。
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(Path(path), arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dst:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    yield buffer.take()
+            yield buffer.take()
+    yield buffer.take()
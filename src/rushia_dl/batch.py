@@ -0,0 +1,242 @@
+"""
+CLIのバッチダウンロード（URLリストの並列処理）
+"""
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+from yt_dlp import YoutubeDL
+
+from .progress import ProgressTracker
+
+# 同じホストへのダウンロード開始間隔（秒）の既定値
+DEFAULT_HOST_INTERVAL = 1.0
+
+# 全体の進捗表示の更新間隔（秒）
+PROGRESS_DISPLAY_INTERVAL = 1.0
+
+# 同じサービスとして扱うホスト名の別名
+HOST_ALIASES = {
+    'youtu.be': 'youtube.com',
+}
+
+
+def host_key(url: str) -> str:
+    """URLのホスト名を正規化（www. や m. の違いは同じホストとして扱う）"""
+    host = (urlparse(url).hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    return HOST_ALIASES.get(host, host)
+
+
+def resolve_output_path(ydl: YoutubeDL, info: dict) -> Optional[str]:
+    """yt-dlpが記録した後処理後の出力パス"""
+    for download in reversed(info.get('requested_downloads') or []):
+        if download.get('filepath'):
+            return download['filepath']
+    return info.get('filepath') or ydl.prepare_filename(info)
+
+
+class HostRateLimiter:
+    """ホストごとにダウンロードの開始間隔を空ける（スレッドセーフ）"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_start: dict = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        """このURLのホストで次に開始できる時刻まで待機"""
+        if self.interval <= 0:
+            return
+        host = host_key(url)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class BatchProgress:
+    """全URLの進捗を集計して1行で表示"""
+
+    def __init__(self, total: int, stream=sys.stdout):
+        self.total = total
+        self.stream = stream
+        self._states: dict = {}
+        self._done = 0
+        self._failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_width = 0
+
+    def tracker(self, url: str) -> ProgressTracker:
+        """URLごとの進捗コールバックを作成"""
+        def apply(snapshot: dict):
+            with self._lock:
+                self._states.setdefault(url, {}).update(snapshot)
+        return ProgressTracker(apply, interval=0.5)
+
+    def finish(self, url: str, ok: bool):
+        """URLの処理完了を記録"""
+        with self._lock:
+            self._states.pop(url, None)
+            if ok:
+                self._done += 1
+            else:
+                self._failed += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._display_loop, name='batch-progress', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._render(final=True)
+
+    def log(self, message: str):
+        """進捗行を消してからメッセージを表示"""
+        with self._lock:
+            self._clear_line()
+            print(message, file=self.stream, flush=True)
+
+    def _display_loop(self):
+        while not self._stop.wait(PROGRESS_DISPLAY_INTERVAL):
+            self._render()
+
+    def _render(self, final: bool = False):
+        with self._lock:
+            active = len(self._states)
+            speed = sum(s.get('speed') or 0 for s in self._states.values())
+            line = (
+                f'[{self._done + self._failed}/{self.total}] '
+                f'完了 {self._done} / 失敗 {self._failed} / 実行中 {active} '
+                f'({format_bytes(speed)}/s)'
+            )
+            if self.stream.isatty():
+                self._clear_line()
+                end = '\n' if final else ''
+                print(line, end=end, file=self.stream, flush=True)
+                self._last_width = 0 if final else len(line)
+            elif final or active:
+                print(line, file=self.stream, flush=True)
+
+    def _clear_line(self):
+        if self._last_width:
+            print('\r' + ' ' * self._last_width + '\r', end='', file=self.stream)
+            self._last_width = 0
+
+
+class BatchDownloader:
+    """URLリストを jobs 件ずつ並列にダウンロード
+
+    YoutubeDLはワーカースレッドごとに1つ作成して使い回す。
+    進捗フックはスレッドごとに現在処理中のURLへ振り分ける。
+    """
+
+    def __init__(self, ydl_opts: dict, jobs: int = 1, host_interval: float = DEFAULT_HOST_INTERVAL):
+        self.ydl_opts = ydl_opts
+        self.jobs = max(1, jobs)
+        self.rate_limiter = HostRateLimiter(host_interval)
+        self._local = threading.local()
+        self._instances: list = []
+        self._instances_lock = threading.Lock()
+
+    def run(self, urls: list, on_result: Optional[Callable[[dict], None]] = None) -> list:
+        """全URLをダウンロードし、URLごとの結果 {url, ok, error, id, filepath} のリストを返す
+
+        on_result はダウンロードの完了ごとにワーカースレッドから呼ばれる。
+        """
+        progress = BatchProgress(len(urls))
+        progress.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='batch') as executor:
+                futures = [executor.submit(self._download, url, progress, on_result) for url in urls]
+                results = [future.result() for future in futures]
+        finally:
+            progress.stop()
+            self._close_instances()
+        return results
+
+    def _download(self, url: str, progress: BatchProgress, on_result: Optional[Callable]) -> dict:
+        self.rate_limiter.wait(url)
+        tracker = progress.tracker(url)
+        self._local.tracker = tracker
+        try:
+            ydl = self._ydl()
+            info = ydl.extract_info(url, download=True)
+            result = {
+                'url': url, 'ok': True, 'error': None,
+                'id': info.get('id'),
+                'filepath': resolve_output_path(ydl, info),
+            }
+        except Exception as e:
+            result = {'url': url, 'ok': False, 'error': str(e), 'id': None, 'filepath': None}
+            progress.log(f'エラー: {url}: {e}')
+        finally:
+            self._local.tracker = None
+        if on_result is not None and result['ok']:
+            try:
+                on_result(result)
+            except Exception as e:
+                progress.log(f'エラー: {url}: 完了の記録に失敗しました: {e}')
+        progress.finish(url, result['ok'])
+        return result
+
+    def _ydl(self) -> YoutubeDL:
+        """このスレッドのYoutubeDL（初回のみ作成）"""
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            opts = {
+                **self.ydl_opts,
+                # 個別の進捗表示は全体の進捗表示に置き換える
+                'quiet': True,
+                'noprogress': True,
+                'no_warnings': True,
+                'progress_hooks': [self._dispatch_progress],
+            }
+            ydl = YoutubeDL(opts)
+            self._local.ydl = ydl
+            with self._instances_lock:
+                self._instances.append(ydl)
+        return ydl
+
+    def _dispatch_progress(self, d: dict):
+        tracker = getattr(self._local, 'tracker', None)
+        if tracker is not None:
+            tracker.on_progress(d)
+
+    def _close_instances(self):
+        with self._instances_lock:
+            instances, self._instances = self._instances, []
+        for ydl in instances:
+            ydl.close()
+
+
+def format_bytes(value: float) -> str:
+    """バイト数を読みやすい単位で表示"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024:
+            return f'{value:.1f}{unit}'
+        value /= 1024
+    return f'{value:.1f}TiB'
+
+
+def print_summary(results: list):
+    """失敗したURLの一覧を表示"""
+    failed = [r for r in results if not r['ok']]
+    print(f'\n成功 {len(results) - len(failed)} 件 / 失敗 {len(failed)} 件')
+    if failed:
+        print('失敗したURL:')
+        for result in failed:
+            print(f'  {result["url"]}')
+            print(f'    {result["error"]}')
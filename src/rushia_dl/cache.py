@@ -0,0 +1,348 @@
+"""
+ダウンロード済みファイルのキャッシュ管理
+"""
+import heapq
+import itertools
+import os
+import re
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+# キャッシュ対象の拡張子（フォーマット名と一致）
+ARTIFACT_FORMATS = ('m4a', 'mp4')
+
+# yt-dlpの出力テンプレート '%(title)s-%(id)s.%(ext)s' から動画IDを取り出す
+ARTIFACT_NAME_PATTERN = re.compile(r'^(?P<title>.*)-(?P<id>[0-9A-Za-z_-]{11})\.(?P<ext>m4a|mp4)$')
+
+# ダウンロード途中・後処理途中に残る一時ファイル・中間ファイル
+# （フォーマットごとのファイルは動画IDの直後の '.f<フォーマットID>' で見分ける。
+#   タイトルが '.f1' などを含む完成ファイルを一時ファイルとみなさないため）
+STRAY_FILE_PATTERN = re.compile(
+    r'(\.part|\.part-Frag\d+|\.ytdl|\.temp\.[0-9A-Za-z]+|-[0-9A-Za-z_-]{11}\.f[0-9A-Za-z_-]+\.[0-9A-Za-z]+'
+    r'|\.(webm|opus|ogg|mkv|m4v|aac|mp3|3gp|flv))$'
+)
+VIDEO_ID_IN_NAME_PATTERN = re.compile(r'-(?P<id>[0-9A-Za-z_-]{11})\.')
+
+# 容量超過時の削除順の評価（1回の利用につき最終利用時刻をこれだけ新しく扱う）
+HIT_BONUS_SECONDS = 15 * 60
+MAX_COUNTED_HITS = 8
+
+# 期限切れでも利用中だったファイルを再確認するまでの時間（秒）
+PINNED_RETRY_SECONDS = 60
+
+# 同じ時刻の予定をヒープ内で比較しないための通し番号
+_expiry_seq = itertools.count()
+
+
+class ExpiryIndex:
+    """削除予定時刻の索引（ヒープ）
+
+    同じキーを再登録した場合、古い予定はヒープに残るが取り出し時に無視する。
+    """
+
+    def __init__(self):
+        self._heap: list = []
+        self._deadlines: dict = {}
+
+    def schedule(self, key, deadline: float):
+        """キーの削除予定時刻を登録（既存の予定は置き換え）"""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(_expiry_seq), key))
+
+    def discard(self, key):
+        """キーの予定を取り消す"""
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self) -> Optional[float]:
+        """最も早い削除予定時刻"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list:
+        """予定時刻を過ぎたキーを取り出す"""
+        due = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+
+    def _drop_stale(self):
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+
+class ArtifactCache:
+    """(動画ID, フォーマット) から完成済みファイルを引くための索引
+
+    ダウンロードディレクトリ内の m4a/mp4 の件数・合計サイズと削除予定時刻も
+    ここで管理し、定期的なディレクトリ走査を不要にする。max_bytes を超えた
+    場合は、最近使われておらず利用回数も少ないファイルから削除する。
+    """
+
+    def __init__(self, directory: Path, retention_seconds: float, max_bytes: Optional[int] = None):
+        self.directory = directory
+        self.retention_seconds = retention_seconds
+        self.max_bytes = max_bytes
+        self._entries: dict = {}
+        self._files: dict = {}
+        self._pins: dict = {}
+        self._expiry = ExpiryIndex()
+        self._lock = Lock()
+        self.total_bytes = 0
+
+    def scan(self) -> int:
+        """ダウンロードディレクトリを走査して索引を再構築（起動時のみ）"""
+        with self._lock:
+            self._entries = {}
+            self._files = {}
+            self._expiry = ExpiryIndex()
+            self.total_bytes = 0
+            for file_path in self.directory.iterdir():
+                if not file_path.is_file() or file_path.suffix[1:] not in ARTIFACT_FORMATS:
+                    continue
+                if STRAY_FILE_PATTERN.search(file_path.name):
+                    # 結合前のストリーム（.f137.mp4 など）は完成品として扱わない
+                    continue
+                stat = file_path.stat()
+                # 最終利用時刻はatime（touchで更新）、作成時刻はmtimeから復元
+                self._track(file_path.name, stat.st_size, max(stat.st_atime, stat.st_mtime))
+                match = ARTIFACT_NAME_PATTERN.match(file_path.name)
+                if match:
+                    self._entries[(match.group('id'), match.group('ext'))] = {
+                        'filename': file_path.name,
+                        'title': match.group('title'),
+                        'created_at': stat.st_mtime,
+                    }
+            return len(self._entries)
+
+    def lookup(self, video_id: str, format: str) -> Optional[dict]:
+        """キャッシュ済みファイルを検索（ファイルが消えていれば索引からも削除）"""
+        key = (video_id, format)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not (self.directory / entry['filename']).is_file():
+            self.discard(entry['filename'])
+            return None
+        return dict(entry)
+
+    def add(self, video_id: str, format: str, filename: str, title: Optional[str] = None) -> list:
+        """完成したファイルを索引に登録し、容量超過で削除したファイル名を返す"""
+        now = time.time()
+        try:
+            size = (self.directory / filename).stat().st_size
+        except OSError:
+            size = 0
+        with self._lock:
+            self._track(filename, size, now)
+            self._entries[(video_id, format)] = {
+                'filename': filename,
+                'title': title,
+                'created_at': now,
+            }
+        return self.enforce_budget(protect=filename)
+
+    def touch(self, filename: str):
+        """ファイルのアクセス時刻を現在時刻にして保持期限を延長
+
+        mtimeは変更しない（ETag/Last-Modifiedが変わると中断したダウンロードを再開できないため）。
+        """
+        file_path = self.directory / filename
+        try:
+            os.utime(file_path, (time.time(), file_path.stat().st_mtime))
+        except OSError as e:
+            print(f"[Cache] Failed to refresh {filename}: {e}")
+            return
+        with self._lock:
+            if filename in self._files:
+                self._files[filename]['last_access'] = time.time()
+                self._expiry.schedule(filename, time.time() + self.retention_seconds)
+
+    def record_access(self, filename: str):
+        """ファイルが利用されたことを記録（保持期限を延長し、削除対象になりにくくする）"""
+        with self._lock:
+            info = self._files.get(filename)
+            if info is not None:
+                info['hits'] += 1
+        self.touch(filename)
+
+    def pin(self, filename: str):
+        """配信中・利用中のファイルを削除対象から外す（unpinと対で呼ぶ）"""
+        with self._lock:
+            self._pins[filename] = self._pins.get(filename, 0) + 1
+
+    def unpin(self, filename: str):
+        """pinを解除"""
+        with self._lock:
+            count = self._pins.get(filename, 0) - 1
+            if count <= 0:
+                self._pins.pop(filename, None)
+            else:
+                self._pins[filename] = count
+
+    def discard(self, filename: str):
+        """ファイル名に対応するエントリを索引から削除"""
+        with self._lock:
+            self._untrack(filename)
+
+    def next_expiry(self) -> Optional[float]:
+        """最も早いファイルの削除予定時刻"""
+        with self._lock:
+            return self._expiry.next_deadline()
+
+    def delete_expired(self, now: float) -> list:
+        """保持期限を過ぎたファイルを削除し、削除したファイル名を返す"""
+        with self._lock:
+            due = self._expiry.pop_due(now)
+            pinned = [filename for filename in due if filename in self._pins]
+            for filename in pinned:
+                # 利用中のファイルは少し後に再確認
+                self._expiry.schedule(filename, now + PINNED_RETRY_SECONDS)
+            due = [filename for filename in due if filename not in self._pins]
+            for filename in due:
+                self._untrack(filename)
+        return self._unlink(due)
+
+    def enforce_budget(self, protect: Optional[str] = None) -> list:
+        """合計サイズがmax_bytesを超えていれば、評価の低いファイルから削除"""
+        if not self.max_bytes:
+            return []
+        with self._lock:
+            if self.total_bytes <= self.max_bytes:
+                return []
+            candidates = sorted(
+                (name for name in self._files if name not in self._pins and name != protect),
+                key=lambda name: self._eviction_score(self._files[name]),
+            )
+            victims = []
+            for filename in candidates:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self._untrack(filename)
+                victims.append(filename)
+        if victims:
+            print(f"[Cache] Evicted {len(victims)} file(s) to stay within {self.max_bytes} bytes")
+        return self._unlink(victims)
+
+    def sweep_strays(self, active_ids: set, grace_seconds: float) -> list:
+        """中断・失敗したダウンロードの一時ファイルや中間ファイルを削除
+
+        実行中の動画IDに属するもの、grace_seconds以内に更新されたものは残す。
+        """
+        now = time.time()
+        strays = []
+        for file_path in self.directory.iterdir():
+            if not file_path.is_file() or not STRAY_FILE_PATTERN.search(file_path.name):
+                continue
+            match = VIDEO_ID_IN_NAME_PATTERN.search(file_path.name)
+            if match and match.group('id') in active_ids:
+                continue
+            try:
+                if now - file_path.stat().st_mtime < grace_seconds:
+                    continue
+            except OSError:
+                continue
+            strays.append(file_path.name)
+        return self._unlink(strays)
+
+    @property
+    def file_count(self) -> int:
+        """管理中のファイル数"""
+        return len(self._files)
+
+    def _eviction_score(self, info: dict) -> float:
+        # 最終利用時刻に利用回数分のボーナスを加える（小さいほど先に削除）
+        return info['last_access'] + min(info['hits'], MAX_COUNTED_HITS) * HIT_BONUS_SECONDS
+
+    def _track(self, filename: str, size: int, mtime: float):
+        previous = self._files.get(filename)
+        self.total_bytes += size - (previous['size'] if previous else 0)
+        self._files[filename] = {
+            'size': size,
+            'last_access': mtime,
+            'hits': previous['hits'] if previous else 0,
+        }
+        self._expiry.schedule(filename, mtime + self.retention_seconds)
+
+    def _untrack(self, filename: str):
+        info = self._files.pop(filename, None)
+        if info is None:
+            return
+        self.total_bytes -= info['size']
+        self._expiry.discard(filename)
+        for key in [k for k, e in self._entries.items() if e['filename'] == filename]:
+            del self._entries[key]
+
+    def _unlink(self, filenames: list) -> list:
+        deleted = []
+        for filename in filenames:
+            try:
+                (self.directory / filename).unlink()
+                deleted.append(filename)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[Cleanup] Failed to delete {filename}: {e}")
+        return deleted
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class TTLCache:
+    """有効期限付きのメモリキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict = {}
+        self._lock = Lock()
+
+    def get(self, key) -> Optional[object]:
+        """有効なエントリを取得"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def pop(self, key) -> Optional[object]:
+        """有効なエントリを取り出して削除"""
+        with self._lock:
+            item = self._entries.pop(key, None)
+        if item is None or item[0] < time.time():
+            return None
+        return item[1]
+
+    def set(self, key, value):
+        """エントリを登録（上限を超えたら期限切れ・古いものから削除）"""
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            if len(self._entries) > self.max_entries:
+                for old_key in [k for k, (exp, _) in self._entries.items() if exp < now]:
+                    del self._entries[old_key]
+                while len(self._entries) > self.max_entries:
+                    oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                    del self._entries[oldest]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -5,10 +5,20 @@ import argparse
 from pathlib import Path
 from yt_dlp import YoutubeDL
 
+from .batch import DEFAULT_HOST_INTERVAL, BatchDownloader, print_summary
+from .manifest import BatchManifest
+from .player_cache import CACHE_DIR as YTDLP_CACHE_DIR, enable_preprocessed_player_cache, prune_player_cache
+
+# 出力先のテンプレート
+OUTPUT_TEMPLATE = './download' + '/%(title)s-%(id)s.%(ext)s'
+
+# 完了記録の既定の保存先
+DEFAULT_MANIFEST = './download/.rushia-dl-manifest.jsonl'
+
 
 def download_youtube(ydl_opts, video_url):
     """YouTubeから動画/音声をダウンロード"""
-    ydl_opts['outtmpl'] = './download' + '/%(title)s-%(id)s.%(ext)s'
+    ydl_opts['outtmpl'] = OUTPUT_TEMPLATE
     with YoutubeDL(ydl_opts) as ydl:
         ydl.download([f'{video_url}'])
 
@@ -22,6 +32,8 @@ def get_ydl_opts(format: str, cookie_file: str = None) -> dict:
         'retries': 10,
         'fragment_retries': 10,
         'extractor_retries': 5,
+        # プレイヤーJSの解析結果をWeb版と共有
+        'cachedir': str(YTDLP_CACHE_DIR),
     }
     
     if cookie_file:
@@ -73,6 +85,19 @@ def parser():
                         required=False, default="./cookie.txt",
                         help="Cookieファイルのパス（デフォルト: ./cookie.txt）")
     
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="URLリストの同時ダウンロード数（デフォルト: 1）")
+    
+    parser.add_argument("--host-interval", dest="host_interval", type=float,
+                        default=DEFAULT_HOST_INTERVAL,
+                        help=f"同じホストへのダウンロード開始間隔（秒、デフォルト: {DEFAULT_HOST_INTERVAL}）")
+    
+    parser.add_argument("--manifest", dest="manifest", default=DEFAULT_MANIFEST,
+                        help=f"URLリストの完了記録ファイル（再実行時は完了済みをスキップ、デフォルト: {DEFAULT_MANIFEST}）")
+    
+    parser.add_argument("--verify", dest="verify", action='store_true',
+                        help="完了済みのファイルをチェックサムで確認してからスキップ")
+    
     args = parser.parse_args()
     return args
 
@@ -80,6 +105,10 @@ def parser():
 def main():
     args = parser()
     
+    # 解析済みのプレイヤーJSを再利用し、古いバージョンのキャッシュは削除
+    enable_preprocessed_player_cache()
+    prune_player_cache(YTDLP_CACHE_DIR)
+    
     # Cookieファイルの設定
     cookie_file = None
     if args.is_membership:
@@ -105,14 +134,26 @@ def main():
         with open(path) as f:
             urls = [line.strip() for line in f if line.strip()]
         
-        print(f'{len(urls)} 件のURLを処理します...')
-        for i, video_url in enumerate(urls, 1):
-            print(f'\n[{i}/{len(urls)}] ダウンロード中: {video_url}')
-            try:
-                download_youtube(ydl_opts, video_url)
-            except Exception as e:
-                print(f'エラー: {e}')
-                continue
+        # 前回までに完了したURLはネットワークにアクセスせずスキップ
+        manifest = BatchManifest(Path(args.manifest))
+        urls = list(dict.fromkeys(urls))
+        pending = [url for url in urls if not manifest.is_done(url, args.format, args.verify)]
+        if len(pending) < len(urls):
+            print(f'{len(urls) - len(pending)} 件は完了済みのためスキップします（{args.manifest}）')
+        
+        print(f'{len(pending)} 件のURLを処理します（同時 {args.jobs} 件）...')
+        downloader = BatchDownloader(
+            {**ydl_opts, 'outtmpl': OUTPUT_TEMPLATE},
+            jobs=args.jobs,
+            host_interval=args.host_interval,
+        )
+        results = downloader.run(
+            pending,
+            on_result=lambda r: manifest.record(r['url'], args.format, r['filepath'], r['id']),
+        )
+        print_summary(results)
+        if any(not r['ok'] for r in results):
+            exit(1)
     else:
         # 単一URLをダウンロード
         video_url = args.url
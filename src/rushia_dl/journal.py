@@ -0,0 +1,144 @@
+"""
+ダウンロード中のジョブの記録（サーバーの再起動後に途中から再開するため）
+
+yt-dlpは書き込み途中のファイル（.part）とフラグメントの進み具合（.ytdl）を残し、
+同じファイル名で再実行すると続きからダウンロードする。待ち行列に入れたジョブと
+選ばれたフォーマットをここに記録しておき、起動時に同じタスクIDで待ち行列へ戻す。
+タスクの状態の保存先（memory / sqlite）に関係なく、常にSQLiteに保存する。
+
+複数のuvicornワーカーが同じファイルを使うため、各ジョブには記録したプロセス（owner）を
+持たせる。プロセスは生存を定期的に記録し、記録が途絶えたプロセス（異常終了）と
+正常終了時に手放したジョブだけを、1つのプロセスがトランザクション内で引き取る。
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# この時間（秒）生存の記録がないプロセスは終了したとみなし、そのジョブを引き取る
+DEFAULT_OWNER_TIMEOUT = 60
+
+
+class DownloadJournal:
+    """終了していないダウンロードのジョブ（URL・フォーマット・選ばれたフォーマットID・進み具合）"""
+
+    def __init__(self, path: Path, owner_timeout: float = DEFAULT_OWNER_TIMEOUT):
+        self.path = path
+        self.owner_timeout = owner_timeout
+        # このプロセスの識別子（コンテナの再起動でPIDが再利用されても区別できるようにする）
+        self.owner = uuid.uuid4().hex
+        self._local = threading.local()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY,
+                owner TEXT,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS owners (
+                owner TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            );
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'owner' not in columns:
+            # ownerの列がない記録（すべて引き取り対象）
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        conn.commit()
+        # 起動直後に記録したジョブを他のプロセスに引き取られないよう、先に生存を記録する
+        self.heartbeat()
+
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドごとの接続を取得"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def heartbeat(self):
+        """このプロセスが動いていることを記録"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO owners (owner, seen_at) VALUES (?, ?)", (self.owner, time.time())
+            )
+
+    def record(self, task_id: str, **fields):
+        """ジョブをこのプロセスのものとして記録（記録済みなら項目を上書きし、作成時刻と再開回数は引き継ぐ）"""
+        self._merge(task_id, fields, create=True)
+
+    def update(self, task_id: str, **fields):
+        """記録済みのジョブの項目を更新（終了して削除された後の更新は無視）"""
+        self._merge(task_id, fields, create=False)
+
+    def _merge(self, task_id: str, fields: dict, create: bool):
+        conn = self._conn()
+        with conn:
+            row = conn.execute("SELECT owner, data FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None and not create:
+                return
+            entry = json.loads(row[1]) if row else {'created_at': time.time(), 'attempts': 0}
+            entry.update(fields)
+            owner = self.owner if create else row[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (task_id, owner, updated_at, data) VALUES (?, ?, ?, ?)",
+                (task_id, owner, time.time(), json.dumps(entry, ensure_ascii=False)),
+            )
+
+    def claim(self) -> list:
+        """持ち主が終了したジョブをこのプロセスのものにし、[(task_id, ジョブ), ...]（最初に記録した順）を返す
+
+        他のプロセスと同時に呼ばれても、1つのジョブは1つのプロセスだけが引き取る。
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO owners (owner, seen_at) VALUES (?, ?)", (self.owner, now)
+            )
+            conn.execute("DELETE FROM owners WHERE seen_at < ?", (now - self.owner_timeout,))
+            rows = conn.execute(
+                "SELECT task_id, data FROM jobs"
+                " WHERE owner IS NULL OR owner NOT IN (SELECT owner FROM owners)"
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET owner = ? WHERE task_id = ?", [(self.owner, task_id) for task_id, _ in rows]
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        entries = [(task_id, json.loads(data)) for task_id, data in rows]
+        return sorted(entries, key=lambda item: item[1].get('created_at', 0))
+
+    def release(self):
+        """正常終了時に、このプロセスのジョブを他のプロセス（次回の起動を含む）がすぐに引き取れるようにする"""
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE jobs SET owner = NULL WHERE owner = ?", (self.owner,))
+            conn.execute("DELETE FROM owners WHERE owner = ?", (self.owner,))
+
+    def remove(self, task_id: str):
+        """終了したジョブの記録を削除"""
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+
+    def close(self):
+        """接続を閉じる"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
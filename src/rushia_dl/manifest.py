@@ -0,0 +1,95 @@
+"""
+CLIのバッチダウンロードの完了記録（マニフェスト）
+"""
+import hashlib
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from .urls import extract_video_id
+
+# チェックサム計算時の読み込み単位
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def manifest_key(url: str, format: str) -> str:
+    """マニフェストのキー（YouTubeは動画ID、それ以外はURLそのもの）"""
+    return f'{format} {extract_video_id(url) or url}'
+
+
+def file_checksum(path: Path) -> str:
+    """ファイルのSHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BatchManifest:
+    """完了したダウンロードを1行1件のJSONで追記するマニフェスト
+
+    yt-dlpの --download-archive と同様に、URLから求めたキー（フォーマット + 動画ID）
+    で完了済みかを判定するため、再実行時はネットワークにアクセスせずに済む。
+    出力ファイルのパス・サイズ・SHA-256も記録し、ファイルが消えたり
+    変わったりしていればダウンロードし直す。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断された行は無視
+                    continue
+                self._entries[entry['key']] = entry
+
+    def is_done(self, url: str, format: str, verify: bool = False) -> bool:
+        """完了済みで出力ファイルも残っているか（verifyならチェックサムも確認）"""
+        entry = self._entries.get(manifest_key(url, format))
+        if entry is None:
+            return False
+        path = Path(entry['filepath'])
+        try:
+            if path.stat().st_size != entry['size']:
+                return False
+        except OSError:
+            return False
+        if verify:
+            return file_checksum(path) == entry['sha256']
+        return True
+
+    def record(self, url: str, format: str, filepath: str, video_id: Optional[str] = None):
+        """完了したダウンロードを追記（チェックサムを計算してから書き込む）"""
+        path = Path(filepath)
+        entry = {
+            'key': manifest_key(url, format),
+            'url': url,
+            'id': video_id,
+            'format': format,
+            'filepath': str(path),
+            'size': path.stat().st_size,
+            'sha256': file_checksum(path),
+            'completed_at': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+            self._entries[entry['key']] = entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
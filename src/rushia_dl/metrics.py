@@ -0,0 +1,164 @@
+"""
+Prometheus形式のメトリクス（テキスト形式で出力、外部ライブラリ不要）
+"""
+import math
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Optional
+
+# 処理時間の既定のバケット（秒）: 数十ミリ秒の情報取得から数十分のダウンロードまで
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += self._samples()
+        return lines
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """増加のみのカウンター"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}'
+                for key, v in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """現在値（出力時に関数で値を取得する）"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, collect: Callable[[], float]):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def _samples(self) -> list:
+        return [f'{self.name} {_format_value(self.collect())}']
+
+
+class Histogram(_Metric):
+    """処理時間などの分布"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: dict = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with文の中の処理時間を記録"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> list:
+        with self._lock:
+            series = {key: {**s, 'counts': list(s['counts'])} for key, s in self._series.items()}
+        lines = []
+        for key, s in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, s['counts']):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(s["sum"])}')
+            lines.append(f'{self.name}_count{labels} {s["count"]}')
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスの登録と出力"""
+
+    def __init__(self, prefix: str = ''):
+        self.prefix = prefix
+        self._metrics: list = []
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, help, labelnames))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(self.prefix + name, help, collect))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (),
+                  buckets: Optional[tuple] = None) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help, labelnames, buckets or DEFAULT_BUCKETS))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式で出力"""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,90 @@
+"""
+yt-dlpのディスクキャッシュ（YouTubeプレイヤーJSの解析結果・署名の解読方法）の設定と整理
+
+yt-dlpはJSチャレンジの解決に使うプレイヤーの情報を cachedir に保存する。
+保存先をAPI（スレッド・子プロセス）とCLIで共有し、プレイヤーのバージョンが
+変わったら古いバージョンの分を削除する。
+"""
+import os
+import re
+import time
+import urllib.parse
+from pathlib import Path
+
+# キャッシュの保存先（未設定ならyt-dlpの既定と同じ場所）
+CACHE_DIR = Path(os.path.expanduser(os.environ.get(
+    'RUSHIA_DL_YTDLP_CACHE',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'yt-dlp'),
+)))
+
+# プレイヤーのバージョンごとに保存されるセクション
+PLAYER_SECTIONS = ('challenge-solver', 'youtube-sigfuncs', 'youtube-nsig', 'youtube-sts')
+# 残すプレイヤーのバージョン数（保存が新しい順）
+KEEP_PLAYER_VERSIONS = 3
+# 書き込み途中で残った一時ファイルを削除するまでの時間（秒）
+TEMP_FILE_GRACE_SECONDS = 60 * 60
+
+# キャッシュのキー（URLをエスケープしたもの）に含まれるプレイヤーのバージョン
+PLAYER_URL_PATTERN = re.compile(r'/s/player/(?P<id>[0-9a-fA-F]{8,})/')
+PLAYER_KEY_PATTERN = re.compile(r'^(?P<id>[0-9a-fA-F]{8,})-')
+
+
+def enable_preprocessed_player_cache() -> bool:
+    """解析済みのプレイヤーJSもディスクに保存する（yt-dlpの既定では無効）
+
+    JSチャレンジの解決ではプレイヤーJS全体の解析が最も重い。yt-dlpは古いバージョンを
+    削除しないため既定で無効にしているが、prune_player_cache() で削除するので有効にする。
+    """
+    try:
+        from yt_dlp.extractor.youtube.jsc._builtin.ejs import EJSBaseJCP
+    except ImportError:
+        return False
+    EJSBaseJCP._ENABLE_PREPROCESSED_PLAYER_CACHE = True
+    return True
+
+
+def player_version(filename: str) -> str:
+    """キャッシュファイル名からプレイヤーのバージョンを取得（該当しなければ空文字）"""
+    key = urllib.parse.unquote(filename.replace(',', '%'))
+    match = PLAYER_URL_PATTERN.search(key) or PLAYER_KEY_PATTERN.match(key)
+    return match.group('id') if match else ''
+
+
+def prune_player_cache(cache_dir: Path = CACHE_DIR, keep: int = KEEP_PLAYER_VERSIONS) -> list:
+    """新しい keep 個以外のプレイヤーのキャッシュを削除し、削除したファイル名を返す"""
+    entries = []  # (プレイヤーのバージョン, パス, 更新時刻)
+    now = time.time()
+    removed = []
+    for section in PLAYER_SECTIONS:
+        directory = Path(cache_dir) / section
+        if not directory.is_dir():
+            continue
+        for path in directory.iterdir():
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                continue
+            if path.suffix == '.tmp':
+                if now - mtime > TEMP_FILE_GRACE_SECONDS:
+                    _remove(path, removed)
+                continue
+            version = player_version(path.stem)
+            if version:
+                entries.append((version, path, mtime))
+
+    newest: dict = {}
+    for version, _, mtime in entries:
+        newest[version] = max(mtime, newest.get(version, 0))
+    kept = set(sorted(newest, key=newest.get, reverse=True)[:keep])
+    for version, path, _ in entries:
+        if version not in kept:
+            _remove(path, removed)
+    return removed
+
+
+def _remove(path: Path, removed: list):
+    try:
+        path.unlink()
+        removed.append(path.name)
+    except OSError:
+        pass
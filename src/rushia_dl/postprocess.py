@@ -0,0 +1,235 @@
+"""
+ダウンロード後の後処理（結合・コンテナの修正・音声の変換）
+
+ffmpegはCPUとディスクを使うため、ネットワークの枠（同時ダウンロード数）とは別に
+コア数までの並列で実行する。コーデックがそのまま格納できる場合は再エンコードせず、
+ストリームのコピー（moovの先頭への移動を含む）かファイル名の変更だけで済ませる。
+"""
+import asyncio
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Optional
+
+# 同時に実行するffmpegの数（未設定ならCPUのコア数）
+POSTPROCESS_WORKERS = int(os.environ.get('RUSHIA_DL_POSTPROCESS_WORKERS') or 0) or os.cpu_count() or 1
+
+# コピーのままm4aに格納する音声コーデック（yt-dlpの表記とffprobeの表記）
+M4A_AUDIO_CODECS = ('mp4a', 'aac', 'alac')
+# AACへ変換する場合の品質（yt-dlpの preferredquality '0' と同じ、ffmpeg内蔵エンコーダーの最高品質）
+AAC_QUALITY = '4'
+# ffmpegのエラー出力のうちエラーメッセージに含める行数
+FFMPEG_ERROR_LINES = 3
+
+# ダウンロードしたファイル名の拡張子（フォーマットごとに保存した場合は .f137.mp4 など）
+DOWNLOADED_SUFFIX_PATTERN = re.compile(r'(?<=-[0-9A-Za-z_-]{11})(\.f[0-9A-Za-z_-]+)?\.[0-9A-Za-z]+$')
+
+
+class PostProcessError(Exception):
+    """後処理の失敗（メッセージにffmpegを含め、エラーの分類で 'ffmpeg' になるようにする）"""
+
+
+def final_name(downloaded: str, ext: str) -> str:
+    """ダウンロードしたファイル名（'%(title)s-%(id)s.f137.mp4' など）から完成品のファイル名を作成"""
+    return DOWNLOADED_SUFFIX_PATTERN.sub('', downloaded) + f'.{ext}'
+
+
+def codec_family(codec: Optional[str]) -> str:
+    """'avc1.640028' -> 'avc1' のようにコーデック名だけを取り出す（'none' は空文字）"""
+    family = (codec or '').split('.')[0].lower()
+    return '' if family == 'none' else family
+
+
+def mp4_layout(path: Path) -> Optional[str]:
+    """MP4のトップレベルのボックスの並びを調べる
+
+    'faststart'（moovがmdatより前）、'moov_at_end'、'fragmented'（DASHのmoof）のいずれか。
+    MP4として読めなければNone。
+    """
+    seen = []
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + 8 <= size:
+                f.seek(offset)
+                header = f.read(16)
+                box_size = int.from_bytes(header[:4], 'big')
+                box_type = header[4:8]
+                if box_size == 1:
+                    box_size = int.from_bytes(header[8:16], 'big')
+                elif box_size == 0:
+                    box_size = size - offset
+                if box_size < 8 or not box_type.isalnum():
+                    return None
+                seen.append(box_type)
+                if box_type in (b'mdat', b'moof'):
+                    break
+                offset += box_size
+    except OSError:
+        return None
+    if not seen or seen[0] not in (b'ftyp', b'styp'):
+        return None
+    if b'moof' in seen or b'sidx' in seen:
+        return 'fragmented'
+    if b'moov' in seen:
+        return 'faststart'
+    return 'moov_at_end'
+
+
+def needs_remux(source: dict) -> bool:
+    """ダウンロードしたままではプレイヤーによって再生できないか（yt-dlpのFixupに相当）"""
+    if (source.get('container') or '').endswith('_dash'):
+        return True
+    if (source.get('protocol') or '').startswith('m3u8'):
+        # HLSはMPEG-TSのままMP4の拡張子で保存されている
+        return True
+    # MP4として読めない場合は判断できないため、yt-dlpと同じくそのまま使う
+    return mp4_layout(Path(source['path'])) in ('moov_at_end', 'fragmented')
+
+
+def _adts_filter(source: dict) -> list:
+    """MPEG-TSのAACをMP4に格納するためのビットストリームフィルター"""
+    if (source.get('protocol') or '').startswith('m3u8') and codec_family(source.get('acodec')) in ('mp4a', 'aac'):
+        return ['-bsf:a', 'aac_adtstoasc']
+    return []
+
+
+def plan(format: str, files: list) -> tuple:
+    """後処理の内容を決める
+
+    (種類, ffmpegの入力から出力の直前までの引数, 必須か) を返す。引数がNoneならファイル名の変更だけ。
+    必須でない処理（コンテナの修正）はffmpegがなければ省略する。
+    """
+    if format == 'm4a':
+        source = files[0]
+        # コーデックが不明な場合は拡張子から判断（m4a・mp4ならAAC）
+        acodec = codec_family(source.get('acodec')) or ('mp4a' if source.get('ext') in ('m4a', 'mp4') else '')
+        if acodec not in M4A_AUDIO_CODECS:
+            return 'convert', [
+                '-i', source['path'], '-vn', '-c:a', 'aac', '-q:a', AAC_QUALITY,
+                '-movflags', '+faststart',
+            ], True
+        has_video = bool(codec_family(source.get('vcodec')))
+        if not has_video and source.get('ext') == 'm4a' and not needs_remux(source):
+            return 'rename', None, True
+        return 'remux', [
+            '-i', source['path'], '-vn', '-c:a', 'copy', *_adts_filter(source),
+            '-movflags', '+faststart',
+        ], has_video
+
+    if len(files) > 1:
+        video = next((f for f in files if codec_family(f.get('vcodec'))), files[0])
+        audio = next(f for f in files if f is not video)
+        return 'merge', [
+            '-i', video['path'], '-i', audio['path'], '-map', '0:v:0', '-map', '1:a:0',
+            '-c', 'copy', *_adts_filter(audio), '-movflags', '+faststart',
+        ], True
+    source = files[0]
+    if source.get('ext') == 'mp4' and not needs_remux(source):
+        return 'rename', None, True
+    return 'remux', [
+        '-i', source['path'], '-c', 'copy', *_adts_filter(source),
+        '-movflags', '+faststart',
+    ], source.get('ext') != 'mp4'
+
+
+async def probe_codecs(path: str) -> dict:
+    """ffprobeでコーデックを調べる（yt-dlpの情報にない場合のみ）"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return {}
+    proc = await asyncio.create_subprocess_exec(
+        ffprobe, '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    codecs = {'vcodec': 'none', 'acodec': 'none'}
+    try:
+        streams = json.loads(stdout or b'{}').get('streams') or []
+    except ValueError:
+        return {}
+    for stream in streams:
+        key = {'video': 'vcodec', 'audio': 'acodec'}.get(stream.get('codec_type'))
+        if key and codecs[key] == 'none':
+            codecs[key] = stream.get('codec_name') or 'none'
+    return codecs
+
+
+class PostProcessPool:
+    """ffmpegの実行枠（ダウンロードの枠とは別に、同時実行数をコア数までに制限）"""
+
+    def __init__(self, max_workers: int = POSTPROCESS_WORKERS):
+        self.max_workers = max_workers
+        self.active = 0
+        self.waiting = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def run(self, format: str, files: list, output: Path) -> str:
+        """ダウンロードしたファイル（'path'・'ext'・コーデック情報）から output を作成し、処理の種類を返す
+
+        成功したら元のファイル（output と同じ名前のものを除く）を削除する。失敗した場合は再試行時にyt-dlpがダウンロードを
+        省略できるよう残す（期限が過ぎれば一時ファイルとして掃除される）。
+        """
+        files = [dict(f) for f in files]
+        for source in files:
+            if source.get('acodec') is None and source.get('vcodec') is None:
+                source.update(await probe_codecs(source['path']))
+        loop = asyncio.get_running_loop()
+        kind, args, required = await loop.run_in_executor(None, plan, format, files)
+
+        if args is not None and not shutil.which('ffmpeg'):
+            if required:
+                raise PostProcessError(f"ffmpeg not found (required to {kind} {Path(files[0]['path']).name})")
+            print(f"[PostProcess] ffmpeg not found, skipping {kind}: {Path(files[0]['path']).name}")
+            args = None
+        if args is None:
+            os.replace(files[0]['path'], output)
+            return 'rename'
+
+        temp = output.with_name(f'{output.stem}.temp{output.suffix}')
+        try:
+            await self._run_ffmpeg([*args, str(temp)])
+            os.replace(temp, output)
+        finally:
+            temp.unlink(missing_ok=True)
+        for source in files:
+            if Path(source['path']) != output:
+                Path(source['path']).unlink(missing_ok=True)
+        return kind
+
+    async def _run_ffmpeg(self, args: list):
+        """空きを待ってffmpegを実行"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        self.waiting += 1
+        waiting = True
+        try:
+            async with self._semaphore:
+                self.waiting -= 1
+                waiting = False
+                self.active += 1
+                try:
+                    await self._ffmpeg(args)
+                finally:
+                    self.active -= 1
+        finally:
+            if waiting:
+                self.waiting -= 1
+
+    async def _ffmpeg(self, args: list):
+        proc = await asyncio.create_subprocess_exec(
+            shutil.which('ffmpeg'), '-y', '-nostdin', '-loglevel', 'error', *args,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        if proc.returncode != 0:
+            lines = stderr.decode(errors='replace').strip().splitlines()[-FFMPEG_ERROR_LINES:]
+            raise PostProcessError(f"ffmpeg exited with code {proc.returncode}: {' '.join(lines)}")
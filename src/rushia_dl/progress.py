@@ -0,0 +1,131 @@
+"""
+yt-dlpの進捗コールバックの集約
+"""
+import time
+from threading import Lock
+from typing import Callable, Optional
+
+# 速度の指数移動平均の重み（大きいほど直近の値を重視）
+SPEED_SMOOTHING = 0.3
+
+
+class ProgressTracker:
+    """1タスク分の進捗コールバックを集約し、一定間隔でスナップショットとして反映
+
+    yt-dlpはフラグメントごと・チャンクごとに何度もコールバックを呼ぶため、
+    最新の状態だけを保持して interval 秒に1回 apply() へ渡す。
+    ステータスが変わった時は間隔に関係なく即座に反映する。
+    """
+
+    def __init__(self, apply: Callable[[dict], None], interval: float = 0.5):
+        self.apply = apply
+        self.interval = interval
+        self._lock = Lock()
+        self._status: Optional[str] = None
+        self._progress = 0.0
+        self._last_apply = 0.0
+        # 平滑化した速度の計算用
+        self._stream: Optional[str] = None
+        self._sample_time: Optional[float] = None
+        self._sample_bytes = 0
+        self._speed: Optional[float] = None
+        # 複数ストリーム（動画+音声）の完了済みバイト数
+        self._finished_bytes = 0
+
+    def on_progress(self, d: dict):
+        """yt-dlpのprogress_hooksから呼ばれる"""
+        if d['status'] == 'downloading':
+            snapshot = self._downloading_snapshot(d)
+        elif d['status'] == 'finished':
+            snapshot = self._finished_snapshot(d)
+        else:
+            return
+        if snapshot is not None:
+            self.apply(snapshot)
+
+    def _downloading_snapshot(self, d: dict) -> Optional[dict]:
+        now = time.monotonic()
+        # バイトベースの進捗
+        # 推定値は小数になることがあるため整数に揃える
+        total = int(d.get('total_bytes') or d.get('total_bytes_estimate') or 0)
+        downloaded = d.get('downloaded_bytes') or 0
+
+        # フラグメントベースの進捗（HLS/DASHなど）
+        fragment_index = d.get('fragment_index')
+        fragment_count = d.get('fragment_count')
+
+        with self._lock:
+            self._update_speed(d.get('tmpfilename') or d.get('filename'), downloaded, d.get('speed'), now)
+
+            # 進捗を計算
+            if total > 0 and downloaded > 0:
+                self._progress = (downloaded / total) * 100
+            elif fragment_index and fragment_count:
+                self._progress = (fragment_index / fragment_count) * 100
+
+            status_changed = self._status != 'downloading'
+            if not status_changed and now - self._last_apply < self.interval:
+                return None
+            self._status = 'downloading'
+            self._last_apply = now
+
+            eta = None
+            if self._speed and total > downloaded:
+                eta = int((total - downloaded) / self._speed)
+            elif d.get('eta') is not None:
+                eta = d.get('eta')
+
+            snapshot = {
+                'progress': min(self._progress, 99),
+                # 追加情報を保存
+                'speed': self._speed,
+                'eta': eta,
+                'downloaded_bytes': self._finished_bytes + downloaded,
+                'total_bytes': self._finished_bytes + total if total else None,
+                'elapsed': d.get('elapsed'),
+            }
+            # ステータスは変化した時だけ含める（保存先が即時書き込みするため）
+            if status_changed:
+                snapshot['status'] = 'downloading'
+            # フラグメント情報も保存（デバッグ用）
+            if fragment_index and fragment_count:
+                snapshot['fragment_index'] = fragment_index
+                snapshot['fragment_count'] = fragment_count
+            return snapshot
+
+    def _update_speed(self, stream: Optional[str], downloaded: int, reported: Optional[float], now: float):
+        """ダウンロード速度の指数移動平均を更新"""
+        if self._sample_time is None or stream != self._stream:
+            # 最初の呼び出しや別のストリームに切り替わった時は基準点をリセット
+            self._stream = stream
+            self._sample_time = now
+            self._sample_bytes = downloaded
+            return
+
+        elapsed = now - self._sample_time
+        if elapsed < 0.2:
+            return
+        instant = (downloaded - self._sample_bytes) / elapsed
+        if instant < 0:
+            instant = reported or 0
+        self._sample_time = now
+        self._sample_bytes = downloaded
+
+        if self._speed is None:
+            self._speed = instant
+        else:
+            self._speed = SPEED_SMOOTHING * instant + (1 - SPEED_SMOOTHING) * self._speed
+
+    def _finished_snapshot(self, d: dict) -> dict:
+        with self._lock:
+            self._status = 'processing'
+            self._last_apply = time.monotonic()
+            self._finished_bytes += int(d.get('total_bytes') or d.get('downloaded_bytes') or 0)
+            self._sample_time = None
+            return {
+                'status': 'processing',
+                'progress': 99,
+                # ダウンロード完了時の情報をクリア
+                'speed': None,
+                'eta': None,
+            }
@@ -0,0 +1,250 @@
+"""
+ダウンロードジョブのスケジューリング
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import random
+import time
+from typing import Callable, Optional
+
+
+class QueueFullError(Exception):
+    """待ち行列が満杯"""
+
+
+class ClientQueueLimitError(Exception):
+    """1クライアントあたりの待ち件数の上限を超えた"""
+
+
+class DownloadQueue:
+    """優先度とクライアント間の公平性を考慮したダウンロード待ち行列
+
+    取り出し順は (優先度, ラウンド, 到着順)。ラウンドはクライアントごとに
+    1件ずつ進むため、同じ優先度の中では各クライアントのジョブが交互に実行される。
+    イベントループのスレッドからのみ操作すること。
+    """
+
+    def __init__(self, maxsize: int, max_per_client: Optional[int] = None):
+        self.maxsize = maxsize
+        self.max_per_client = max_per_client
+        self._heap: list = []
+        self._jobs: dict = {}
+        self._seq = itertools.count()
+        self._current_round = 0
+        self._client_rounds: dict = {}
+        self._client_counts: dict = {}
+        self._order: Optional[list] = None
+        self._getters: collections.deque = collections.deque()
+
+    def put_nowait(self, task_id: str, job: dict, priority: int = 0, client: str = ''):
+        """ジョブを追加（満杯の場合は例外）"""
+        if len(self._jobs) >= self.maxsize:
+            raise QueueFullError()
+        if self.max_per_client and self._client_counts.get(client, 0) >= self.max_per_client:
+            raise ClientQueueLimitError()
+
+        # クライアントの次のラウンド（空いているクライアントは現在のラウンドから）
+        job_round = max(self._client_rounds.get(client, 0), self._current_round)
+        self._client_rounds[client] = job_round + 1
+        self._client_counts[client] = self._client_counts.get(client, 0) + 1
+
+        entry = (priority, job_round, next(self._seq), task_id)
+        heapq.heappush(self._heap, entry)
+        self._jobs[task_id] = {
+            **job,
+            'task_id': task_id,
+            'client': client,
+            'priority': priority,
+            'enqueued_at': time.time(),
+        }
+        self._order = None
+        self._wake()
+
+    async def get(self) -> dict:
+        """次に実行するジョブを取り出す（空の場合は待機）"""
+        while True:
+            await self.wait()
+            job = self.get_nowait()
+            if job is not None:
+                return job
+
+    def get_nowait(self) -> Optional[dict]:
+        """次に実行するジョブを取り出す（空の場合はNone）"""
+        while self._heap:
+            _, job_round, _, task_id = heapq.heappop(self._heap)
+            job = self._jobs.pop(task_id, None)
+            if job is None:
+                # 取り消し済み
+                continue
+            self._current_round = max(self._current_round, job_round)
+            self._release_client(job['client'])
+            self._order = None
+            return job
+        return None
+
+    async def wait(self):
+        """取り出せるジョブができるまで待機（ジョブは待ち行列に残したまま）"""
+        while not self._jobs:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                # 受け取るはずだった通知を次の待機者へ渡す
+                if getter.done() and not getter.cancelled():
+                    self._wake()
+                raise
+
+    def remove(self, task_id: str) -> Optional[dict]:
+        """待機中のジョブを取り消す（ヒープからは取り出し時に除外）"""
+        job = self._jobs.pop(task_id, None)
+        if job is not None:
+            self._release_client(job['client'])
+            self._order = None
+        return job
+
+    def position(self, task_id: str) -> Optional[int]:
+        """待ち順（1始まり）。待機中でなければNone"""
+        if task_id not in self._jobs:
+            return None
+        if self._order is None:
+            self._order = [entry[3] for entry in sorted(self._heap) if entry[3] in self._jobs]
+        return self._order.index(task_id) + 1
+
+    def get_job(self, task_id: str) -> Optional[dict]:
+        """待機中のジョブを取得"""
+        return self._jobs.get(task_id)
+
+    def task_ids(self) -> list:
+        """待機中のタスクID一覧"""
+        return list(self._jobs)
+
+    def _release_client(self, client: str):
+        count = self._client_counts.get(client, 0) - 1
+        if count <= 0:
+            self._client_counts.pop(client, None)
+            # 待ちがなくなったクライアントのラウンドは次回現在値から始める
+            self._client_rounds.pop(client, None)
+        else:
+            self._client_counts[client] = count
+
+    def _wake(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+class AdaptiveConcurrency:
+    """上流のレート制限に合わせて同時実行数を調整する（AIMD）
+
+    成功するたびに上限を 1/上限 ずつ増やし（おおむね上限分の成功で+1）、
+    レート制限を検知したら上限を半分にして、全体でしばらく新規開始を止める。
+    同じ波で失敗した複数のジョブで何度も半減しないよう、直前の調整より前に
+    開始したジョブのレート制限は無視する。イベントループのスレッドからのみ操作すること。
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1,
+                 backoff_base: float = 30.0, backoff_max: float = 15 * 60, jitter: float = 0.2,
+                 on_backoff: Optional[Callable[[float], None]] = None):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.on_backoff = on_backoff
+        self.limit = float(max_limit)
+        self.active = 0
+        self.backoff_until = 0.0
+        self._epoch = 0
+        self._consecutive = 0
+        self._waiters: collections.deque = collections.deque()
+
+    async def acquire(self) -> int:
+        """実行枠を確保（上限に達しているか待機中なら空くまで待つ）。releaseに渡す値を返す"""
+        while True:
+            remaining = self.backoff_until - time.time()
+            if remaining > 0:
+                await self._wait(remaining)
+                continue
+            if self.active < int(self.limit):
+                self.active += 1
+                return self._epoch
+            await self._wait()
+
+    def release(self, epoch: int, outcome: Optional[str]):
+        """実行枠を返却（outcome: 'success' / 'rate_limit' / その他の失敗 / None）"""
+        self.active -= 1
+        if outcome == 'success':
+            self._consecutive = 0
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        elif outcome == 'rate_limit' and epoch == self._epoch:
+            self._reduce()
+        self._wake()
+
+    def backoff_remaining(self) -> float:
+        return max(0.0, self.backoff_until - time.time())
+
+    def _reduce(self):
+        self._epoch += 1
+        self._consecutive += 1
+        self.limit = max(float(self.min_limit), self.limit / 2)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self._consecutive - 1))
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.backoff_until = time.time() + delay
+        print(f"[Throttle] Rate limited: concurrency {int(self.limit)}, pausing new downloads for {delay:.0f}s")
+        if self.on_backoff is not None:
+            self.on_backoff(self.backoff_until)
+
+    async def _wait(self, timeout: Optional[float] = None):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class FragmentBudget:
+    """フラグメントの同時接続数の全体の上限を、実行中のジョブで分け合う
+
+    yt-dlpはフラグメントのダウンロード開始時にスレッド数を決めるため、割り当ては
+    ジョブの開始時に行い、終了したジョブの分は後から開始するジョブへ回す。
+    空きがなくても最低1接続（逐次ダウンロード）は割り当てるため、上限を超えるのは
+    その分だけ。イベントループのスレッドからのみ操作すること。
+    """
+
+    def __init__(self, total: int, per_job_max: int):
+        self.total = total
+        self.per_job_max = per_job_max
+        self.in_use = 0
+        self.jobs = 0
+
+    def allocate(self, scale: float = 1.0) -> int:
+        """このジョブの接続数を決めて確保（scaleで全体の上限を一時的に縮める）"""
+        total = max(1, int(self.total * scale))
+        fair_share = total // (self.jobs + 1)
+        count = max(1, min(self.per_job_max, fair_share, total - self.in_use))
+        self.in_use += count
+        self.jobs += 1
+        return count
+
+    def release(self, count: int):
+        """allocateで確保した接続数を返却"""
+        self.in_use -= count
+        self.jobs -= 1
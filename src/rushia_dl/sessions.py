@@ -0,0 +1,219 @@
+"""
+YoutubeDLのセッションプール
+
+YoutubeDLを作るたびにエクストラクターの初期化、HTTP接続の確立、プレイヤーJSの
+取得・チャレンジの解決がやり直しになるため、同じオプション（Cookieを含む）の
+インスタンスをジョブ間で使い回す。インスタンスはスレッドセーフではないため、
+1つのセッションは同時に1つのジョブだけが使う。
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+
+# ジョブごとに差し替えるオプション（プールのキーに含めない）
+PER_JOB_OPTIONS = ('progress_hooks', 'postprocessor_hooks')
+# ジョブごとに params を書き換えて適用するオプション（未指定ならyt-dlpの既定値）
+PER_JOB_PARAMS = {'concurrent_fragment_downloads': 1}
+
+# 1つのオプションあたりに保持する待機中のセッション数と、全体の上限
+MAX_IDLE_PER_KEY = 4
+MAX_IDLE_SESSIONS = 16
+# 使われないまま経過したら閉じるまでの時間（秒）
+SESSION_IDLE_TIMEOUT = 10 * 60
+# 1つのセッションで実行するジョブ数の上限（内部状態が増え続けないよう作り直す）
+SESSION_MAX_JOBS = 50
+
+
+def session_key(ydl_opts: dict) -> str:
+    """オプションからプールのキーを作成（関数はモジュール名と名前で区別）"""
+    def default(value):
+        if callable(value):
+            return f'{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", repr(value))}'
+        return repr(value)
+
+    opts = {k: v for k, v in ydl_opts.items() if k not in PER_JOB_OPTIONS and k not in PER_JOB_PARAMS}
+    return json.dumps(opts, sort_keys=True, default=default)
+
+
+class YoutubeDLSession:
+    """プール内の1つのYoutubeDL（フックはジョブごとに差し替える）"""
+
+    def __init__(self, key: str, ydl_opts: dict):
+        self.key = key
+        self.cookiefile = ydl_opts.get('cookiefile')
+        self.jobs = 0
+        self.last_used = time.monotonic()
+        self._progress_hooks: list = []
+        self._postprocessor_hooks: list = []
+        opts = {k: v for k, v in ydl_opts.items() if k not in PER_JOB_OPTIONS and k not in PER_JOB_PARAMS}
+        opts['progress_hooks'] = [self._dispatch_progress]
+        opts['postprocessor_hooks'] = [self._dispatch_postprocess]
+        self.ydl = YoutubeDL(opts)
+
+    def warm(self):
+        """エクストラクターとHTTPハンドラー、Cookieを先に読み込む"""
+        self.ydl.get_info_extractor('Youtube')
+        self.ydl.get_info_extractor('YoutubeTab')
+        self.ydl._request_director
+        if self.cookiefile:
+            self.ydl.cookiejar
+
+    def bind(self, ydl_opts: dict):
+        """このジョブのフックとオプションを設定"""
+        self._progress_hooks = list(ydl_opts.get('progress_hooks') or [])
+        self._postprocessor_hooks = list(ydl_opts.get('postprocessor_hooks') or [])
+        for name, default in PER_JOB_PARAMS.items():
+            self.ydl.params[name] = ydl_opts.get(name, default)
+
+    def unbind(self):
+        self._progress_hooks = []
+        self._postprocessor_hooks = []
+        self.jobs += 1
+        self.last_used = time.monotonic()
+
+    def cookie_removed(self) -> bool:
+        """Cookieファイルが削除済みか（削除後のセッションは使わない）"""
+        return bool(self.cookiefile) and not os.path.exists(self.cookiefile)
+
+    def save_cookies(self):
+        # 削除済みのCookieファイルを書き戻して復元しないようにする
+        if self.cookiefile and not self.cookie_removed():
+            self.ydl.save_cookies()
+
+    def close(self):
+        if self.cookie_removed():
+            self.ydl.params['cookiefile'] = None
+        try:
+            self.ydl.close()
+        except Exception as e:
+            print(f"[Session] Failed to close YoutubeDL: {e}")
+
+    def _dispatch_progress(self, d):
+        for hook in self._progress_hooks:
+            hook(d)
+
+    def _dispatch_postprocess(self, d):
+        for hook in self._postprocessor_hooks:
+            hook(d)
+
+
+class YoutubeDLPool:
+    """オプションごとに待機中のYoutubeDLを保持するプール"""
+
+    def __init__(self, max_idle_per_key: int = MAX_IDLE_PER_KEY, max_idle: int = MAX_IDLE_SESSIONS,
+                 idle_timeout: float = SESSION_IDLE_TIMEOUT, max_jobs: int = SESSION_MAX_JOBS):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_jobs = max_jobs
+        self._idle: dict = {}  # キー -> 待機中のセッション（古い順）
+        self._lock = Lock()
+        self.created = 0
+        self.reused = 0
+
+    @contextmanager
+    def session(self, ydl_opts: dict):
+        """プールからYoutubeDLを借りる（フックはこのジョブの間だけ有効）
+
+        yt-dlpが報告したエラー（DownloadError）以外の例外が発生した場合、
+        セッションは内部状態が不明なためプールに戻さず閉じる。
+        """
+        session = self._checkout(ydl_opts)
+        session.bind(ydl_opts)
+        try:
+            yield session.ydl
+        except DownloadError:
+            self._release(session)
+            raise
+        except BaseException:
+            session.unbind()
+            session.close()
+            raise
+        self._release(session)
+
+    def warm(self, ydl_opts: dict):
+        """セッションを作成して待機させておく（最初のジョブの待ち時間を減らす）"""
+        key = session_key(ydl_opts)
+        with self._lock:
+            if self._idle.get(key):
+                return
+        session = YoutubeDLSession(key, ydl_opts)
+        with self._lock:
+            self.created += 1
+        session.warm()
+        self._checkin(session)
+
+    def idle_count(self) -> int:
+        with self._lock:
+            return sum(len(sessions) for sessions in self._idle.values())
+
+    def prune(self):
+        """期限切れ・Cookie削除済みの待機中セッションを閉じる"""
+        now = time.monotonic()
+        closing = []
+        with self._lock:
+            for key in list(self._idle):
+                kept = []
+                for session in self._idle[key]:
+                    if now - session.last_used > self.idle_timeout or session.cookie_removed():
+                        closing.append(session)
+                    else:
+                        kept.append(session)
+                if kept:
+                    self._idle[key] = kept
+                else:
+                    del self._idle[key]
+        for session in closing:
+            session.close()
+
+    def close(self):
+        """待機中のセッションをすべて閉じる"""
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+    def _checkout(self, ydl_opts: dict) -> YoutubeDLSession:
+        self.prune()
+        key = session_key(ydl_opts)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                # 最後に使われたもの（HTTP接続が生きている可能性が高い）から使う
+                session = idle.pop()
+                if not idle:
+                    del self._idle[key]
+                self.reused += 1
+                return session
+            self.created += 1
+        return YoutubeDLSession(key, ydl_opts)
+
+    def _release(self, session: YoutubeDLSession):
+        session.unbind()
+        session.save_cookies()
+        self._checkin(session)
+
+    def _checkin(self, session: YoutubeDLSession):
+        closing = []
+        with self._lock:
+            idle = self._idle.setdefault(session.key, [])
+            if session.jobs >= self.max_jobs or len(idle) >= self.max_idle_per_key:
+                closing.append(session)
+            else:
+                idle.append(session)
+            # 全体の上限を超えたら最も長く使われていないものから閉じる
+            while sum(len(s) for s in self._idle.values()) > self.max_idle:
+                oldest_key = min(self._idle, key=lambda k: self._idle[k][0].last_used)
+                closing.append(self._idle[oldest_key].pop(0))
+                if not self._idle[oldest_key]:
+                    del self._idle[oldest_key]
+            if not idle and session.key in self._idle:
+                del self._idle[session.key]
+        for s in closing:
+            s.close()
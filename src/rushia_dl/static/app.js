@@ -44,7 +44,9 @@ class RushiaDL {
         
         this.currentTaskId = null;
         this.pollInterval = null;
+        this.eventSource = null;
         this.historyPollInterval = null;
+        this.historyEventSource = null;
         this.lastDownloadParams = null;
         this.cookieId = null;
         
@@ -198,20 +200,78 @@ class RushiaDL {
         }
     }
     
-    // 履歴のポーリング開始
+    // 履歴のポーリング開始（SSEが使える場合はまとめて購読）
     startHistoryPolling() {
+        const pendingIds = this.getHistory()
+            .filter(item => item.status !== 'completed' && item.status !== 'error')
+            .map(item => item.taskId);
+        
+        if (pendingIds.length === 0) return;
+        
+        if (window.EventSource) {
+            const query = encodeURIComponent(pendingIds.join(','));
+            this.historyEventSource = new EventSource(`/api/events?task_ids=${query}`);
+            this.historyEventSource.addEventListener('status', (e) => {
+                const data = JSON.parse(e.data);
+                if (this.applyHistoryStatus(data.task_id, data)) {
+                    this.renderHistory();
+                    this.updateHistoryBadge();
+                }
+            });
+            this.historyEventSource.addEventListener('missing', (e) => {
+                const data = JSON.parse(e.data);
+                this.updateHistoryTask(data.task_id, { status: 'error' });
+                this.renderHistory();
+                this.updateHistoryBadge();
+            });
+            this.historyEventSource.addEventListener('end', () => this.stopHistoryPolling());
+            this.historyEventSource.onerror = () => {
+                // ストリームが使えない場合はポーリングに切り替え
+                if (this.historyEventSource && this.historyEventSource.readyState === EventSource.CLOSED) {
+                    this.historyEventSource = null;
+                    this.startHistoryIntervalPolling();
+                }
+            };
+            return;
+        }
+        
+        this.startHistoryIntervalPolling();
+    }
+    
+    startHistoryIntervalPolling() {
         this.updateHistoryStatuses();
         this.historyPollInterval = setInterval(() => this.updateHistoryStatuses(), 2000);
     }
     
     // 履歴のポーリング停止
     stopHistoryPolling() {
+        if (this.historyEventSource) {
+            this.historyEventSource.close();
+            this.historyEventSource = null;
+        }
         if (this.historyPollInterval) {
             clearInterval(this.historyPollInterval);
             this.historyPollInterval = null;
         }
     }
     
+    // 履歴の1件にステータスを反映（変更があればtrue）
+    applyHistoryStatus(taskId, data) {
+        const item = this.getHistory().find(h => h.taskId === taskId);
+        if (!item) return false;
+        
+        if (data.status !== item.status || data.title !== item.title || data.filename !== item.filename || data.progress !== item.progress) {
+            this.updateHistoryTask(taskId, {
+                status: data.status,
+                title: data.title || item.title,
+                filename: data.filename || item.filename,
+                progress: data.progress
+            });
+            return true;
+        }
+        return false;
+    }
+    
     // 履歴の各タスクのステータスを更新
     async updateHistoryStatuses() {
         const history = this.getHistory();
@@ -224,13 +284,7 @@ class RushiaDL {
                     const response = await fetch(`/api/status/${item.taskId}`);
                     if (response.ok) {
                         const data = await response.json();
-                        if (data.status !== item.status || data.title !== item.title || data.filename !== item.filename) {
-                            this.updateHistoryTask(item.taskId, {
-                                status: data.status,
-                                title: data.title || item.title,
-                                filename: data.filename || item.filename,
-                                progress: data.progress
-                            });
+                        if (this.applyHistoryStatus(item.taskId, data)) {
                             updated = true;
                         }
                     } else {
@@ -570,11 +624,34 @@ class RushiaDL {
         }
     }
     
+    // 進捗の監視開始（SSEが使える場合はプッシュ、使えない場合はポーリング）
     startPolling() {
+        if (window.EventSource) {
+            this.eventSource = new EventSource(`/api/events/${this.currentTaskId}`);
+            this.eventSource.addEventListener('status', (e) => this.handleStatus(JSON.parse(e.data)));
+            this.eventSource.addEventListener('missing', () => {
+                this.stopPolling();
+                this.clearSavedTask();
+                this.showError('タスクが見つかりません');
+            });
+            this.eventSource.onerror = () => {
+                // ストリームが使えない場合はポーリングに切り替え
+                if (this.eventSource && this.eventSource.readyState === EventSource.CLOSED) {
+                    this.eventSource = null;
+                    this.pollInterval = setInterval(() => this.checkStatus(), 1000);
+                }
+            };
+            return;
+        }
+        
         this.pollInterval = setInterval(() => this.checkStatus(), 1000);
     }
     
     stopPolling() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
         if (this.pollInterval) {
             clearInterval(this.pollInterval);
             this.pollInterval = null;
@@ -592,34 +669,37 @@ class RushiaDL {
             }
             
             const data = await response.json();
-            
-            // 進捗を更新
-            this.updateProgress(data);
-            
-            // 履歴も更新
-            this.updateHistoryTask(this.currentTaskId, {
-                status: data.status,
-                title: data.title,
-                filename: data.filename,
-                progress: data.progress
-            });
-            this.updateHistoryBadge();
-            
-            if (data.status === 'completed') {
-                this.stopPolling();
-                // 完了時は保存ボタンクリック後にクリアするため、ここではクリアしない
-                this.showComplete(data.filename, data.title);
-            } else if (data.status === 'error') {
-                this.stopPolling();
-                this.clearSavedTask(); // エラー時はクリア
-                this.showError(data.error || 'ダウンロード中にエラーが発生しました');
-            }
+            this.handleStatus(data);
             
         } catch (error) {
             console.error('Status check failed:', error);
         }
     }
     
+    handleStatus(data) {
+        // 進捗を更新
+        this.updateProgress(data);
+        
+        // 履歴も更新
+        this.updateHistoryTask(this.currentTaskId, {
+            status: data.status,
+            title: data.title,
+            filename: data.filename,
+            progress: data.progress
+        });
+        this.updateHistoryBadge();
+        
+        if (data.status === 'completed') {
+            this.stopPolling();
+            // 完了時は保存ボタンクリック後にクリアするため、ここではクリアしない
+            this.showComplete(data.filename, data.title);
+        } else if (data.status === 'error') {
+            this.stopPolling();
+            this.clearSavedTask(); // エラー時はクリア
+            this.showError(data.error || 'ダウンロード中にエラーが発生しました');
+        }
+    }
+    
     updateProgress(data) {
         const percent = Math.round(data.progress);
         this.progressPercent.textContent = `${percent}%`;
@@ -639,7 +719,7 @@ class RushiaDL {
                 statusClass = 'status-processing';
                 break;
             case 'pending':
-                statusText = '準備中...';
+                statusText = data.queue_position ? `順番待ち（${data.queue_position}番目）` : '準備中...';
                 break;
         }
         
@@ -0,0 +1,272 @@
+"""
+ダウンロードタスクの状態の保存先
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from .cache import ExpiryIndex
+
+# 実行中とみなすステータス
+ACTIVE_STATUSES = ('pending', 'downloading', 'processing')
+
+# タイムアウト未設定のステータスの保持時間（秒）
+DEFAULT_TASK_TIMEOUT = 3 * 60 * 60
+
+
+class MemoryTaskStore:
+    """プロセス内の辞書でタスクを管理（既定）
+
+    update() は新しい辞書に差し替えるため、get() で受け取った辞書は
+    その時点のスナップショットとして一貫した状態のまま読める。
+    """
+
+    shared = False
+
+    def __init__(self, timeouts: dict):
+        self.timeouts = timeouts
+        self._tasks: dict = {}
+        self._expiry = ExpiryIndex()
+        self._lock = threading.Lock()
+
+    def create(self, task_id: str, task: dict):
+        """タスクを登録"""
+        task = dict(task)
+        task['expires_at'] = _expires_at(task, self.timeouts)
+        with self._lock:
+            self._tasks[task_id] = task
+            self._expiry.schedule(task_id, task['expires_at'])
+
+    def get(self, task_id: str) -> Optional[dict]:
+        """タスクを取得（存在しない場合はNone）"""
+        return self._tasks.get(task_id)
+
+    def update(self, task_id: str, batch: bool = False, **fields):
+        """タスクの項目を更新（batchはSQLite版との互換のため）"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            task = {**task, **fields}
+            if 'status' in fields:
+                task['expires_at'] = _expires_at(task, self.timeouts)
+                self._expiry.schedule(task_id, task['expires_at'])
+            self._tasks[task_id] = task
+
+    def delete(self, task_id: str):
+        """タスクを削除"""
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            self._expiry.discard(task_id)
+
+    def active(self) -> list:
+        """実行中のタスク一覧 [(task_id, task), ...]"""
+        with self._lock:
+            return [(tid, t) for tid, t in self._tasks.items() if t.get('status') in ACTIVE_STATUSES]
+
+    def delete_expired(self, now: float) -> int:
+        """期限切れのタスクを削除し、削除件数を返す"""
+        with self._lock:
+            expired = self._expiry.pop_due(now)
+            for task_id in expired:
+                self._tasks.pop(task_id, None)
+        return len(expired)
+
+    def next_expiry(self) -> Optional[float]:
+        """最も早いタスクの削除予定時刻"""
+        with self._lock:
+            return self._expiry.next_deadline()
+
+    def flush(self):
+        """保留中の書き込みを反映（メモリ版では不要）"""
+
+    def close(self):
+        """保存先を閉じる"""
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+
+class SqliteTaskStore:
+    """SQLite（WALモード）でタスクを管理
+
+    複数のuvicornワーカーから同じファイルを参照できる。進捗のように頻繁な
+    更新は batch=True で渡すとプロセス内に溜め、flush_interval ごとに
+    まとめて書き込む（ステータス変更を含む更新は即座に書き込む）。
+    """
+
+    shared = True
+
+    def __init__(self, path: Path, timeouts: dict, flush_interval: float = 1.0):
+        self.path = path
+        self.timeouts = timeouts
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._pending: dict = {}
+        self._pending_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status);
+            CREATE INDEX IF NOT EXISTS idx_tasks_expires_at ON tasks (expires_at);
+        """)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        """スレッドごとの接続を取得"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, task_id: str, task: dict):
+        """タスクを登録"""
+        task = dict(task)
+        task['expires_at'] = _expires_at(task, self.timeouts)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, expires_at, data) VALUES (?, ?, ?, ?)",
+                (task_id, task['status'], task['expires_at'], json.dumps(task, ensure_ascii=False)),
+            )
+
+    def get(self, task_id: str) -> Optional[dict]:
+        """タスクを取得（このプロセスの未反映の更新も含める）"""
+        row = self._conn().execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        task = json.loads(row[0])
+        with self._pending_lock:
+            pending = self._pending.get(task_id)
+            if pending:
+                task.update(pending)
+        return task
+
+    def update(self, task_id: str, batch: bool = False, **fields):
+        """タスクの項目を更新"""
+        with self._pending_lock:
+            if batch and 'status' not in fields:
+                self._pending.setdefault(task_id, {}).update(fields)
+                if time.monotonic() - self._last_flush < self.flush_interval:
+                    return
+                batch_fields = self._take_pending()
+            else:
+                # ステータス変更などは保留中の進捗と合わせて即座に書き込む
+                pending = self._pending.pop(task_id, {})
+                pending.update(fields)
+                batch_fields = {task_id: pending}
+        self._write(batch_fields)
+
+    def _take_pending(self) -> dict:
+        pending = self._pending
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        return pending
+
+    def _write(self, updates: dict):
+        """複数タスクの更新を1トランザクションで書き込む
+
+        読み出してから書き戻すまでに他のプロセスの更新が挟まって失われないよう、
+        最初に書き込みロックを取る。
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for task_id, fields in updates.items():
+                row = conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+                if row is None:
+                    continue
+                task = json.loads(row[0])
+                task.update(fields)
+                if 'status' in fields:
+                    task['expires_at'] = _expires_at(task, self.timeouts)
+                conn.execute(
+                    "UPDATE tasks SET status = ?, expires_at = ?, data = ? WHERE task_id = ?",
+                    (task['status'], task['expires_at'], json.dumps(task, ensure_ascii=False), task_id),
+                )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def delete(self, task_id: str):
+        """タスクを削除"""
+        with self._pending_lock:
+            self._pending.pop(task_id, None)
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def active(self) -> list:
+        """実行中のタスク一覧 [(task_id, task), ...]"""
+        placeholders = ','.join('?' * len(ACTIVE_STATUSES))
+        rows = self._conn().execute(
+            f"SELECT task_id, data FROM tasks WHERE status IN ({placeholders})", ACTIVE_STATUSES
+        ).fetchall()
+        return [(task_id, json.loads(data)) for task_id, data in rows]
+
+    def delete_expired(self, now: float) -> int:
+        """期限切れのタスクを削除し、削除件数を返す"""
+        self.flush()
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("DELETE FROM tasks WHERE expires_at <= ?", (now,))
+        return cursor.rowcount
+
+    def next_expiry(self) -> Optional[float]:
+        """最も早いタスクの削除予定時刻（expires_atのインデックスを使用）"""
+        return self._conn().execute("SELECT MIN(expires_at) FROM tasks").fetchone()[0]
+
+    def flush(self):
+        """保留中の進捗を書き込む"""
+        with self._pending_lock:
+            batch_fields = self._take_pending()
+        if batch_fields:
+            self._write(batch_fields)
+
+    def close(self):
+        """保留中の書き込みを反映して接続を閉じる"""
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __contains__(self, task_id: str) -> bool:
+        row = self._conn().execute("SELECT 1 FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+
+def _expires_at(task: dict, timeouts: dict) -> float:
+    """作成時刻とステータスごとのタイムアウトから削除予定時刻を計算"""
+    timeout = timeouts.get(task.get('status', 'pending'), DEFAULT_TASK_TIMEOUT)
+    return task.get('created_at', time.time()) + timeout
+
+
+def create_task_store(name: str, timeouts: dict, path: Optional[Path] = None):
+    """名前から保存先を作成"""
+    if name == 'memory':
+        return MemoryTaskStore(timeouts)
+    if name == 'sqlite':
+        return SqliteTaskStore(path, timeouts)
+    raise ValueError(f"Unknown task store: {name} (choose from memory, sqlite)")
@@ -0,0 +1,33 @@
+"""
+URLの解析
+"""
+import re
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+# YouTubeの動画ID（11文字）
+VIDEO_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{11}$')
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """YouTubeのURLから動画IDを取得（取得できない場合はNone）"""
+    parsed = urlparse(url)
+    host = (parsed.netloc or '').lower()
+
+    candidate = None
+    if host.endswith('youtu.be'):
+        # https://youtu.be/<id>
+        candidate = parsed.path.strip('/').split('/')[0]
+    elif 'youtube.com' in host:
+        query_params = parse_qs(parsed.query)
+        if 'v' in query_params:
+            candidate = query_params['v'][0]
+        else:
+            # /shorts/<id>, /live/<id>, /embed/<id>
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'live', 'embed', 'v'):
+                candidate = parts[1]
+
+    if candidate and VIDEO_ID_PATTERN.match(candidate):
+        return candidate
+    return None
@@ -0,0 +1,354 @@
+"""
+yt-dlpの実行バックエンド（スレッドプール / プロセスプール）
+"""
+import asyncio
+import multiprocessing
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled, DownloadError
+
+from .player_cache import enable_preprocessed_player_cache
+from .sessions import YoutubeDLPool
+
+# 子プロセスから親プロセスへ送る進捗情報の項目（picklableなもののみ）
+PROGRESS_FIELDS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'fragment_index', 'fragment_count', 'speed', 'eta', 'elapsed',
+    'filename', 'tmpfilename', 'format_ids',
+)
+POSTPROCESSOR_FIELDS = ('status', 'postprocessor')
+
+# 子プロセスの終了後、送られた進捗を中継し終えるまで待つ最大時間（秒）
+RELAY_FLUSH_TIMEOUT = 5.0
+
+# yt-dlpのリトライ間隔（秒）: 1, 2, 4, ... 最大 RETRY_SLEEP_MAX（それぞれ半分までの揺らぎあり）
+RETRY_SLEEP_BASE = 1.0
+RETRY_SLEEP_MAX = 30.0
+
+# 子プロセス内で使う進捗送信用キュー（プール初期化時に設定）
+_event_queue = None
+
+# 全体のバックオフ終了時刻（UNIX時刻）。スレッド版は _SharedTime、プロセス版は共有メモリ
+_backoff_until = None
+
+# キャンセル要求のフラグ（プロセス版のみ、実行枠ごとの共有メモリ）
+_cancel_flags = None
+
+# 解析済みのプレイヤーJSを共有キャッシュに保存（子プロセスではimport時に設定される）
+enable_preprocessed_player_cache()
+
+# このプロセスのYoutubeDLセッションプール（プロセス版では子プロセスごとに持つ）
+session_pool = YoutubeDLPool()
+
+
+class _SharedTime:
+    """スレッド間で共有する時刻（multiprocessing.Valueと同じ .value で読み書き）"""
+
+    def __init__(self):
+        self.value = 0.0
+
+
+def _retry_sleep(n: int) -> float:
+    """yt-dlpのリトライ待ち時間（全体のバックオフ中はその終了まで待つ）
+
+    同時に動いているジョブがそれぞれすぐにリトライして上流へ負荷をかけ続けないよう、
+    レート制限の検知後は全ジョブのリトライをバックオフの終了後にそろえる。
+    """
+    delay = min(RETRY_SLEEP_MAX, RETRY_SLEEP_BASE * 2 ** n) * random.uniform(0.5, 1.0)
+    if _backoff_until is not None:
+        delay = max(delay, _backoff_until.value - time.time())
+    return delay
+
+
+# 後処理の段階へ渡すフォーマットの情報
+DOWNLOADED_FILE_FIELDS = ('format_id', 'ext', 'vcodec', 'acodec', 'container', 'protocol')
+
+
+def run_ytdlp(url: str, ydl_opts: dict, probed_info: Optional[dict] = None) -> Optional[dict]:
+    """yt-dlpでダウンロードを実行し、動画情報を返す
+
+    選ばれたフォーマットは結合・変換せずに個別のファイルとして保存し、
+    パスとフォーマットの情報を '_downloaded_files' に設定する（後処理は postprocess で行う）。
+    ダウンロードの前に、選ばれたフォーマットIDを進捗フックへ {'status': 'selected'} として通知する。
+    """
+    opts = _download_opts(ydl_opts)
+    with session_pool.session(opts) as ydl:
+        if probed_info:
+            # 取得済みの動画情報を使って再抽出を省略（フォーマットの選択のみやり直す）
+            info = ydl.process_ie_result(probed_info, download=False)
+        else:
+            info = ydl.extract_info(url, download=False)
+        if info:
+            requested = info.get('requested_formats') or [info]
+            format_ids = [fmt['format_id'] for fmt in requested if fmt.get('format_id')]
+            for hook in opts.get('progress_hooks') or []:
+                hook({'status': 'selected', 'format_ids': format_ids})
+            info['_downloaded_files'] = [
+                _download_format(ydl, info, fmt) for fmt in info.get('requested_formats') or [{}]
+            ]
+        return info
+
+
+def _download_format(ydl: YoutubeDL, info: dict, fmt: dict) -> dict:
+    """1つのフォーマットをダウンロード（yt-dlpが複数フォーマットを順に保存するのと同じ手順）"""
+    format_info = {k: v for k, v in info.items() if k != 'requested_formats'}
+    format_info.update(fmt)
+    ydl.process_info(format_info)
+    downloaded = {k: format_info.get(k) for k in DOWNLOADED_FILE_FIELDS}
+    downloaded['path'] = format_info.get('filepath') or ydl.prepare_filename(format_info)
+    return downloaded
+
+
+def _download_opts(ydl_opts: dict) -> dict:
+    """ダウンロード時のオプション（リトライ待ちを全体のバックオフに合わせる）"""
+    opts = dict(ydl_opts)
+    opts.setdefault('retry_sleep_functions', {
+        'http': _retry_sleep,
+        'fragment': _retry_sleep,
+        'extractor': _retry_sleep,
+    })
+    return opts
+
+
+def warm_sessions(opts_list: list) -> int:
+    """ダウンロード用のセッションを事前に作成し、作成できた数を返す"""
+    warmed = 0
+    for ydl_opts in opts_list:
+        try:
+            session_pool.warm(_download_opts(ydl_opts))
+            warmed += 1
+        except Exception as e:
+            print(f"[Worker] Failed to warm YoutubeDL session: {e}")
+    return warmed
+
+
+def _init_process_worker(event_queue, backoff_until, cancel_flags):
+    """プロセスプールのワーカー初期化"""
+    global _event_queue, _backoff_until, _cancel_flags
+    _event_queue = event_queue
+    _backoff_until = backoff_until
+    _cancel_flags = cancel_flags
+
+
+def _cancellable(hook: Callable, is_cancelled: Callable) -> Callable:
+    """キャンセル要求があれば進捗フックから例外を送出してyt-dlpを中断する"""
+    def wrapper(d):
+        if is_cancelled():
+            raise DownloadCancelled('Download cancelled')
+        hook(d)
+    return wrapper
+
+
+def _relay_hook(task_id: str, kind: str, fields: tuple) -> Callable:
+    """進捗を親プロセスへ転送するフック"""
+    def hook(d):
+        _event_queue.put((task_id, kind, {k: d[k] for k in fields if k in d}))
+    return hook
+
+
+def _run_ytdlp_in_process(task_id: str, url: str, ydl_opts: dict, probed_info: Optional[dict],
+                          slot: Optional[int] = None) -> Optional[dict]:
+    """子プロセスでyt-dlpを実行（戻り値と例外は親プロセスへ送れる形に変換）
+
+    終了時に 'done' を送り、親プロセスはそれまでの進捗を中継し終えてからコールバックを外す。
+    """
+    opts = dict(ydl_opts)
+    relay = _relay_hook(task_id, 'progress', PROGRESS_FIELDS)
+    opts['progress_hooks'] = [_cancellable(relay, lambda: slot is not None and _cancel_flags[slot])]
+    opts['postprocessor_hooks'] = [_relay_hook(task_id, 'postprocess', POSTPROCESSOR_FIELDS)]
+    try:
+        info = run_ytdlp(url, opts, probed_info)
+        return YoutubeDL.sanitize_info(info)
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        # yt-dlpの例外はロガーやトレースバック（exc_info）を持ち、pickleできないため
+        # メッセージだけを持つ例外に置き換える（エラーの分類はメッセージで行う）
+        raise DownloadError(str(e)) from None
+    finally:
+        _event_queue.put((task_id, 'done', None))
+
+
+class ThreadBackend:
+    """uvicornプロセス内のスレッドプールでyt-dlpを実行"""
+
+    name = 'thread'
+
+    def __init__(self, max_workers: int):
+        global _backoff_until
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._backoff_until = _backoff_until = _SharedTime()
+        self._running: set = set()
+        self._cancelled: set = set()
+        self._stopping = False
+
+    async def run(self, task_id: str, url: str, ydl_opts: dict,
+                  on_progress: Callable, on_postprocess: Callable,
+                  probed_info: Optional[dict] = None) -> Optional[dict]:
+        """ダウンロードを実行（キャンセルされた場合は DownloadCancelled）"""
+        opts = dict(ydl_opts)
+        opts['progress_hooks'] = [_cancellable(on_progress, lambda: self._stopping or task_id in self._cancelled)]
+        opts['postprocessor_hooks'] = [on_postprocess]
+        self._running.add(task_id)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, run_ytdlp, url, opts, probed_info)
+        finally:
+            self._running.discard(task_id)
+            self._cancelled.discard(task_id)
+
+    def cancel(self, task_id: str) -> bool:
+        """実行中のジョブを次の進捗の報告時に中断させる（このバックエンドで実行中でなければFalse）"""
+        if task_id not in self._running:
+            return False
+        self._cancelled.add(task_id)
+        return True
+
+    def set_backoff(self, until: float):
+        """実行中のジョブのリトライを until まで待たせる"""
+        self._backoff_until.value = until
+
+    async def warm(self, opts_list: list) -> int:
+        """ダウンロード用のセッションを事前に作成"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, warm_sessions, opts_list)
+
+    def shutdown(self):
+        """実行中のジョブを次の進捗の報告時に中断させて停止（書き込み途中のファイルは残す）"""
+        self._stopping = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        session_pool.close()
+
+
+class ProcessBackend:
+    """別プロセスでyt-dlpを実行（GILを共有しないためコア数に応じて並列化できる）
+
+    進捗は multiprocessing.Queue 経由で受け取り、中継スレッドが
+    タスクごとのコールバックを呼び出す。
+    """
+
+    name = 'process'
+
+    def __init__(self, max_workers: int):
+        # uvicornのスレッドを引き継がないようspawnで起動
+        context = multiprocessing.get_context('spawn')
+        self._event_queue = context.Queue()
+        self._backoff_until = context.Value('d', 0.0, lock=False)
+        # 実行中のジョブは同時実行数までなので、実行枠ごとにキャンセルのフラグを用意する
+        self._cancel_flags = context.Array('b', max_workers, lock=False)
+        self._free_slots = list(range(max_workers))
+        self._slots: dict = {}
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_process_worker,
+            initargs=(self._event_queue, self._backoff_until, self._cancel_flags),
+        )
+        self._callbacks: dict = {}
+        self._relay = threading.Thread(target=self._relay_events, name='ytdlp-progress-relay', daemon=True)
+        self._relay.start()
+
+    async def run(self, task_id: str, url: str, ydl_opts: dict,
+                  on_progress: Callable, on_postprocess: Callable,
+                  probed_info: Optional[dict] = None) -> Optional[dict]:
+        """ダウンロードを実行（キャンセルされた場合は DownloadCancelled）"""
+        loop = asyncio.get_running_loop()
+        relayed = asyncio.Event()
+        self._callbacks[task_id] = {
+            'progress': on_progress,
+            'postprocess': on_postprocess,
+            'done': lambda _: loop.call_soon_threadsafe(relayed.set),
+        }
+        slot = self._free_slots.pop() if self._free_slots else None
+        if slot is not None:
+            self._cancel_flags[slot] = 0
+            self._slots[task_id] = slot
+        try:
+            future = loop.run_in_executor(
+                self.executor, _run_ytdlp_in_process, task_id, url, ydl_opts, probed_info, slot
+            )
+            try:
+                return await future
+            finally:
+                if future.done() and not future.cancelled():
+                    await self._wait_relayed(task_id, relayed)
+        finally:
+            self._callbacks.pop(task_id, None)
+            if slot is not None:
+                del self._slots[task_id]
+                self._free_slots.append(slot)
+
+    async def _wait_relayed(self, task_id: str, relayed: asyncio.Event):
+        """子プロセスが送った最後の進捗（完了・選ばれたフォーマット・ファイル名）まで中継されるのを待つ
+
+        子プロセスが異常終了して 'done' が届かない場合は RELAY_FLUSH_TIMEOUT で諦める。
+        """
+        try:
+            await asyncio.wait_for(relayed.wait(), RELAY_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[Worker] Progress relay for {task_id} did not finish in {RELAY_FLUSH_TIMEOUT}s")
+
+    def cancel(self, task_id: str) -> bool:
+        """実行中のジョブ（子プロセス）を次の進捗の報告時に中断させる"""
+        slot = self._slots.get(task_id)
+        if slot is None:
+            return False
+        self._cancel_flags[slot] = 1
+        return True
+
+    def _relay_events(self):
+        """子プロセスからの進捗をタスクのコールバックへ中継"""
+        while True:
+            event = self._event_queue.get()
+            if event is None:
+                break
+            task_id, kind, data = event
+            callback = self._callbacks.get(task_id, {}).get(kind)
+            if callback is None:
+                continue
+            try:
+                callback(data)
+            except Exception as e:
+                print(f"[Worker] Progress relay error ({task_id}): {e}")
+
+    def set_backoff(self, until: float):
+        """実行中のジョブ（子プロセス）のリトライを until まで待たせる"""
+        self._backoff_until.value = until
+
+    async def warm(self, opts_list: list) -> int:
+        """子プロセスを起動してセッションを事前に作成
+
+        どの子プロセスで実行されるかは指定できないため、ワーカー数だけ投入する（目安）。
+        """
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, warm_sessions, opts_list)
+            for _ in range(self.max_workers)
+        ))
+        return sum(results)
+
+    def shutdown(self):
+        """実行中のジョブ（子プロセス）を次の進捗の報告時に中断させて停止（書き込み途中のファイルは残す）"""
+        for slot in range(self.max_workers):
+            self._cancel_flags[slot] = 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self._event_queue.put(None)
+
+
+DOWNLOAD_BACKENDS = {
+    ThreadBackend.name: ThreadBackend,
+    ProcessBackend.name: ProcessBackend,
+}
+
+
+def create_backend(name: str, max_workers: int):
+    """名前からバックエンドを作成"""
+    if name not in DOWNLOAD_BACKENDS:
+        raise ValueError(f"Unknown download backend: {name} (choose from {', '.join(DOWNLOAD_BACKENDS)})")
+    return DOWNLOAD_BACKENDS[name](max_workers)